@@ -0,0 +1,286 @@
+import argparse
+import hashlib
+import inspect
+import itertools
+import json
+import os
+import sys
+from bms import BMS, MachineError, STATES, STATE_CODES, TRIGGERS, TRANSITIONS
+from charging import ChargeController
+from clock import VirtualClock
+from events import NullSink
+import faults
+from faults import evaluate_faults
+from profiles import LI4P25RT, LIMIT_FIELDS
+
+# Static analysis of the state machine of a BMS class: reachability, dead ends, transitions that are never taken
+# and safety invariants, over the product of the states and discretised sensor regions
+# python analysis.py [--cache DIR]
+# Prints the report as JSON, the exit status is 1 if a step raises or an invariant is violated from a state that is
+# not a known gap (KNOWN_GAPS), or if a known gap is not violated any more (the list is kept exact)
+#
+# The graph is the one the step handlers actually take: from every state, one step (entering it or staying in it)
+# is run for every combination of sensor regions (one representative reading per region of each channel, the
+# regions being delimited by the warning/fatal limits of the profile) and inputs, and every transition fire() takes
+# is recorded; between steps the readings and inputs can change to anything
+# Triggers no step handler fires (EXTERNAL_TRIGGERS) are fired from outside, from any state where they are valid
+# The BMS is explored with a ChargeController, so the charging limit checks (charging_fault, and fatal_fault_detected
+# for the fatal limits) are part of the graph
+#
+# Reports are cached by the hash of the graph (the transitions, the source of the modules the handlers depend on
+# and the profile limits), so an unchanged machine is not explored again
+
+EXTERNAL_TRIGGERS = ('button_pressed_5_sec',)
+INPUTS = ('pedal_press', 'button_press', 'charger_plugged_in', 'diagnostics_pass')
+CHANNELS = ('voltage', 'current', 'temp_voltage', 'soc')
+
+# Steps a BMS holding a fatal fault is given to reach deep sleep without any user action
+HORIZON = 1000
+
+# Known gaps of the original state machine: states from which a BMS holding a fatal fault does not get to deep sleep
+# on its own (fatal_fault_shuts_down), allowed by the exit status until the handlers are changed
+KNOWN_GAPS = {
+    'run_tests': "the tests check the typical readings run_tests sets, not the measured ones",
+    'idle': "idle does not check for faults",
+    'normal_operation': "the button takes normal and fault operation to sleep before a fatal fault shuts them down",
+    'sleep': "sleep does not check for faults",
+}
+
+# Modules whose source the step handlers depend on, besides the modules of the BMS class
+SOURCES = ('bms', 'faults', 'soc', 'profiles', 'charging', 'cellmodel')
+
+
+def regions(profile=LI4P25RT):
+    # (name, representative reading) of every region of each channel
+    p = profile
+    return {
+        'voltage': [
+            ('undervoltage', p.undervoltage_fatal - 0.1),
+            ('low', (p.undervoltage_fatal + p.undervoltage_warning) / 2),
+            ('normal', (p.undervoltage_warning + p.overvoltage_warning) / 2),
+            ('high', (p.overvoltage_warning + p.overvoltage_fatal) / 2),
+            ('overvoltage', p.overvoltage_fatal + 0.1),
+        ],
+        'current': [
+            ('normal', 0.0),
+            ('high', (p.overcurrent_warning + p.overcurrent_fatal) / 2),
+            ('overcurrent', p.overcurrent_fatal + 10),
+        ],
+        # a higher sensor voltage is a colder cell
+        'temp_voltage': [
+            ('undertemperature', p.undertemperature_fatal + 0.05),
+            ('cold', (p.undertemperature_warning + p.undertemperature_fatal) / 2),
+            ('normal', (p.overtemperature_warning + p.undertemperature_warning) / 2),
+            ('hot', (p.overtemperature_fatal + p.overtemperature_warning) / 2),
+            ('overtemperature', p.overtemperature_fatal - 0.05),
+        ],
+        'soc': [('empty', 2.0), ('low', 30.0), ('storage', 50.0), ('high', 75.0), ('full', 100.0)],
+    }
+
+
+def graph_hash(cls=BMS, transitions=TRANSITIONS, profile=LI4P25RT):
+    digest = hashlib.sha256()
+    digest.update(json.dumps([list(transition) for transition in transitions]).encode())
+    modules = list(dict.fromkeys([c.__module__ for c in cls.__mro__ if c is not object] + list(SOURCES)))
+    for name in modules:
+        digest.update(inspect.getsource(sys.modules[name] if name in sys.modules else __import__(name)).encode())
+    digest.update(repr([getattr(profile, field) for field in LIMIT_FIELDS]).encode())
+    digest.update(repr((EXTERNAL_TRIGGERS, HORIZON)).encode())
+    return digest.hexdigest()
+
+
+class Recorder():
+    # Takes the place of the TransitionHistory of the BMS being explored, keeps the transitions of one step
+    def __init__(self):
+        self.taken = []
+
+    def record(self, timestamp, source, dest, trigger):
+        self.taken.append((trigger, source, dest))
+
+
+def explorer(cls, profile):
+    bms = cls(VirtualClock(), events=NullSink(), profile=profile)
+    bms.simulated = False # the readings stay at the region representatives
+    bms.charge_controller = ChargeController(profile=profile) # charging checks its limits
+    bms.history = Recorder()
+    return bms
+
+
+def step_from(bms, state, readings, inputs, enter):
+    # One step in state with the given readings and inputs, returns the transitions it took
+    # (a step firing a trigger that is not valid in the state it got to raises MachineError)
+    bms.state_code = state
+    bms.step_code = -1 if enter else state
+    bms.voltage, bms.current, bms.temp_voltage, bms.soc = readings
+    bms.pedal_press, bms.button_press, bms.charger_plugged_in, bms.diagnostics_pass = inputs
+    del bms.history.taken[:]
+    bms.step()
+    return bms.history.taken
+
+
+def explore(cls=BMS, profile=LI4P25RT):
+    # Transitions taken by one step from every (state, readings, inputs), as (trigger, source, dest) codes,
+    # all of them and those taken with a fatal fault in the readings, and the errors raised by steps
+    # as (state, inputs, message)
+    bms = explorer(cls, profile)
+    points = list(itertools.product(*[[value for name, value in regions(profile)[channel]] for channel in CHANNELS]))
+    taken = set()
+    fatal = set()
+    errors = set()
+    for state in range(len(STATES)):
+        for readings in points:
+            faulty = evaluate_faults(readings[0], readings[1], readings[2], profile) & faults.FATAL_MASK
+            for inputs in itertools.product((False, True), repeat=len(INPUTS)):
+                for enter in (True, False):
+                    try:
+                        steps = step_from(bms, state, readings, inputs, enter)
+                    except MachineError as error:
+                        steps = bms.history.taken
+                        errors.add((state, tuple(name for name, on in zip(INPUTS, inputs) if on), str(error)))
+                    taken.update(steps)
+                    if faulty:
+                        fatal.update(steps)
+    for trigger in EXTERNAL_TRIGGERS:
+        for trigger_name, source, dest in TRANSITIONS:
+            if trigger_name == trigger:
+                external = (TRIGGERS.index(trigger), STATE_CODES[source], STATE_CODES[dest])
+                taken.add(external)
+                fatal.add(external)
+    return taken, fatal, errors
+
+
+def reach(edges, start):
+    # States reachable from start through edges (source, dest) pairs
+    found = {start}
+    frontier = [start]
+    while frontier:
+        state = frontier.pop()
+        for source, dest in edges:
+            if source == state and dest not in found:
+                found.add(dest)
+                frontier.append(dest)
+    return found
+
+
+def shutdown_runs(cls=BMS, profile=LI4P25RT, horizon=HORIZON):
+    # Starts from which a BMS with one fatal fault (held in the readings) and the inputs left as they are does not
+    # get to deep sleep: (state, readings, inputs, state it stays in) for every such start
+    bms = explorer(cls, profile)
+    channels = regions(profile)
+    normal = [dict(channels[channel])['normal'] for channel in ('voltage', 'current', 'temp_voltage')]
+    fatal_readings = []
+    for i, channel in enumerate(('voltage', 'current', 'temp_voltage')):
+        for name, value in channels[channel]:
+            readings = list(normal)
+            readings[i] = value
+            if evaluate_faults(*readings, profile) & faults.FATAL_MASK:
+                fatal_readings.append((name, readings))
+
+    failures = []
+    for state in range(len(STATES)):
+        if STATES[state] == 'deep_sleep':
+            continue
+        for (fault, readings), (level, soc) in itertools.product(fatal_readings, channels['soc']):
+            for inputs in itertools.product((False, True), repeat=len(INPUTS)):
+                try:
+                    step_from(bms, state, readings + [soc], inputs, True)
+                    end = run_to_shutdown(bms, readings, horizon)
+                except MachineError:
+                    continue # reported by explore
+
+                if end is not None:
+                    failures.append({'state': STATES[state], 'fault': fault, 'soc': level,
+                                     'inputs': [name for name, on in zip(INPUTS, inputs) if on], 'stays_in': STATES[end]})
+    return failures
+
+
+def run_to_shutdown(bms, readings, horizon):
+    # Step on with the fault held until deep sleep (returns None), a step that changes nothing or the horizon
+    # (returns the state the BMS is left in)
+    for _ in range(horizon):
+        if STATES[bms.state_code] == 'deep_sleep':
+            return None
+        before = (bms.state_code, bms.step_code, bms.soc, bms.pedal_press, bms.button_press, bms.charger_plugged_in)
+        bms.voltage, bms.current, bms.temp_voltage = readings
+        bms.step()
+        if (bms.state_code, bms.step_code, bms.soc, bms.pedal_press, bms.button_press, bms.charger_plugged_in) == before:
+            break
+    return None if STATES[bms.state_code] == 'deep_sleep' else bms.state_code
+
+
+def analyze(cls=BMS, profile=LI4P25RT, cache=None):
+    # Report of the analysis of cls, read from/written to the directory cache if given
+    key = graph_hash(cls, TRANSITIONS, profile)
+    path = os.path.join(cache, key + '.json') if cache is not None else None
+    if path is not None and os.path.exists(path):
+        with open(path) as file:
+            report = json.load(file)
+        report['cached'] = True
+        return report
+
+    taken, fatal, errors = explore(cls, profile)
+    edges = {(source, dest) for trigger, source, dest in taken}
+    fatal_edges = {(source, dest) for trigger, source, dest in fatal}
+    start = STATE_CODES['deep_sleep']
+    reachable = reach(edges, start)
+    declared = [(TRIGGERS.index(trigger), STATE_CODES[source], STATE_CODES[dest]) for trigger, source, dest in TRANSITIONS]
+
+    def names(codes):
+        return [STATES[code] for code in sorted(codes)]
+
+    def transitions(codes):
+        return [[TRIGGERS[trigger], STATES[source], STATES[dest]] for trigger, source, dest in codes]
+
+    shutdown_failures = [failure for failure in shutdown_runs(cls, profile) if STATE_CODES[failure['state']] in reachable]
+    report = {
+        'hash': key,
+        'reachable': names(reachable),
+        'unreachable_states': names(set(range(len(STATES))) - reachable),
+        # reachable states no step ever leaves
+        'dead_ends': names(state for state in reachable if not any(source == state and dest != state for source, dest in edges)),
+        # reachable states from which deep sleep can't be reached any more
+        'traps': names(state for state in reachable if start not in reach(edges, state)),
+        'unreachable_transitions': transitions(transition for transition in declared
+                                               if transition not in taken or transition[1] not in reachable),
+        # steps that fire a trigger the state they got to has no transition for
+        'step_errors': [{'state': STATES[state], 'inputs': list(inputs), 'error': message}
+                        for state, inputs, message in sorted(errors) if state in reachable],
+        'invariants': {
+            # every state can reach deep sleep while a fatal fault lasts (the user may act)
+            'fatal_fault_can_reach_deep_sleep': names(state for state in reachable if start not in reach(fatal_edges, state)),
+            # every state gets to deep sleep on its own while a fatal fault lasts (the user does nothing)
+            'fatal_fault_shuts_down': sorted(set(failure['state'] for failure in shutdown_failures), key=STATES.index),
+        },
+        'counterexamples': {'fatal_fault_shuts_down': shutdown_failures[:10]},
+    }
+    if path is not None:
+        os.makedirs(cache, exist_ok=True)
+        with open(path, 'w') as file:
+            json.dump(report, file, indent=2)
+    report['cached'] = False
+    return report
+
+
+def problems(report, known_gaps=KNOWN_GAPS):
+    # What fails the analysis: step errors, invariant violations outside known_gaps and known gaps no longer seen
+    found = [f"step error in {error['state']}: {error['error']}" for error in report['step_errors']]
+    for name, states in report['invariants'].items():
+        allowed = known_gaps if name == 'fatal_fault_shuts_down' else {}
+        found += [f"{name} violated from {state}" for state in states if state not in allowed]
+        found += [f"known gap of {name} in {state} not seen" for state in allowed if state not in states]
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reachability and safety analysis of the BMS state machine")
+    parser.add_argument('--cache', default='.analysis_cache', help="directory of the cached reports ('' for none)")
+    args = parser.parse_args(argv)
+
+    report = analyze(cache=args.cache or None)
+    report['problems'] = problems(report)
+    print(json.dumps(report, indent=2))
+    return 1 if report['problems'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
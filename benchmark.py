@@ -0,0 +1,274 @@
+import argparse
+import gc
+import json
+import sys
+import time
+import tracemalloc
+import numpy as np
+from bms import BMS, STATES, TRANSITIONS, STATE_CODES, TRIGGER_CODES
+from clock import VirtualClock
+from events import NullSink
+from compact import BMSStore
+from fleet import BMSFleet
+
+# Benchmarks for the state machine and the simulation
+# python benchmark.py [--quick] [--output results.json] [--baseline baseline.json] [--threshold 0.2]
+# Prints the results as JSON, and with a baseline, the change of every metric and the regressions beyond threshold
+# Metrics ending in _per_s are better when higher, every other metric (times, bytes) is better when lower
+# Every time is the best of several runs; a change of a whole-run time (_s) below NOISE_FLOOR, or of a metric within
+# its THRESHOLDS entry, is reported but not counted as a regression
+
+SCALES = [1, 10, 100, 1000, 10000, 100000, 1000000]
+QUICK_SCALES = [1, 10, 100, 1000, 10000]
+MAX_SCALAR_INSTANCES = 100000 # larger BMS lists are only measured as a BMSFleet
+
+# Times in seconds this short are within timer and scheduling noise
+NOISE_FLOOR = 1e-3
+# Regression thresholds of metrics noisier than the others, by name prefix (the larger of this and --threshold)
+THRESHOLDS = {'scaling.': 0.5}
+
+
+def best_time(function, number, repeat=5, setup=None):
+    # Best time in seconds of one call out of repeat runs of number calls, setup() runs untimed before each run
+    # The garbage collector is off while timing (like timeit), its pauses depend on everything allocated before
+    best = float('inf')
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            for _ in range(number):
+                function()
+            best = min(best, (time.perf_counter() - start) / number)
+    finally:
+        if enabled:
+            gc.enable()
+    return best
+
+
+def quiet_bms():
+    return BMS(VirtualClock(), events=NullSink())
+
+
+def bench_construction(number):
+    return {'construction_us': best_time(quiet_bms, number) * 1e6}
+
+
+def bench_transitions(number):
+    # Latency of each of the transitions, firing the trigger from its source state
+    results = {}
+    bms = quiet_bms()
+    for trigger, source, dest in TRANSITIONS:
+        source_code = STATE_CODES[source]
+        trigger_code = TRIGGER_CODES[trigger]
+        trigger_method = getattr(bms, trigger)
+
+        def fire():
+            bms.state_code = source_code
+            trigger_method()
+
+        def fire_code():
+            bms.state_code = source_code
+            bms.fire(trigger_code)
+
+        name = f"{trigger}:{source}->{dest}"
+        results[name + '_ns'] = best_time(fire, number) * 1e9
+        results[name + ':fire_ns'] = best_time(fire_code, number) * 1e9
+    return {'transitions': results}
+
+
+def bench_fault_check(number):
+    bms = quiet_bms()
+    bms.voltage = 3.6
+    fleet = BMSFleet(100000)
+    fleet.voltage[:] = np.linspace(2.4, 4.3, fleet.n)
+    return {
+        'fault_check_per_s': 1 / best_time(bms.fault_check, number),
+        'evaluate_faults_per_s': 1 / best_time(bms.evaluate_faults, number),
+        'fleet_fault_check_per_s': fleet.n / best_time(fleet.fault_check, 10),
+    }
+
+
+def bench_normal_operation(number):
+    # Full normal operation ticks (simulation, SOC, fault checks, transitions)
+    # Readings are reset every tick so the BMS stays in normal operation
+    bms = quiet_bms()
+    normal = STATE_CODES['normal_operation']
+
+    def tick():
+        bms.state_code = normal
+        bms.voltage = 3.6
+        bms.current = 0
+        bms.temp_voltage = 1.86
+        bms.enter_normal_operation()
+
+    return {'normal_ticks_per_s': 1 / best_time(tick, number)}
+
+
+def bench_steps(number):
+    # Latency of one step() in each state (one control period, never waits), from typical readings
+    results = {}
+    bms = quiet_bms()
+    for code, state in enumerate(STATES):
+
+        def step():
+            bms.state_code = bms.step_code = code
+            bms.voltage = 3.6
+            bms.current = 0
+            bms.temp_voltage = 1.86
+            bms.soc = 75
+            bms.step()
+
+        results[state + '_ns'] = best_time(step, number) * 1e9
+    return {'steps': results}
+
+
+def bytes_per_bms(n):
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    cells = [quiet_bms() for _ in range(n)]
+    used = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    del cells
+    return used / n
+
+
+def compact_bytes_per_instance(n):
+    # Rows of a BMSStore holding n cells (the cells are used through store[i] when needed)
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    store = BMSStore(n, VirtualClock(), NullSink())
+    for _ in range(n):
+        store.new()
+    used = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    return used / n
+
+
+def fleet_bytes_per_instance(fleet):
+    arrays = [value for value in vars(fleet).values() if isinstance(value, np.ndarray)]
+    return sum(array.nbytes for array in arrays) / fleet.n
+
+
+def normal_operation_setup(cells):
+    # Puts every cell back in normal operation with typical readings, before each timed tick
+    normal = STATE_CODES['normal_operation']
+
+    def setup():
+        for cell in cells:
+            cell.state_code = normal
+            cell.voltage = 3.6
+            cell.current = 0
+    return setup
+
+
+def tick_all(cells):
+    def tick():
+        for cell in cells:
+            cell.enter_normal_operation()
+    return tick
+
+
+def bench_scaling(scales):
+    # Construction, one tick of every instance and memory, from 1 instance up (best of 5 runs each)
+    results = []
+    for n in scales:
+        result = {'instances': n}
+        if n <= MAX_SCALAR_INSTANCES:
+            result['bms_construction_s'] = best_time(lambda: [quiet_bms() for _ in range(n)], 1)
+            cells = [quiet_bms() for _ in range(n)]
+            result['bms_tick_s'] = best_time(tick_all(cells), 1, setup=normal_operation_setup(cells))
+            del cells
+            result['bms_bytes_per_instance'] = bytes_per_bms(min(n, 10000))
+            result['compact_bytes_per_instance'] = compact_bytes_per_instance(n)
+            store = BMSStore(n, VirtualClock(), NullSink())
+            cells = [store.new() for _ in range(n)]
+            result['compact_tick_s'] = best_time(tick_all(cells), 1, setup=normal_operation_setup(cells))
+            del cells
+
+        result['fleet_construction_s'] = best_time(lambda: BMSFleet(n, seed=0), 1)
+        fleet = BMSFleet(n, seed=0)
+        fleet.state[:] = STATE_CODES['normal_operation']
+        fleet.voltage[:] = 3.6
+        result['fleet_tick_s'] = best_time(fleet.step, 1, repeat=3)
+        result['fleet_bytes_per_instance'] = fleet_bytes_per_instance(fleet)
+        results.append(result)
+    return {'scaling': {str(result['instances']): result for result in results}}
+
+
+def run(quick=False):
+    number = 2000 if quick else 20000
+    results = {}
+    results.update(bench_construction(number))
+    results.update(bench_transitions(number))
+    results.update(bench_fault_check(number))
+    results.update(bench_normal_operation(number))
+    results.update(bench_steps(number))
+    results.update(bench_scaling(QUICK_SCALES if quick else SCALES))
+    return results
+
+
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        elif key != 'instances':
+            flat[prefix + key] = value
+    return flat
+
+
+def metric_threshold(name, threshold):
+    for prefix, value in THRESHOLDS.items():
+        if name.startswith(prefix):
+            return max(threshold, value)
+    return threshold
+
+
+def compare(results, baseline, threshold):
+    # Relative change of every metric found in both, and the metrics that got worse by more than their threshold
+    changes = {}
+    regressions = []
+    current = flatten(results)
+    for name, old in flatten(baseline).items():
+        if name not in current or not old:
+            continue
+        new = current[name]
+        change = (new - old) / old
+        changes[name] = change
+        if name.endswith('_s') and not name.endswith('_per_s') and max(old, new) < NOISE_FLOOR:
+            continue
+        worse = -change if name.endswith('_per_s') else change
+        if worse > metric_threshold(name, threshold):
+            regressions.append(name)
+    return changes, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="BMS benchmarks")
+    parser.add_argument('--quick', action='store_true', help="fewer iterations and at most 10k instances")
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    parser.add_argument('--baseline', help="JSON results of an earlier run to compare against")
+    parser.add_argument('--threshold', type=float, default=0.2, help="relative change counted as a regression")
+    args = parser.parse_args(argv)
+
+    report = {'results': run(args.quick)}
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        report['changes'], regressions = compare(report['results'], baseline.get('results', baseline), args.threshold)
+        report['regressions'] = regressions
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text + '\n')
+    print(text)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,14 @@
-import time
-from transitions import Machine
+import math
 import random
+import numpy as np
+from clock import RealClock
+import events
+from events import DEBUG, INFO, WARNING, ERROR, PrintSink
+import faults
+from faults import evaluate_faults
+from profiles import LI4P25RT
+from temperature import DEFAULT_SENSOR
+from soc import coulomb_count, ocv_to_soc, soc_to_ocv, OCV_MIN, OCV_MAX
 
 # Li4P25RT (1s4p) Accumulator Battery Thresholds
 
@@ -18,133 +26,242 @@ import random
 #                       Charge range - [0 C, 45 C]
 # Temperature sensors in battery output a voltage that corresponds to a temperature
 
-class BMS():
-    def __init__(self):
-        # initialize measuremennt/booleans
-        self.voltage = 0
-        self.current = 0
-        self.soc = 100
-        self.ocv = 3.8
-        self.temp_voltage = 1.86 # 25 C
-        self.pedal_press = False
-        self.charger_plugged_in = False
-        self.diagnostics_pass = True # true if passed, false if not
-        self.button_press = False # false for car off, true for car on
-
-        # Initialize states
-        states = ['deep_sleep','run_tests','idle','normal_operation','fault_operating','sleep','discharge_to_storage','charging']
-
-        # Set up state machine
-        self.machine = Machine(model=self, states=states, initial='deep_sleep')
-        self.initialize_transitions()
-    
-    def initialize_transitions(self):
-        # 1) Transition from deep_sleep to run_tests when the button is pressed for 5 seconds
-        self.machine.add_transition(trigger='button_pressed_5_sec', source='deep_sleep', dest='run_tests')
-
-        # 2) Transition from run_tests to idle if the tests are passed
-        self.machine.add_transition(trigger='tests_passed', source='run_tests', dest='idle')
-
-        # 3) Transition from run_tests back to deep_sleep if the tests are failed
-        self.machine.add_transition(trigger='tests_failed', source='run_tests', dest='deep_sleep')
-
-        # 4) Transition from idle to normal operation if pedal is pressed
-        self.machine.add_transition(trigger='pedal_pressed', source='idle', dest='normal_operation')
+# Charging and discharge_to_storage move the SOC by PHASE_SOC_STEP % every PHASE_PERIOD seconds
+# until it reaches PHASE_TARGETS[state]
+PHASE_SOC_STEP = 0.5
+PHASE_PERIOD = 0.2
+PHASE_TARGETS = {'charging': 100, 'discharge_to_storage': 50}
+
+# States of the BMS, the index of each state is its state code
+STATES = ['deep_sleep','run_tests','idle','normal_operation','fault_operating','sleep','discharge_to_storage','charging']
+
+# Transitions of the BMS as (trigger, source, dest)
+TRANSITIONS = [
+    # 1) Transition from deep_sleep to run_tests when the button is pressed for 5 seconds
+    ('button_pressed_5_sec', 'deep_sleep', 'run_tests'),
+    # 2) Transition from run_tests to idle if the tests are passed
+    ('tests_passed', 'run_tests', 'idle'),
+    # 3) Transition from run_tests back to deep_sleep if the tests are failed
+    ('tests_failed', 'run_tests', 'deep_sleep'),
+    # 4) Transition from idle to normal operation if pedal is pressed
+    ('pedal_pressed', 'idle', 'normal_operation'),
+    # 5) Transition from idle to sleep if button is pressed
+    ('button_pressed', 'idle', 'sleep'),
+    # 6) Transition from normal operation to sleep if button is pressed
+    ('button_pressed', 'normal_operation', 'sleep'),
+    # 7) Transition from normal operation to sleep if SOC < 4%
+    ('soc_below_4_percent', 'normal_operation', 'sleep'),
+    # 8) Transition from normal operation to fault operating if a fault is detected
+    ('fault_detected', 'normal_operation', 'fault_operating'),
+    # 9) Transition from fault operating to deep sleep if fatal fault is detected (shutdown circuit)
+    ('fatal_fault_detected', 'fault_operating', 'deep_sleep'),
+    # 10) Transition from fault operating to normal operating if no fault is detected
+    ('no_faults', 'fault_operating', 'normal_operation'),
+    # 11) Transition from fault operating to sleep if button is pressed
+    ('button_pressed', 'fault_operating', 'sleep'),
+    # 12) Transition from sleep to idle if the button is pressed
+    ('button_pressed', 'sleep', 'idle'),
+    # 13) Transition from sleep to charging if charger is plugged in
+    ('charger_in', 'sleep', 'charging'),
+    # 14) Transition from sleep to discharge to storage if button is pressed for 5 seconds
+    ('button_pressed_5_sec', 'sleep', 'discharge_to_storage'),
+    # 15) Transition from charging to sleep if fully charged
+    ('fully_charged', 'charging', 'sleep'),
+    # 16) Transition from discharge to storage to deep sleep if SOC reaches 50%
+    ('soc_50', 'discharge_to_storage', 'deep_sleep'),
+    # 17) Transition from charging to sleep if a charge limit is exceeded (charging.ChargeController)
+    ('charging_fault', 'charging', 'sleep'),
+    # 18) Transition from charging to deep sleep if a fatal fault is detected while charging (shutdown circuit)
+    ('fatal_fault_detected', 'charging', 'deep_sleep'),
+]
+
+# Transition table compiled once from STATES/TRANSITIONS and shared by every BMS
+# TRANSITION_TABLE[state code][trigger code] is the dest state code, or -1 if the trigger is not valid from that state
+STATE_CODES = {name: code for code, name in enumerate(STATES)}
+TRIGGERS = list(dict.fromkeys(trigger for trigger, source, dest in TRANSITIONS))
+TRIGGER_CODES = {name: code for code, name in enumerate(TRIGGERS)}
+
+def compile_transitions(transitions):
+    table = [[-1] * len(TRIGGERS) for _ in STATES]
+    for trigger, source, dest in transitions:
+        table[STATE_CODES[source]][TRIGGER_CODES[trigger]] = STATE_CODES[dest]
+    return tuple(tuple(row) for row in table)
+
+TRANSITION_TABLE = compile_transitions(TRANSITIONS)
+
+
+# Event reported for each fault bit
+FAULT_EVENTS = {
+    faults.POTENTIAL_UNDERVOLTAGE: events.POTENTIAL_UNDERVOLTAGE,
+    faults.POTENTIAL_OVERVOLTAGE: events.POTENTIAL_OVERVOLTAGE,
+    faults.POTENTIAL_OVERCURRENT: events.POTENTIAL_OVERCURRENT,
+    faults.POTENTIAL_UNDERTEMPERATURE: events.POTENTIAL_UNDERTEMPERATURE,
+    faults.POTENTIAL_OVERTEMPERATURE: events.POTENTIAL_OVERTEMPERATURE,
+    faults.UNDERVOLTAGE: events.UNDERVOLTAGE,
+    faults.OVERVOLTAGE: events.OVERVOLTAGE,
+    faults.OVERCURRENT: events.OVERCURRENT,
+    faults.UNDERTEMPERATURE: events.UNDERTEMPERATURE,
+    faults.OVERTEMPERATURE: events.OVERTEMPERATURE,
+}
+
+
+class MachineError(Exception):
+    # Raised when a trigger has no transition from the current state
+    pass
+
+def set_handlers(cls):
+    # begin_*/step_* methods of every state, indexed by state code, as overridden in cls
+    cls.begin_handlers = tuple(getattr(cls, 'begin_' + state) for state in STATES)
+    cls.step_handlers = tuple(getattr(cls, 'step_' + state) for state in STATES)
+
+
+def unsupported_property(name, description):
+    # Optional BMS plug-in a subclass does not support: reads as None, only None can be set
+    def getter(self):
+        return None
+    def setter(self, value):
+        if value is not None:
+            raise AttributeError(f"{type(self).__name__} has no {description}, {name} can only be None")
+    return property(getter, setter)
+
+
+class BMSBase():
+    # Behaviour of the BMS (state handlers, fault checks, simulation), shared by BMS and compact.CompactBMS
+    # which only differ in where the instance data is kept
+    __slots__ = ()
+
+    # Temperature sensor used to convert temp_voltage to C
+    sensor = DEFAULT_SENSOR
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        set_handlers(cls)
+
+    @property
+    def state(self):
+        return STATES[self.state_code]
+
+    @state.setter
+    def state(self, name):
+        self.state_code = STATE_CODES[name]
+
+    @property
+    def temperature(self):
+        # Cell temperature in C from the sensor voltage
+        return self.sensor.to_celsius(self.temp_voltage)
+
+    @temperature.setter
+    def temperature(self, celsius):
+        self.temp_voltage = self.sensor.to_voltage(celsius)
+
+    def fire(self, trigger):
+        # Take the transition for trigger (name or code) from the current state through TRANSITION_TABLE
+        if trigger.__class__ is str:
+            trigger = TRIGGER_CODES[trigger]
+        dest = TRANSITION_TABLE[self.state_code][trigger]
+        if dest < 0:
+            raise MachineError(f"Can't trigger event {TRIGGERS[trigger]} from state {self.state}!")
+        if self.history is not None:
+            self.history.record(self.clock.time(), self.state_code, dest, trigger)
+        self.state_code = dest
+        return True
+
+    # Every state has a begin_* method, its work when it is entered, and a step_* method, the work of one
+    # control period in it, neither of which waits or runs the work of another state
+    # step() runs them for the current state, the enter_* methods run them in the blocking style of the test scenarios
+
+    def step(self):
+        # One control period: begin_* if the state was entered since the last step, then step_*
+        # A transition taken during the step only takes effect at the next call, so the stack never nests
+        code = self.state_code
+        if code != self.step_code:
+            self.step_code = code
+            self.begin_handlers[code](self)
+        self.step_handlers[code](self)
 
-        # 5) Transition from idle to sleep if button is pressed
-        self.machine.add_transition(trigger='button_pressed', source='idle', dest='sleep')
-
-        # 6) Transition from normal operation to sleep if button is pressed
-        self.machine.add_transition(trigger='button_pressed', source='normal_operation', dest='sleep')
-
-        # 7) Transition from normal operation to sleep if SOC < 4%
-        self.machine.add_transition(trigger='soc_below_4_percent', source='normal_operation', dest='sleep')
-
-        # 8) Transition from normal operation to fault operating if a fault is detected
-        self.machine.add_transition(trigger='fault_detected', source='normal_operation', dest='fault_operating')
-
-        # 9) Transition from fault operating to deep sleep if fatal fault is detected (shutdown circuit)
-        self.machine.add_transition(trigger='fatal_fault_detected', source='fault_operating', dest='deep_sleep')
-
-        # 10) Transition from fault operating to normal operating if no fault is detected
-        self.machine.add_transition(trigger='no_faults', source='fault_operating', dest='normal_operation')
-
-        # 11) Transition from fault operating to sleep if button is pressed
-        self.machine.add_transition(trigger='button_pressed', source='fault_operating', dest='sleep')
-
-        # 12) Transition from sleep to idle if the button is pressed
-        self.machine.add_transition(trigger='button_pressed', source='sleep', dest='idle')
-
-        # 13) Transition from sleep to charging if charger is plugged in
-        self.machine.add_transition(trigger='charger_in', source='sleep', dest='charging')
-
-        # 14) Transition from sleep to discharge to storage if button is pressed for 5 seconds
-        self.machine.add_transition(trigger='button_pressed_5_sec', source='sleep', dest='discharge_to_storage')
-
-        # 15) Transition from charging to sleep if fully charged
-        self.machine.add_transition(trigger='fully_charged', source='charging', dest='sleep')
+    def enter_deep_sleep(self):
+        self.begin_deep_sleep()
+        self.step_deep_sleep()
+        self.clock.sleep(1)
 
-        # 16) Transition from discharge to storage to deep sleep if SOC reaches 50%
-        self.machine.add_transition(trigger='soc_50', source='discharge_to_storage', dest='deep_sleep')
+    def begin_deep_sleep(self):
+        self.events.emit(INFO, events.ENTER_DEEP_SLEEP, self)
+        if self.fault_filter is not None:
+            self.fault_filter.reset() # powered off, faults are debounced again from scratch
 
-        
-    def enter_deep_sleep(self):
-        print("Entering deep sleep: Power is off for long-term storage.")
+    def step_deep_sleep(self):
         # Simulate power switch being off
         self.voltage = 0  
         self.current = 0
         self.pedal_press = False
         self.button_press = False
-        time.sleep(1)
 
     def enter_run_tests(self):
+        self.begin_run_tests()
+        self.step_run_tests()
+
+    def begin_run_tests(self):
         self.voltage = 3.6 # set to typical values
         self.current = 0
         self.temp_voltage = 1.86
-        print("Running tests: Checking battery health and system readiness.")
+        self.events.emit(INFO, events.ENTER_RUN_TESTS, self)
+
+    def step_run_tests(self):
         # Check for communication, fault detection, charger status
         if not(self.fault_check()) and self.diagnostics_pass:
             self.tests_passed() # Move to idle
-            print("Configuration Tests Passed")
+            self.events.emit(INFO, events.TESTS_PASSED, self)
         else:
-            print("Configuration Tests Failed")
+            self.events.emit(WARNING, events.TESTS_FAILED, self)
             self.tests_failed() # Move back to deep sleep
 
     def enter_idle(self):
-        print("System is idle. Waiting for accelerator or button press.")
+        self.begin_idle()
+        self.step_idle()
+
+    def begin_idle(self):
+        self.events.emit(INFO, events.ENTER_IDLE, self)
+
+    def step_idle(self):
         # Waiting for user input (pedal press/button press)
         # while self.state == 'idle': (doesn't work, had to put while loop in the test functions)
         # Check if the pedal is pressed
         if self.pedal_press:
-            print("Pedal pressed. Transitioning to normal operation.")
+            self.events.emit(INFO, events.PEDAL_PRESSED, self)
             self.pedal_pressed()  # Trigger the transition to normal_operation
         
         # Check if the button is pressed
         if self.button_press:
-            print("Button pressed. Transitioning to sleep.")
+            self.events.emit(INFO, events.BUTTON_TO_SLEEP, self)
             self.button_pressed()  # Trigger the transition to sleep
         
-        # time.sleep(0.1)
+        # self.clock.sleep(0.1)
         
 
     def enter_normal_operation(self):
-        print("Car in normal operation: Monitoring battery performance.")
+        self.begin_normal_operation()
+        self.step_normal_operation()
+
+    def begin_normal_operation(self):
+        self.events.emit(INFO, events.ENTER_NORMAL_OPERATION, self)
+
+    def step_normal_operation(self):
         # Begin continuous monitoring of voltage, current, SOC, temperature
         proportion = 1.0
         # while loop moved to the test function
         self.simulate_battery(proportion) # Update attributes based on "sensor readings"
         self.simulate_soc() # Simulate SOC
 
-        print(f"Voltage: {self.voltage}, Current: {self.current}, Temperature Voltage: {self.temp_voltage}, SOC: {self.soc}")
+        self.events.emit(DEBUG, events.MEASUREMENT, self)
 
         if self.fault_check(): # If fault, transition to fault operating state
             self.fault_detected() # Trigger tranistion to fault operating
         elif self.soc <= 4: # Go to sleep to prevent full battery drainage
-            print("SOC below 4%. Transitioning to sleep.")
+            self.events.emit(INFO, events.SOC_BELOW_4_PERCENT, self)
             self.soc_below_4_percent()
 
         if self.button_press:
-            print("Button pressed. Transitioning to sleep.")
+            self.events.emit(INFO, events.BUTTON_TO_SLEEP, self)
             self.button_pressed()  # Trigger the transition to sleep
 
 
@@ -152,143 +269,295 @@ class BMS():
     # If overtemperature is detected, can activate cooling systems and limit current
     # If overcurrent or overvoltage is detected, limit current
     def enter_fault_operating(self):
-        print("Fault detected: Activating protection mechanisms.")
+        self.begin_fault_operating()
         # Limit current if fault is not cleared, check if fault clears
-        proportion = 0.75
         while self.state == 'fault_operating':
-            self.simulate_battery(proportion)
-            self.simulate_soc()
-            if not(self.fault_check()):
-                print("No more faults")
-                self.no_faults() # go back to normal operation
+            self.step_fault_operating()
+            self.clock.sleep(self.sample_period)
+
+    def begin_fault_operating(self):
+        self.events.emit(WARNING, events.ENTER_FAULT_OPERATING, self)
+
+    def step_fault_operating(self):
+        # One pass of the fault operating loop (does not wait)
+        proportion = 0.75
+        self.simulate_battery(proportion)
+        self.simulate_soc()
+        flags = self.evaluate_faults() # warning and fatal limits checked once per loop
+        if not(self.fault_check(flags)):
+            self.events.emit(INFO, events.NO_MORE_FAULTS, self)
+            self.no_faults() # go back to normal operation
 
-            if self.fatal_fault_check():
-                print("Fatal Fault Detected. Shutting down")
-                self.fatal_fault_detected() # Trigger transition to deep sleep if fatal fault
+        if self.fatal_fault_check(flags):
+            self.events.emit(ERROR, events.FATAL_FAULT, self)
+            self.fatal_fault_detected() # Trigger transition to deep sleep if fatal fault
 
-            if self.button_press:
-                print("Button pressed. Transitioning to sleep.")
-                self.button_pressed()  # Trigger the transition to sleep if button pressed
-            time.sleep(0.1)
+        elif self.button_press:
+            self.events.emit(INFO, events.BUTTON_TO_SLEEP, self)
+            self.button_pressed()  # Trigger the transition to sleep if button pressed
 
     def enter_sleep(self):
-        print("System in sleep mode. OCV measurement ongoing.")
+        self.begin_sleep()
+        self.step_sleep()
+
+    def begin_sleep(self):
+        self.events.emit(INFO, events.ENTER_SLEEP, self)
         # Low power state, occasional OCV checks (time doubles after each OCV measurement)
         # time_break = 0.5
         self.current = 0
         self.button_press = False
         self.pedal_press = False
         # while self.state == 'sleep':
-            # time.sleep(time_break)
+            # self.clock.sleep(time_break)
             # time_break = time_break * 2
         self.simulate_ocv()
 
+    def step_sleep(self):
+        self.check_sleep_inputs()
+
+    def check_sleep_inputs(self):
+        # Leave sleep if the button is pressed or the charger is plugged in (the button first, at most one
+        # transition per step: charger_in is not valid from idle)
         if self.button_press:
-            print("Button pressed. Transitioning to idle.")
+            self.events.emit(INFO, events.BUTTON_TO_IDLE, self)
             self.button_pressed()  # Trigger the transition to idle
-        if self.charger_plugged_in:
-            print("Charger Plugged in: Transitioning to charging state")
+        elif self.charger_plugged_in:
+            self.events.emit(INFO, events.CHARGER_IN, self)
             self.charger_in()
 
     def enter_discharge_to_storage(self):
-        print("Discharging battery to 50% for storage.")
+        self.begin_discharge_to_storage()
         # Simulate discharge process
-        while self.soc > 50:
-            self.soc -= 0.5
-            print(f"SOC: {self.soc}")
-            time.sleep(0.2)
-        self.soc_50() # Transition to deep sleep
+        while self.state == 'discharge_to_storage':
+            self.step_discharge_to_storage()
+            self.clock.sleep(PHASE_PERIOD)
+
+    def begin_discharge_to_storage(self):
+        self.events.emit(INFO, events.ENTER_DISCHARGE_TO_STORAGE, self)
+
+    def step_discharge_to_storage(self):
+        # One 0.5% step of the discharge (does not wait)
+        if self.soc > 50:
+            self.soc -= PHASE_SOC_STEP
+            self.events.emit(DEBUG, events.SOC_STEP, self)
+        if self.simulated:
+            self.voltage = soc_to_ocv(self.soc) # no load, the voltage follows the OCV curve
+        if self.soc <= 50:
+            self.soc_50() # Transition to deep sleep
 
 
     def enter_charging(self):
-        print("Charging battery.")
-        # Simulate charging process (assumes safe charging, can add checking for charging faults)
-        while self.soc < 100:
-            self.soc += 0.5
-            time.sleep(0.2)  # Simulate charging time
-            print(f"SOC: {self.soc}")
-            if self.soc >= 100:
-                self.soc = 100
-                self.charger_plugged_in = False # Stimulate unplugging
-                self.fully_charged()  # Trigger transition when fully charged
-
-    def fault_check(self):
-        # For discharge
-        # 2.7 V < voltage < 4.0 V
-        # i < 110 A
-        # -15 < temp < 55 corresponds to 2.32 V > temp_voltage > 1.55 V
-        fault_detected = False
-        # Check voltage conditions
-        if self.voltage <= 2.7:
-            print("Fault: Potential for undervoltage")
-            fault_detected = True
-        if self.voltage >= 4.0:
-            print("Fault: Potential for overvoltage")
-            fault_detected = True
-        # Check current condition
-        if self.current >= 110:
-            print("Fault: Potential for overcurrent")
-            fault_detected = True
-        # Check temperature conditions
-        if self.temp_voltage >= 2.32:
-            print("Fault: Potential for undertemperature")
-            fault_detected = True
-        elif self.temp_voltage <= 1.55:
-            print("Fault: Potential for overtemperature")
-            fault_detected = True
+        self.begin_charging()
+        # Simulate charging process (a charge_controller also checks the charge limits every tick)
+        while self.state == 'charging':
+            self.step_charging()
+            self.clock.sleep(PHASE_PERIOD)  # Simulate charging time
+
+    def begin_charging(self):
+        self.events.emit(INFO, events.ENTER_CHARGING, self)
+
+    def step_charging(self):
+        # One 0.5% step of the charging (does not wait), or one CC/CV tick of the charge controller
+        if self.charge_controller is not None:
+            self.charge_controller.step(self)
+            return
+        if self.soc < 100:
+            self.soc += PHASE_SOC_STEP
+            self.events.emit(DEBUG, events.SOC_STEP, self)
+        if self.simulated:
+            self.voltage = soc_to_ocv(min(self.soc, 100)) # the voltage follows the OCV curve
+        if self.soc >= 100:
+            self.soc = 100
+            self.charger_plugged_in = False # Stimulate unplugging
+            self.fully_charged()  # Trigger transition when fully charged
+
+    def fast_forward(self, resolution=None):
+        # Run a whole charging or discharge_to_storage phase at once, in place of enter_charging/enter_discharge_to_storage:
+        # the end SOC, voltage, state and clock time are computed from the start SOC instead of stepping 0.5% at a time
+        # (on a VirtualClock this takes no time at all, whatever the length of the phase)
+        # Returns (seconds, samples), samples being None or the (times, soc) arrays every resolution seconds
+        state = self.state
+        if state not in PHASE_TARGETS:
+            raise MachineError(f"No phase to fast-forward in state {state}!")
+        if state == 'charging' and self.charge_controller is not None:
+            raise MachineError("CC/CV charging can't fast-forward, step it through charging")
+        code = self.state_code
+        if code != self.step_code: # begin_* unless a step already ran it, as in step()
+            self.step_code = code
+            self.begin_handlers[code](self)
+        start = self.clock.time()
+        soc = self.soc
+        steps, sign = phase_steps(soc, state)
+        seconds = steps * PHASE_PERIOD
+
+        samples = None
+        if resolution is not None:
+            times = np.arange(math.ceil(seconds / resolution - 1e-9)) * resolution
+            done = np.minimum(np.floor(times / PHASE_PERIOD + 1e-9) + 1, steps) # steps taken by each time
+            levels = soc + sign * PHASE_SOC_STEP * done
+            if state == 'charging':
+                levels = np.minimum(levels, 100)
+            samples = (start + times, levels)
+
+        if sign:
+            self.soc = soc + sign * PHASE_SOC_STEP * steps
+        self.clock.sleep(seconds)
+        self.events.emit(DEBUG, events.SOC_FAST_FORWARD, self)
+        if state == 'charging':
+            self.step_charging() # at 100%: unplugs and takes fully_charged
+        else:
+            self.step_discharge_to_storage() # at 50% or below: takes soc_50
+        return seconds, samples
+
+    def evaluate_faults(self):
+        # Check voltage, current and temperature against the warning and fatal limits in one pass
+        # returns the bitmask of the limits that tripped (see faults.py), also kept in self.fault_flags
+        # With a fault_filter, the bitmask after hysteresis and debouncing (one filter sample per call)
+        flags = evaluate_faults(self.voltage, self.current, self.temp_voltage, self.profile)
+        if self.fault_filter is not None:
+            flags = self.fault_filter.filter(self, flags)
+        self.fault_flags = flags
+        return flags
+
+    def fault_check(self, flags=None):
+        # For discharge, against the warning limits of self.profile
+        # flags can be passed in to reuse an evaluate_faults result from the same readings
+        if flags is None:
+            flags = self.evaluate_faults()
+        flags &= faults.WARNING_MASK
+        if flags:
+            for bit in faults.WARNING_BITS:
+                if flags & bit:
+                    self.events.emit(WARNING, FAULT_EVENTS[bit], self)
         # returns true if there is a fault and false if there is not a fault
-        return fault_detected
+        return flags != 0
     
-    def fatal_fault_check(self):
-        # For discharge
-        # 2.5 V < voltage < 4.2 V
-        # i < 120 A
-        # -20 < temp < 60 so 2.35 V < temp_voltage < 1.51 V
-        fault_detected = False
-        # Check voltage conditions
-        if self.voltage <= 2.5:
-            print("Fault: Undervoltage detected, Shutting off system")
-            fault_detected = True
-        if self.voltage >= 4.2:
-            print("Fault: Overvoltage detected, Shutting off system")
-            fault_detected = True
-        # Check current condition
-        if self.current >= 120:
-            print("Fault: Overcurrent detected, Shutting off system")
-            fault_detected = True
-        # Check temperature conditions
-        if self.temp_voltage >= 2.35:
-            print("Fault: Undertemperature detected, Shutting off system")
-            fault_detected = True
-        elif self.temp_voltage <= 1.51:
-            print("Fault: Overtemperature detected, Shutting off system")
-            fault_detected = True
+    def fatal_fault_check(self, flags=None):
+        # For discharge, against the fatal limits of self.profile
+        if flags is None:
+            flags = self.evaluate_faults()
+        flags &= faults.FATAL_MASK
+        if flags:
+            for bit in faults.FATAL_BITS:
+                if flags & bit:
+                    self.events.emit(ERROR, FAULT_EVENTS[bit], self)
         # returns true if there is a fault and false if there is not a fault
-        return fault_detected
+        return flags != 0
     
     def simulate_soc(self):
-        # Simulate SOC and update attribute
-        # Every cycle, we decrease SOC by 0.5 (made up number)
-        self.soc -= 0.5
+        # Update the SOC for one sample period of drawing self.current (coulomb counting)
+        if self.soc_filter is not None:
+            self.soc = self.soc_filter.step(self.current, self.voltage, self.sample_period)
+        else:
+            self.soc = coulomb_count(self.soc, self.current, self.sample_period, self.profile.capacity)
     
     def simulate_ocv(self):
-        # Measures and updates the attribute for OCV (from sleep state)
-        # would be used for the soc calculate
-        return
+        # Measures and updates the attribute for OCV (from sleep state, no current so the voltage is the OCV)
+        # and corrects the SOC from the OCV-SOC curve
+        if OCV_MIN <= self.voltage <= OCV_MAX:
+            self.ocv = self.voltage
+            self.soc = ocv_to_soc(self.ocv)
+            if self.soc_filter is not None:
+                self.soc_filter.reset(self.soc)
     
     def simulate_battery(self, proportion):
         # If pedal is pressed, increase current, voltage and temperature by a random value
         # If pedal is not pressed, decrease current, voltage, and temperature by a randomized value
         # Additionally, multiply the increase/decrease of each attribute by proportion (simulates limiting currrent if fault is detection)
+        if not self.simulated:
+            return # readings come from real sensors
+        if self.cell_model is not None:
+            self.cell_model.step(self, proportion) # equivalent circuit model instead of the random walk
+            return
+        # Three uniform numbers in [0, 1), scaled like random.uniform(a, b) = a + (b - a) * random()
+        if self.noise is not None:
+            u_current, u_voltage, u_temp = self.noise.row()
+        else:
+            u_current, u_voltage, u_temp = random.random(), random.random(), random.random()
         if self.pedal_press:
-            self.current += random.uniform(0.5, 5.0) * proportion
-            self.voltage += random.uniform(0.01, 0.05) * proportion
-            self.temp_voltage -= random.uniform(0.01, 0.02) * proportion
+            self.current += (0.5 + (5.0 - 0.5) * u_current) * proportion
+            self.voltage += (0.01 + (0.05 - 0.01) * u_voltage) * proportion
+            self.temp_voltage -= (0.01 + (0.02 - 0.01) * u_temp) * proportion
         else:
-            self.current -= random.uniform(0.5, 2.0)
-            self.voltage -= random.uniform(0.01, 0.05)
-            self.temp_voltage += random.uniform(0.01, 0.02)
+            self.current -= 0.5 + (2.0 - 0.5) * u_current
+            self.voltage -= 0.01 + (0.05 - 0.01) * u_voltage
+            self.temp_voltage += 0.01 + (0.02 - 0.01) * u_temp
 
         self.current = max(self.current, 0)
         self.voltage = max(self.voltage, 0)
         self.temp_voltage = max(self.temp_voltage, 0)
+
+set_handlers(BMSBase)
+
+
+class BMS(BMSBase):
+    # Every instance attribute is a fixed slot (no per-instance __dict__)
+    __slots__ = ('clock', 'events', 'profile', 'voltage', 'current', 'soc', 'ocv', 'temp_voltage',
+                 'pedal_press', 'charger_plugged_in', 'diagnostics_pass', 'button_press', 'fault_flags',
+                 'sample_period', 'soc_filter', 'simulated', 'noise', 'cell_model', 'fault_filter', 'charge_controller', 'history',
+                 'state_code', 'step_code')
+
+    def __init__(self, clock=None, events=None, profile=None, noise=None):
+        # Clock used for every delay (real time by default, pass a VirtualClock to simulate instantly)
+        self.clock = clock if clock is not None else RealClock()
+        # Sink for status/fault events (printed by default, pass a NullSink or RingBufferSink for quiet runs)
+        self.events = events if events is not None else PrintSink()
+        # Limits of the cell chemistry (shared CellProfile, Li4P25RT by default)
+        self.profile = profile if profile is not None else LI4P25RT
+
+        # initialize measuremennt/booleans
+        self.voltage = 0
+        self.current = 0
+        self.soc = 100
+        self.ocv = 3.8
+        self.temp_voltage = 1.86 # 25 C
+        self.pedal_press = False
+        self.charger_plugged_in = False
+        self.diagnostics_pass = True # true if passed, false if not
+        self.button_press = False # false for car off, true for car on
+        self.fault_flags = 0 # bitmask of the limits tripped at the last fault evaluation
+
+        # SOC estimation: coulomb counting every sample period (seconds), set soc_filter to a
+        # SOCKalmanFilter to also correct the SOC from the measured voltage
+        self.sample_period = 0.1
+        self.soc_filter = None
+
+        # False when voltage, current and temp_voltage come from real sensor readings instead of simulate_battery
+        self.simulated = True
+        # NoiseStream for simulate_battery (seeded, can be shared by several BMS), the global random module if None
+        self.noise = noise
+        # Cell model (e.g. cellmodel.TheveninModel()) computing the readings in simulate_battery, the random walk if None
+        self.cell_model = None
+        # FaultFilter (debounce.FaultFilter()) applied to every fault evaluation, the raw limit checks if None
+        self.fault_filter = None
+        # ChargeController (charging.ChargeController()) running CC/CV charging, fixed 0.5% steps if None
+        self.charge_controller = None
+        # TransitionHistory recording every transition (see history.attach_history), nothing is recorded if None
+        self.history = None
+
+        # Current state code (index into STATES), every BMS starts in deep sleep
+        self.state_code = STATE_CODES['deep_sleep']
+        # State code of the last step() (-1: not stepped yet), to run begin_* once on entering a state
+        self.step_code = -1
+
+
+def phase_steps(soc, state):
+    # (steps, sign) of a charging or discharge_to_storage phase from soc: the number of PHASE_PERIOD steps
+    # including the one that takes the transition, and the direction of the SOC changes (0 if it is already there)
+    target = PHASE_TARGETS[state]
+    remaining = target - soc if state == 'charging' else soc - target
+    if remaining <= 0:
+        return 1, 0
+    return math.ceil(remaining / PHASE_SOC_STEP), 1 if state == 'charging' else -1
+
+
+def add_trigger_method(trigger):
+    # Trigger methods (bms.button_pressed() etc.) fire their trigger code directly
+    code = TRIGGER_CODES[trigger]
+    def trigger_method(self):
+        return self.fire(code)
+    trigger_method.__name__ = trigger
+    setattr(BMSBase, trigger, trigger_method)
+
+for trigger in TRIGGERS:
+    add_trigger_method(trigger)
@@ -0,0 +1,97 @@
+import math
+import numpy as np
+from lookup import LookupTable
+from soc import SOC_TO_OCV
+from temperature import DEFAULT_SENSOR
+
+# Equivalent circuit cell model, used by simulate_battery in place of the random walk when a BMS (or fleet) has one:
+# first order Thevenin circuit, terminal voltage = OCV(SOC) - I * R0(T) - V1, with V1 the voltage over R1 || C1,
+# and a lumped thermal model, the cell heating up by I^2 * R0 + V1^2 / R1 and cooling to ambient through R_th
+#
+# Both are solved with a fixed step (the sample period): over one step the current is constant, so V1 and the
+# temperature follow exact exponentials whose factors are computed once per step length
+# The current is set by the pedal: drive_current (limited by proportion in fault operating) while pressed,
+# rest_current otherwise, positive currents discharge the cell and lower the SOC through simulate_soc
+
+# R0 relative to its 25 C value (profile.internal_resistance), Arrhenius law with activation temperature of 2500 K
+ACTIVATION_TEMPERATURE = 2500.0
+RESISTANCE_FACTOR = LookupTable(
+    [(t, math.exp(ACTIVATION_TEMPERATURE * (1 / (t + 273.15) - 1 / 298.15))) for t in range(-40, 101, 5)],
+    -40.0, 100.0, 0.1)
+
+# RC pair and thermal parameters of the Li4P25RT (1s4p of 2.5 Ah cells)
+R1 = 0.002 # Ohm
+C1 = 20000.0 # F, 40 s time constant
+HEAT_CAPACITY = 300.0 # J/K
+THERMAL_RESISTANCE = 2.0 # K/W to ambient, with cooling
+DRIVE_CURRENT = 40.0 # A
+REST_CURRENT = 0.5 # A
+
+
+class TheveninModel():
+    # Model of one cell (n=None, for a BMS) or of n cells (for a BMSFleet), every BMS needs its own model
+    # The model state (V1, temperature in C) starts from the readings of the BMS at its first step
+    def __init__(self, n=None, r1=R1, c1=C1, heat_capacity=HEAT_CAPACITY, thermal_resistance=THERMAL_RESISTANCE,
+                 ambient=25.0, drive_current=DRIVE_CURRENT, rest_current=REST_CURRENT, sensor=DEFAULT_SENSOR):
+        self.n = n
+        self.r1 = r1
+        self.rc = r1 * c1
+        self.thermal_resistance = thermal_resistance
+        self.thermal_time = heat_capacity * thermal_resistance
+        self.ambient = ambient
+        self.drive_current = drive_current
+        self.rest_current = rest_current
+        self.sensor = sensor
+        self.dt = None
+        self.v1 = 0.0 if n is None else np.zeros(n)
+        self.temperature = None
+
+    def factors(self, dt):
+        # Decay of V1 and of the temperature difference to steady state over one step of dt seconds
+        if dt != self.dt:
+            self.dt = dt
+            self.rc_decay = math.exp(-dt / self.rc)
+            self.thermal_decay = math.exp(-dt / self.thermal_time)
+        return self.rc_decay, self.thermal_decay
+
+    def step(self, bms, proportion):
+        # One sample period of a BMS: sets current, voltage and temp_voltage
+        rc_decay, thermal_decay = self.factors(bms.sample_period)
+        if self.temperature is None:
+            self.temperature = bms.temperature
+        current = self.drive_current * proportion if bms.pedal_press else self.rest_current
+        r0 = bms.profile.internal_resistance * RESISTANCE_FACTOR.lookup(self.temperature)
+
+        self.v1 = self.v1 * rc_decay + (1 - rc_decay) * self.r1 * current
+        heat = current * current * r0 + self.v1 * self.v1 / self.r1
+        steady = self.ambient + heat * self.thermal_resistance
+        self.temperature = steady + (self.temperature - steady) * thermal_decay
+
+        bms.current = current
+        bms.voltage = max(SOC_TO_OCV.lookup(bms.soc) - current * r0 - self.v1, 0)
+        bms.temp_voltage = self.sensor.to_voltage(self.temperature)
+
+    def step_fleet(self, fleet, proportion, mask):
+        # One sample period of the instances of a fleet in mask, proportion is a scalar or one value per instance
+        rc_decay, thermal_decay = self.factors(fleet.sample_period)
+        if self.temperature is None:
+            self.temperature = self.sensor.to_celsius_array(fleet.temp_voltage)
+        idx = np.flatnonzero(mask)
+        proportion = np.broadcast_to(proportion, mask.shape)[idx]
+        current = np.where(fleet.pedal_press[idx], self.drive_current * proportion, self.rest_current)
+        temperature = self.temperature[idx]
+        r0 = fleet.profile.internal_resistance
+        if np.ndim(r0):
+            r0 = r0[idx]
+        r0 = r0 * RESISTANCE_FACTOR.lookup_array(temperature)
+
+        v1 = self.v1[idx] * rc_decay + (1 - rc_decay) * self.r1 * current
+        heat = current * current * r0 + v1 * v1 / self.r1
+        steady = self.ambient + heat * self.thermal_resistance
+        temperature = steady + (temperature - steady) * thermal_decay
+        self.v1[idx] = v1
+        self.temperature[idx] = temperature
+
+        fleet.current[idx] = current
+        fleet.voltage[idx] = np.maximum(SOC_TO_OCV.lookup_array(fleet.soc[idx]) - current * r0 - v1, 0)
+        fleet.temp_voltage[idx] = self.sensor.to_voltage_array(temperature)
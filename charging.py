@@ -0,0 +1,185 @@
+import numpy as np
+from bms import PHASE_PERIOD
+from cellmodel import RESISTANCE_FACTOR
+import events
+from events import DEBUG, WARNING
+from faults import FATAL_MASK
+from profiles import LI4P25RT
+from soc import SOC_TO_OCV, coulomb_count
+from temperature import DEFAULT_SENSOR
+
+# CC/CV charging controller, used by step_charging in place of the fixed 0.5% steps when a BMS (or fleet) has one:
+# constant current at the charge current limit until the terminal voltage reaches cv_voltage, then constant voltage
+# with the current tapering off until it falls below termination_current (the cell is full)
+# The charge current limit is fast_charge_current derated by temperature and SOC, looked up every tick in a table
+# precomputed over TABLE_TEMPERATURES x TABLE_SOC
+#
+# Every tick the readings are also checked against the charge limits (charge temperature window of the profile,
+# charge current limit, cv_voltage) and the fatal limits of the BMS profile (evaluate_faults), with the charger
+# disconnected on any violation: a charge limit stops the charge through the charging_fault transition
+# (charging => sleep), a fatal limit shuts the BMS down through fatal_fault_detected (charging => deep_sleep)
+# cv_voltage is kept CV_TOLERANCE below the overvoltage fatal limit of the profile (which trips at the limit), and
+# the overvoltage charge limit never lies beyond it
+# Charging currents are negative (positive currents discharge the cell, as everywhere else)
+# With simulated readings the controller sets the current and the voltage (OCV + I * R0(T)), otherwise it only
+# checks the measured ones
+
+FAST_CHARGE_CURRENT = 20.0 # A, with cooling
+CV_VOLTAGE = 4.2 # V, at most overvoltage_fatal - CV_TOLERANCE of the profile
+TERMINATION_CURRENT = 0.5 # A, C/20
+CURRENT_MARGIN = 1.0 # A above the limit before a charging fault
+VOLTAGE_MARGIN = 0.05 # V above cv_voltage before a charging fault
+CV_TOLERANCE = 0.01 # V below cv_voltage that counts as the constant voltage phase
+
+# Derating factors (piecewise linear), no charging at all outside the charge temperature window
+TEMPERATURE_DERATING = [(0, 0.3), (10, 1.0), (40, 1.0), (45, 0.25)] # C
+SOC_DERATING = [(0, 1.0), (80, 1.0), (100, 0.2)] # %
+
+TABLE_TEMPERATURES = np.arange(-40.0, 101.0) # C, 1 C steps
+TABLE_SOC = np.arange(0.0, 101.0) # %, 1 % steps
+
+# Charge fault bits
+CHARGE_OVERCURRENT = 1 << 0
+CHARGE_OVERVOLTAGE = 1 << 1
+CHARGE_UNDERTEMPERATURE = 1 << 2
+CHARGE_OVERTEMPERATURE = 1 << 3
+CHARGE_FATAL_FAULT = 1 << 4 # a fatal limit of the BMS profile, the BMS fault_flags tell which
+
+
+def limit_table(window, fast_charge_current=FAST_CHARGE_CURRENT):
+    # Charge current limit (A) at every (TABLE_TEMPERATURES, TABLE_SOC) point
+    low, high = window
+    temperature = np.interp(TABLE_TEMPERATURES, *zip(*TEMPERATURE_DERATING))
+    temperature[(TABLE_TEMPERATURES < low) | (TABLE_TEMPERATURES > high)] = 0
+    soc = np.interp(TABLE_SOC, *zip(*SOC_DERATING))
+    return fast_charge_current * np.outer(temperature, soc)
+
+
+class ChargeController():
+    # Controller of one BMS (n=None) or of the n instances of a fleet, one call per charging tick of period seconds
+    # flags: the charge fault bits found at the last tick (one value per instance for a fleet)
+    def __init__(self, n=None, profile=LI4P25RT, period=PHASE_PERIOD, fast_charge_current=FAST_CHARGE_CURRENT,
+                 cv_voltage=CV_VOLTAGE, termination_current=TERMINATION_CURRENT, sensor=DEFAULT_SENSOR):
+        self.n = n
+        self.window = profile.charge_temperature
+        self.period = period
+        self.cv_voltage = min(cv_voltage, profile.overvoltage_fatal - CV_TOLERANCE)
+        self.overvoltage = min(self.cv_voltage + VOLTAGE_MARGIN, profile.overvoltage_fatal)
+        self.termination_current = termination_current
+        self.sensor = sensor
+        self.table = limit_table(self.window, fast_charge_current)
+        self.rows = self.table.tolist() # plain floats for scalar lookups
+        self.last_row = len(TABLE_TEMPERATURES) - 1
+        self.last_column = len(TABLE_SOC) - 1
+        self.flags = 0 if n is None else np.zeros(n, dtype=np.uint8)
+
+    def limit(self, temperature, soc):
+        # Charge current limit at the nearest table point
+        row = min(max(int(round(temperature - TABLE_TEMPERATURES[0])), 0), self.last_row)
+        column = min(max(int(round(soc)), 0), self.last_column)
+        return self.rows[row][column]
+
+    def limit_array(self, temperature, soc):
+        rows = np.clip(np.rint(temperature - TABLE_TEMPERATURES[0]), 0, self.last_row).astype(np.intp)
+        columns = np.clip(np.rint(soc), 0, self.last_column).astype(np.intp)
+        return self.table[rows, columns]
+
+    def check(self, voltage, charge_current, temperature, limit, faults):
+        # Charge fault bits of one set of readings, faults being their evaluate_faults bitmask
+        flags = CHARGE_FATAL_FAULT if faults & FATAL_MASK else 0
+        low, high = self.window
+        if temperature < low:
+            flags |= CHARGE_UNDERTEMPERATURE
+        elif temperature > high:
+            flags |= CHARGE_OVERTEMPERATURE
+        if charge_current > limit + CURRENT_MARGIN:
+            flags |= CHARGE_OVERCURRENT
+        if voltage >= self.overvoltage:
+            flags |= CHARGE_OVERVOLTAGE
+        return flags
+
+    def check_array(self, voltage, charge_current, temperature, limit, faults):
+        low, high = self.window
+        flags = np.zeros(len(voltage), dtype=np.uint8)
+        for condition, bit in [(temperature < low, CHARGE_UNDERTEMPERATURE), (temperature > high, CHARGE_OVERTEMPERATURE),
+                               (charge_current > limit + CURRENT_MARGIN, CHARGE_OVERCURRENT),
+                               (voltage >= self.overvoltage, CHARGE_OVERVOLTAGE),
+                               ((faults & FATAL_MASK) != 0, CHARGE_FATAL_FAULT)]:
+            np.bitwise_or(flags, bit, out=flags, where=condition)
+        return flags
+
+    def step(self, bms):
+        # One charging tick of a BMS
+        temperature = self.sensor.to_celsius(bms.temp_voltage)
+        soc = bms.soc
+        limit = self.limit(temperature, soc)
+        if bms.simulated:
+            r0 = bms.profile.internal_resistance * RESISTANCE_FACTOR.lookup(temperature)
+            ocv = SOC_TO_OCV.lookup(soc)
+            current = min(limit, max((self.cv_voltage - ocv) / r0, 0.0))
+            bms.current = -current
+            bms.voltage = ocv + current * r0
+        charge_current = -bms.current
+
+        faults = bms.evaluate_faults()
+        self.flags = self.check(bms.voltage, charge_current, temperature, limit, faults)
+        if self.flags:
+            bms.charger_plugged_in = False # charger disconnected
+            if self.flags & CHARGE_FATAL_FAULT:
+                bms.fatal_fault_check(faults) # reports the fatal limits that tripped
+                bms.fatal_fault_detected()
+            else:
+                bms.events.emit(WARNING, events.CHARGING_FAULT, bms)
+                bms.charging_fault()
+            return
+
+        bms.soc = min(coulomb_count(soc, bms.current, self.period, bms.profile.capacity), 100)
+        bms.events.emit(DEBUG, events.SOC_STEP, bms)
+        constant_voltage = bms.voltage >= self.cv_voltage - CV_TOLERANCE
+        if bms.soc >= 100 or (constant_voltage and charge_current < self.termination_current):
+            bms.soc = 100 # full at the end of the CV phase
+            bms.charger_plugged_in = False # Stimulate unplugging
+            bms.fully_charged()
+
+    def step_fleet(self, fleet, mask):
+        # One charging tick of the instances of a fleet in mask
+        idx = np.flatnonzero(mask)
+        if len(idx) == 0:
+            return
+        temperature = self.sensor.to_celsius_array(fleet.temp_voltage[idx])
+        soc = fleet.soc[idx]
+        limit = self.limit_array(temperature, soc)
+        if fleet.simulated:
+            r0 = fleet.profile.internal_resistance
+            if np.ndim(r0):
+                r0 = r0[idx]
+            r0 = r0 * RESISTANCE_FACTOR.lookup_array(temperature)
+            ocv = SOC_TO_OCV.lookup_array(soc)
+            current = np.minimum(limit, np.maximum((self.cv_voltage - ocv) / r0, 0.0))
+            fleet.current[idx] = -current
+            fleet.voltage[idx] = ocv + current * r0
+        current = fleet.current[idx]
+        voltage = fleet.voltage[idx]
+
+        faults = fleet.evaluate_faults(mask)[idx]
+        flags = self.check_array(voltage, -current, temperature, limit, faults)
+        self.flags[idx] = flags
+        faulty = flags != 0
+        fatal = (flags & CHARGE_FATAL_FAULT) != 0
+
+        capacity = fleet.profile.capacity
+        if np.ndim(capacity):
+            capacity = capacity[idx]
+        charged = np.minimum(coulomb_count(soc, current, self.period, capacity), 100)
+        full = ~faulty & ((charged >= 100) | ((voltage >= self.cv_voltage - CV_TOLERANCE) & (-current < self.termination_current)))
+        charged[full] = 100
+        fleet.soc[idx] = np.where(faulty, soc, charged)
+
+        stopped = idx[faulty | full]
+        fleet.charger_plugged_in[stopped] = False
+        for trigger, instances in (('fatal_fault_detected', idx[fatal]), ('charging_fault', idx[faulty & ~fatal]),
+                                   ('fully_charged', idx[full])):
+            if len(instances):
+                selected = np.zeros(fleet.n, dtype=bool)
+                selected[instances] = True
+                fleet.fire(trigger, selected)
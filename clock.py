@@ -0,0 +1,38 @@
+import time
+
+# Clocks used by the BMS and the test scenarios for every delay
+# RealClock waits on the wall clock (default behaviour)
+# VirtualClock only advances a counter, so simulated time passes instantly
+
+class RealClock():
+    def time(self):
+        # Seconds since an arbitrary point, only differences are meaningful
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class VirtualClock():
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        # Advance simulated time without blocking
+        self.now += seconds
+
+
+class LoopClock():
+    # Time of an asyncio event loop, used by the async runtime (runtime.py)
+    # The runtime does the waiting between ticks by awaiting, so sleep returns at once instead of blocking the loop
+    def __init__(self, loop):
+        self.loop = loop
+
+    def time(self):
+        return self.loop.time()
+
+    def sleep(self, seconds):
+        pass
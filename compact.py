@@ -0,0 +1,138 @@
+from array import array
+from bms import BMSBase, STATE_CODES, unsupported_property
+from clock import RealClock
+from events import PrintSink
+from profiles import LI4P25RT
+
+# Compact BMS: the data of every cell is a row in the typed arrays of a shared BMSStore
+# and each CompactBMS is only a (store, index) pair, so a cell costs well under 100 bytes
+# Row: float32 voltage, current, temp_voltage, ocv, float64 soc, uint16 fault flags,
+#      one byte of bit-packed input flags and one byte each for the state code and the state code of the last step
+
+# Input flag bits
+PEDAL_PRESS = 1
+CHARGER_PLUGGED_IN = 2
+DIAGNOSTICS_PASS = 4
+BUTTON_PRESS = 8
+
+
+class BMSStore():
+    # Rows for up to size cells, cells are taken in order with new()
+    # store[i] makes a new CompactBMS for row i, so cells don't have to be kept around as objects; views of the same
+    # row compare and hash equal, so they can key dicts (e.g. the OCVScheduler's)
+    # clock, events, profile, sample_period, simulated and noise are shared by every cell of the store
+    def __init__(self, size, clock=None, events=None, profile=None):
+        self.size = size
+        self.count = 0
+        self.clock = clock if clock is not None else RealClock()
+        self.events = events if events is not None else PrintSink()
+        self.profile = profile if profile is not None else LI4P25RT
+        self.sample_period = 0.1
+        self.simulated = True
+        self.noise = None
+
+        # Same initial values as BMS
+        self.voltage = array('f', [0.0]) * size
+        self.current = array('f', [0.0]) * size
+        self.temp_voltage = array('f', [1.86]) * size # 25 C
+        self.ocv = array('f', [3.8]) * size
+        self.soc = array('d', [100.0]) * size
+        self.fault_flags = array('H', [0]) * size
+        self.flags = array('B', [DIAGNOSTICS_PASS]) * size
+        self.state_code = array('B', [STATE_CODES['deep_sleep']]) * size
+        self.step_code = array('b', [-1]) * size
+
+    def new(self):
+        # The next unused cell
+        if self.count == self.size:
+            raise IndexError("BMSStore is full")
+        cell = CompactBMS(self, self.count)
+        self.count += 1
+        return cell
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.count:
+            raise IndexError("BMSStore index out of range")
+        return CompactBMS(self, index)
+
+    def __len__(self):
+        return self.count
+
+    def nbytes(self):
+        # Bytes used by the rows
+        rows = [self.voltage, self.current, self.temp_voltage, self.ocv, self.soc, self.fault_flags, self.flags, self.state_code,
+                self.step_code]
+        return sum(row.itemsize * len(row) for row in rows)
+
+
+def row_property(name):
+    # Attribute stored in the array name of the store
+    def getter(self):
+        return getattr(self.store, name)[self.index]
+    def setter(self, value):
+        getattr(self.store, name)[self.index] = value
+    return property(getter, setter)
+
+
+def flag_property(bit):
+    # Boolean stored as one bit of the packed input flags
+    def getter(self):
+        return bool(self.store.flags[self.index] & bit)
+    def setter(self, value):
+        if value:
+            self.store.flags[self.index] |= bit
+        else:
+            self.store.flags[self.index] &= ~bit
+    return property(getter, setter)
+
+
+def shared_property(name):
+    # Attribute shared by every cell of the store
+    def getter(self):
+        return getattr(self.store, name)
+    def setter(self, value):
+        setattr(self.store, name, value)
+    return property(getter, setter)
+
+
+class CompactBMS(BMSBase):
+    # Same interface and behaviour as BMS (float32 measurements aside), created with BMSStore.new()
+    __slots__ = ('store', 'index')
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    def __eq__(self, other):
+        return isinstance(other, CompactBMS) and self.store is other.store and self.index == other.index
+
+    def __hash__(self):
+        return hash((id(self.store), self.index))
+
+    voltage = row_property('voltage')
+    current = row_property('current')
+    temp_voltage = row_property('temp_voltage')
+    ocv = row_property('ocv')
+    soc = row_property('soc')
+    fault_flags = row_property('fault_flags')
+    state_code = row_property('state_code')
+    step_code = row_property('step_code')
+
+    pedal_press = flag_property(PEDAL_PRESS)
+    charger_plugged_in = flag_property(CHARGER_PLUGGED_IN)
+    diagnostics_pass = flag_property(DIAGNOSTICS_PASS)
+    button_press = flag_property(BUTTON_PRESS)
+
+    clock = shared_property('clock')
+    events = shared_property('events')
+    profile = shared_property('profile')
+    sample_period = shared_property('sample_period')
+    simulated = shared_property('simulated')
+    noise = shared_property('noise')
+
+    # Plug-ins that keep per cell state, which a compact cell has no room for: always None, setting one raises
+    soc_filter = unsupported_property('soc_filter', "SOC filter")
+    history = unsupported_property('history', "transition history")
+    cell_model = unsupported_property('cell_model', "cell model") # compact cells use the random walk
+    fault_filter = unsupported_property('fault_filter', "fault filter") # compact cells use the raw limit checks
+    charge_controller = unsupported_property('charge_controller', "charge controller") # compact cells charge in fixed steps
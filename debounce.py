@@ -0,0 +1,274 @@
+import math
+import numpy as np
+from faults import evaluate_faults, evaluate_faults_batch
+
+# Fault filtering between the limit checks and the state machine, so a reading sitting on a limit doesn't make the
+# BMS flap between normal_operation and fault_operating every sample:
+# - hysteresis: a tripped limit only clears once the reading is back past the limit by a band
+# - N of M debouncing: a fault bit is reported once it was set in trip of the last of samples, and cleared once
+#   it was clear in trip of the last of samples (trip > of / 2, so both can't hold)
+# - rolling min/max/mean of the last window samples of every sensor channel
+# A BMS (or fleet) with a fault_filter passes every evaluate_faults result through it, one sample per evaluation
+# Everything is kept in preallocated circular buffers, a sample costs O(1) (amortized for the rolling min/max)
+# One filter is for one BMS (n=None) or for the n instances of a fleet (vectorized over the instances)
+
+TRIP_SAMPLES = 3
+OF_SAMPLES = 5
+WINDOW = 10
+
+# Hysteresis bands, how far back inside a limit a reading has to be for its fault to clear
+VOLTAGE_BAND = 0.05 # V
+CURRENT_BAND = 5.0 # A
+TEMP_VOLTAGE_BAND = 0.01 # V of the temperature sensor (about 1 C)
+
+CHANNELS = ('voltage', 'current', 'temp_voltage')
+
+# Fault bits (faults.py): bit b is 1 << b
+FAULT_BIT_COUNT = 10
+_shifts = np.arange(FAULT_BIT_COUNT, dtype=np.uint16)[:, None]
+_weights = (np.uint16(1) << _shifts).astype(np.uint16)
+
+
+class ReleaseLimits():
+    # Limits a tripped fault has to come back past to clear: every limit of profile moved towards the normal range
+    # by its band (profile can be a CellProfile or the ProfileArrays of a mixed fleet)
+    def __init__(self, profile, voltage_band, current_band, temp_voltage_band):
+        self.undervoltage_warning = profile.undervoltage_warning + voltage_band
+        self.undervoltage_fatal = profile.undervoltage_fatal + voltage_band
+        self.overvoltage_warning = profile.overvoltage_warning - voltage_band
+        self.overvoltage_fatal = profile.overvoltage_fatal - voltage_band
+        self.overcurrent_warning = profile.overcurrent_warning - current_band
+        self.overcurrent_fatal = profile.overcurrent_fatal - current_band
+        # a higher sensor voltage is a colder cell
+        self.undertemperature_warning = profile.undertemperature_warning - temp_voltage_band
+        self.undertemperature_fatal = profile.undertemperature_fatal - temp_voltage_band
+        self.overtemperature_warning = profile.overtemperature_warning + temp_voltage_band
+        self.overtemperature_fatal = profile.overtemperature_fatal + temp_voltage_band
+
+
+class RollingWindow():
+    # Min, max and mean of the last size samples of a channel, of one BMS (n=None) or of n fleet instances
+    # Min/max are van Herk/Gil-Werman blocks: the running min/max of the block of size samples being filled and the
+    # suffix min/max of the previous block (computed once the block is full), the window being the end of the
+    # previous block and the start of the current one
+    def __init__(self, size, n=None):
+        self.size = size
+        self.n = n
+        if n is None:
+            self.values = [0.0] * size
+            self.low_suffix = [math.inf] * (size + 1)
+            self.high_suffix = [-math.inf] * (size + 1)
+            self.low_prefix = math.inf
+            self.high_prefix = -math.inf
+            self.position = 0
+            self.count = 0
+            self.total = 0.0
+        else:
+            self.values = np.zeros((size, n))
+            self.low_suffix = np.full((size + 1, n), np.inf)
+            self.high_suffix = np.full((size + 1, n), -np.inf)
+            self.low_prefix = np.full(n, np.inf)
+            self.high_prefix = np.full(n, -np.inf)
+            self.position = np.zeros(n, dtype=np.int64)
+            self.count = np.zeros(n, dtype=np.int64)
+            self.total = np.zeros(n)
+
+    def push(self, value):
+        # One sample of a BMS
+        i = self.position
+        self.total += value - self.values[i]
+        self.values[i] = value
+        if i == 0:
+            self.low_prefix = self.high_prefix = value
+        else:
+            self.low_prefix = min(self.low_prefix, value)
+            self.high_prefix = max(self.high_prefix, value)
+        if self.count < self.size:
+            self.count += 1
+        i += 1
+        if i == self.size:
+            low = self.low_suffix
+            high = self.high_suffix
+            for j in range(self.size - 1, -1, -1):
+                low[j] = min(self.values[j], low[j + 1])
+                high[j] = max(self.values[j], high[j + 1])
+            i = 0
+        self.position = i
+
+    def push_fleet(self, values, idx):
+        # One sample of the fleet instances in idx, values has one value per instance of the fleet
+        position = self.position[idx]
+        if len(idx) == self.n and (position == position[0]).all():
+            self.push_rows(values, position[0]) # every instance at the same slot, whole rows instead of gathers
+            return
+        new = values[idx]
+        flat = self.values.reshape(-1)
+        cells = position * self.n + idx # flat index of the slot of every instance
+        self.total[idx] += new - flat[cells]
+        flat[cells] = new
+        start = position == 0
+        self.low_prefix[idx] = np.where(start, new, np.minimum(self.low_prefix[idx], new))
+        self.high_prefix[idx] = np.where(start, new, np.maximum(self.high_prefix[idx], new))
+        self.count[idx] = np.minimum(self.count[idx] + 1, self.size)
+        position += 1
+        full = position == self.size
+        if full.any():
+            done = idx[full]
+            block = self.values[::-1, done]
+            self.low_suffix[:self.size, done] = np.minimum.accumulate(block, axis=0)[::-1]
+            self.high_suffix[:self.size, done] = np.maximum.accumulate(block, axis=0)[::-1]
+            position[full] = 0
+        self.position[idx] = position
+
+    def push_rows(self, values, i):
+        row = self.values[i]
+        self.total += values - row
+        row[:] = values
+        if i == 0:
+            self.low_prefix[:] = values
+            self.high_prefix[:] = values
+        else:
+            np.minimum(self.low_prefix, values, out=self.low_prefix)
+            np.maximum(self.high_prefix, values, out=self.high_prefix)
+        np.minimum(self.count + 1, self.size, out=self.count)
+        i += 1
+        if i == self.size:
+            np.minimum.accumulate(self.values[::-1], axis=0, out=self.low_suffix[self.size - 1::-1])
+            np.maximum.accumulate(self.values[::-1], axis=0, out=self.high_suffix[self.size - 1::-1])
+            i = 0
+        self.position[:] = i
+
+    @property
+    def min(self):
+        if self.n is None:
+            return min(self.low_suffix[self.position], self.low_prefix)
+        return np.minimum(self.low_suffix[self.position, np.arange(self.n)], self.low_prefix)
+
+    @property
+    def max(self):
+        if self.n is None:
+            return max(self.high_suffix[self.position], self.high_prefix)
+        return np.maximum(self.high_suffix[self.position, np.arange(self.n)], self.high_prefix)
+
+    @property
+    def mean(self):
+        # Mean of the samples so far while the window is not full yet (nan before the first one)
+        if self.n is None:
+            return self.total / self.count if self.count else math.nan
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.total / self.count
+
+
+class FaultFilter():
+    # Hysteresis, N of M debouncing and rolling windows of one BMS (n=None) or of the n instances of a fleet
+    def __init__(self, n=None, trip=TRIP_SAMPLES, of=OF_SAMPLES, window=WINDOW,
+                 voltage_band=VOLTAGE_BAND, current_band=CURRENT_BAND, temp_voltage_band=TEMP_VOLTAGE_BAND):
+        if not of >= trip > of / 2:
+            raise ValueError(f"Debouncing needs of / 2 < trip <= of, got {trip} of {of}")
+        self.n = n
+        self.trip = trip
+        self.of = of
+        self.bands = (voltage_band, current_band, temp_voltage_band)
+        self.profile = None
+        self.limits = None
+        self.windows = {name: RollingWindow(window, n) for name in CHANNELS}
+        if n is None:
+            self.samples = [0] * of
+            self.counts = [0] * FAULT_BIT_COUNT
+        else:
+            self.samples = np.zeros((of, n), dtype=np.uint16)
+            self.counts = np.zeros((FAULT_BIT_COUNT, n), dtype=np.int16)
+            self.held = np.zeros(n, dtype=np.uint16)
+            self.flags = np.zeros(n, dtype=np.uint16)
+            self.position = np.zeros(n, dtype=np.int64)
+        self.reset()
+
+    def reset(self, mask=None):
+        # Forget the faults seen so far (the BMS was powered off), of the instances in mask for a fleet
+        if self.n is None:
+            self.samples[:] = [0] * self.of
+            self.counts[:] = [0] * FAULT_BIT_COUNT
+            self.held = 0 # flags after hysteresis
+            self.flags = 0 # flags after debouncing
+            self.position = 0
+        else:
+            idx = slice(None) if mask is None else np.flatnonzero(mask)
+            self.samples[:, idx] = 0
+            self.counts[:, idx] = 0
+            self.held[idx] = 0
+            self.flags[idx] = 0
+            self.position[idx] = 0
+
+    def release_limits(self, profile):
+        if profile is not self.profile:
+            self.profile = profile
+            self.limits = ReleaseLimits(profile, *self.bands)
+        return self.limits
+
+    def filter(self, bms, flags):
+        # Filtered flags of a BMS for one sample, flags being the evaluate_faults result of its readings
+        windows = self.windows
+        windows['voltage'].push(bms.voltage)
+        windows['current'].push(bms.current)
+        windows['temp_voltage'].push(bms.temp_voltage)
+
+        held = flags
+        if self.held:
+            held |= self.held & evaluate_faults(bms.voltage, bms.current, bms.temp_voltage,
+                                                self.release_limits(bms.profile))
+        self.held = held
+
+        i = self.position
+        changed = held ^ self.samples[i]
+        self.samples[i] = held
+        self.position = i + 1 if i + 1 < self.of else 0
+        if changed:
+            out = self.flags
+            for b in range(FAULT_BIT_COUNT):
+                bit = 1 << b
+                if changed & bit:
+                    count = self.counts[b] + (1 if held & bit else -1)
+                    self.counts[b] = count
+                    if count >= self.trip:
+                        out |= bit
+                    elif self.of - count >= self.trip:
+                        out &= ~bit
+            self.flags = out
+        return self.flags
+
+    def filter_fleet(self, fleet, flags, mask=None):
+        # Filtered flags of the fleet instances in mask (all if None) for one sample, flags being the
+        # evaluate_faults result of the fleet, the other instances keep their flags as they are
+        idx = np.arange(self.n) if mask is None else np.flatnonzero(mask)
+        if len(idx) == 0:
+            return flags
+        for name, window in self.windows.items():
+            window.push_fleet(getattr(fleet, name), idx)
+
+        held = flags[idx]
+        previous = self.held[idx]
+        if previous.any():
+            release = evaluate_faults_batch(fleet.voltage, fleet.current, fleet.temp_voltage,
+                                            self.release_limits(fleet.profile))
+            held = held | (previous & release[idx])
+        self.held[idx] = held
+
+        position = self.position[idx]
+        old = self.samples[position, idx]
+        self.samples[position, idx] = held
+        position += 1
+        position[position == self.of] = 0
+        self.position[idx] = position
+        changed = np.flatnonzero(held != old)
+        if len(changed):
+            rows = idx[changed]
+            counts = self.counts[:, rows]
+            counts += ((held[changed] >> _shifts) & 1).astype(np.int16) - ((old[changed] >> _shifts) & 1).astype(np.int16)
+            self.counts[:, rows] = counts
+            on = ((counts >= self.trip) * _weights).sum(axis=0, dtype=np.uint16)
+            off = ((self.of - counts >= self.trip) * _weights).sum(axis=0, dtype=np.uint16)
+            self.flags[rows] = (self.flags[rows] | on) & ~off
+
+        result = flags.copy()
+        result[idx] = self.flags[idx]
+        return result
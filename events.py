@@ -0,0 +1,142 @@
+import numpy as np
+
+# Events reported by the BMS and the sinks that receive them
+# The BMS only passes an event code and itself to the sink, any text is built by the sink (and only if it is printed)
+
+# Levels
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+# Event codes
+ENTER_DEEP_SLEEP = 1
+ENTER_RUN_TESTS = 2
+TESTS_PASSED = 3
+TESTS_FAILED = 4
+ENTER_IDLE = 5
+PEDAL_PRESSED = 6
+BUTTON_TO_SLEEP = 7
+ENTER_NORMAL_OPERATION = 8
+MEASUREMENT = 9
+SOC_BELOW_4_PERCENT = 10
+ENTER_FAULT_OPERATING = 11
+NO_MORE_FAULTS = 12
+FATAL_FAULT = 13
+ENTER_SLEEP = 14
+BUTTON_TO_IDLE = 15
+CHARGER_IN = 16
+ENTER_DISCHARGE_TO_STORAGE = 17
+SOC_STEP = 18
+ENTER_CHARGING = 19
+
+# Fault check (warning limits)
+POTENTIAL_UNDERVOLTAGE = 20
+POTENTIAL_OVERVOLTAGE = 21
+POTENTIAL_OVERCURRENT = 22
+POTENTIAL_UNDERTEMPERATURE = 23
+POTENTIAL_OVERTEMPERATURE = 24
+
+# Fatal fault check (fatal limits)
+UNDERVOLTAGE = 25
+OVERVOLTAGE = 26
+OVERCURRENT = 27
+UNDERTEMPERATURE = 28
+OVERTEMPERATURE = 29
+
+# Charging/discharge to storage phase skipped to its end (BMS.fast_forward)
+SOC_FAST_FORWARD = 30
+
+# Charge limit exceeded, charging stopped (charging.ChargeController)
+CHARGING_FAULT = 31
+
+# Message printed for each event code, fields are filled from the BMS when printed
+MESSAGES = {
+    ENTER_DEEP_SLEEP: "Entering deep sleep: Power is off for long-term storage.",
+    ENTER_RUN_TESTS: "Running tests: Checking battery health and system readiness.",
+    TESTS_PASSED: "Configuration Tests Passed",
+    TESTS_FAILED: "Configuration Tests Failed",
+    ENTER_IDLE: "System is idle. Waiting for accelerator or button press.",
+    PEDAL_PRESSED: "Pedal pressed. Transitioning to normal operation.",
+    BUTTON_TO_SLEEP: "Button pressed. Transitioning to sleep.",
+    ENTER_NORMAL_OPERATION: "Car in normal operation: Monitoring battery performance.",
+    MEASUREMENT: "Voltage: {voltage}, Current: {current}, Temperature Voltage: {temp_voltage}, SOC: {soc}",
+    SOC_BELOW_4_PERCENT: "SOC below 4%. Transitioning to sleep.",
+    ENTER_FAULT_OPERATING: "Fault detected: Activating protection mechanisms.",
+    NO_MORE_FAULTS: "No more faults",
+    FATAL_FAULT: "Fatal Fault Detected. Shutting down",
+    ENTER_SLEEP: "System in sleep mode. OCV measurement ongoing.",
+    BUTTON_TO_IDLE: "Button pressed. Transitioning to idle.",
+    CHARGER_IN: "Charger Plugged in: Transitioning to charging state",
+    ENTER_DISCHARGE_TO_STORAGE: "Discharging battery to 50% for storage.",
+    SOC_STEP: "SOC: {soc}",
+    ENTER_CHARGING: "Charging battery.",
+    POTENTIAL_UNDERVOLTAGE: "Fault: Potential for undervoltage",
+    POTENTIAL_OVERVOLTAGE: "Fault: Potential for overvoltage",
+    POTENTIAL_OVERCURRENT: "Fault: Potential for overcurrent",
+    POTENTIAL_UNDERTEMPERATURE: "Fault: Potential for undertemperature",
+    POTENTIAL_OVERTEMPERATURE: "Fault: Potential for overtemperature",
+    UNDERVOLTAGE: "Fault: Undervoltage detected, Shutting off system",
+    OVERVOLTAGE: "Fault: Overvoltage detected, Shutting off system",
+    OVERCURRENT: "Fault: Overcurrent detected, Shutting off system",
+    UNDERTEMPERATURE: "Fault: Undertemperature detected, Shutting off system",
+    OVERTEMPERATURE: "Fault: Overtemperature detected, Shutting off system",
+    SOC_FAST_FORWARD: "SOC: {soc} (fast-forwarded)",
+    CHARGING_FAULT: "Charging fault: Charge limit exceeded, stopping charge",
+}
+
+
+class PrintSink():
+    # Prints the message of every event at or above level (default, same output as before)
+    def __init__(self, level=DEBUG):
+        self.level = level
+
+    def emit(self, level, code, bms):
+        if level < self.level:
+            return
+        print(MESSAGES[code].format(voltage=bms.voltage, current=bms.current, temp_voltage=bms.temp_voltage, soc=bms.soc))
+
+
+class NullSink():
+    # Drops every event
+    def emit(self, level, code, bms):
+        pass
+
+
+class RingBufferSink():
+    # Records (timestamp, state, event code, voltage, current, temp_voltage, soc) for every event at or above level
+    # into preallocated arrays, once full the oldest records are overwritten
+    def __init__(self, size=4096, level=DEBUG):
+        self.size = size
+        self.level = level
+        self.count = 0 # total number of events recorded (including overwritten ones)
+        self.timestamp = np.zeros(size)
+        self.state = np.zeros(size, dtype=np.int8)
+        self.code = np.zeros(size, dtype=np.int16)
+        self.voltage = np.zeros(size)
+        self.current = np.zeros(size)
+        self.temp_voltage = np.zeros(size)
+        self.soc = np.zeros(size)
+
+    def emit(self, level, code, bms):
+        if level < self.level:
+            return
+        i = self.count % self.size
+        self.timestamp[i] = bms.clock.time()
+        self.state[i] = bms.state_code
+        self.code[i] = code
+        self.voltage[i] = bms.voltage
+        self.current[i] = bms.current
+        self.temp_voltage[i] = bms.temp_voltage
+        self.soc[i] = bms.soc
+        self.count += 1
+
+    def records(self):
+        # Recorded events, oldest first, as a structured array
+        n = min(self.count, self.size)
+        order = (np.arange(n) + self.count - n) % self.size
+        records = np.empty(n, dtype=[('timestamp', 'f8'), ('state', 'i1'), ('code', 'i2'), ('voltage', 'f8'),
+                                     ('current', 'f8'), ('temp_voltage', 'f8'), ('soc', 'f8')])
+        for name in records.dtype.names:
+            records[name] = getattr(self, name)[order]
+        return records
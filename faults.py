@@ -0,0 +1,69 @@
+import numpy as np
+from profiles import LI4P25RT
+
+# Fault evaluation in one pass over voltage, current and temp_voltage against the limits of a CellProfile
+# The result is a bitmask with one bit per limit that tripped, warning limits in the low bits and fatal limits above them
+
+# Warning limits (fault_check)
+POTENTIAL_UNDERVOLTAGE = 1 << 0
+POTENTIAL_OVERVOLTAGE = 1 << 1
+POTENTIAL_OVERCURRENT = 1 << 2
+POTENTIAL_UNDERTEMPERATURE = 1 << 3
+POTENTIAL_OVERTEMPERATURE = 1 << 4
+
+# Fatal limits (fatal_fault_check)
+UNDERVOLTAGE = 1 << 5
+OVERVOLTAGE = 1 << 6
+OVERCURRENT = 1 << 7
+UNDERTEMPERATURE = 1 << 8
+OVERTEMPERATURE = 1 << 9
+
+WARNING_MASK = 0b0000011111
+FATAL_MASK = 0b1111100000
+
+# Bits in the order fault_check/fatal_fault_check report them
+WARNING_BITS = [POTENTIAL_UNDERVOLTAGE, POTENTIAL_OVERVOLTAGE, POTENTIAL_OVERCURRENT, POTENTIAL_UNDERTEMPERATURE, POTENTIAL_OVERTEMPERATURE]
+FATAL_BITS = [UNDERVOLTAGE, OVERVOLTAGE, OVERCURRENT, UNDERTEMPERATURE, OVERTEMPERATURE]
+
+
+def evaluate_faults(voltage, current, temp_voltage, profile=LI4P25RT):
+    # Every limit is compared on its own, so the result is the same bit for bit as evaluate_faults_batch
+    # whatever the order of the limits of profile
+    p = profile
+    flags = 0
+    if voltage <= p.undervoltage_warning:
+        flags |= POTENTIAL_UNDERVOLTAGE
+    if voltage <= p.undervoltage_fatal:
+        flags |= UNDERVOLTAGE
+    if voltage >= p.overvoltage_warning:
+        flags |= POTENTIAL_OVERVOLTAGE
+    if voltage >= p.overvoltage_fatal:
+        flags |= OVERVOLTAGE
+    if current >= p.overcurrent_warning:
+        flags |= POTENTIAL_OVERCURRENT
+    if current >= p.overcurrent_fatal:
+        flags |= OVERCURRENT
+    # a higher sensor voltage is a colder cell
+    if temp_voltage >= p.undertemperature_warning:
+        flags |= POTENTIAL_UNDERTEMPERATURE
+    if temp_voltage >= p.undertemperature_fatal:
+        flags |= UNDERTEMPERATURE
+    if temp_voltage <= p.overtemperature_warning:
+        flags |= POTENTIAL_OVERTEMPERATURE
+    if temp_voltage <= p.overtemperature_fatal:
+        flags |= OVERTEMPERATURE
+    return flags
+
+
+def evaluate_faults_batch(voltage, current, temp_voltage, profile=LI4P25RT):
+    # evaluate_faults over arrays, returns one uint16 bitmask per element
+    # profile is a CellProfile or a ProfileArrays with one set of limits per element
+    p = profile
+    flags = np.zeros(np.shape(voltage), dtype=np.uint16)
+    for condition, bit in [(voltage <= p.undervoltage_warning, POTENTIAL_UNDERVOLTAGE), (voltage <= p.undervoltage_fatal, UNDERVOLTAGE),
+                           (voltage >= p.overvoltage_warning, POTENTIAL_OVERVOLTAGE), (voltage >= p.overvoltage_fatal, OVERVOLTAGE),
+                           (current >= p.overcurrent_warning, POTENTIAL_OVERCURRENT), (current >= p.overcurrent_fatal, OVERCURRENT),
+                           (temp_voltage >= p.undertemperature_warning, POTENTIAL_UNDERTEMPERATURE), (temp_voltage >= p.undertemperature_fatal, UNDERTEMPERATURE),
+                           (temp_voltage <= p.overtemperature_warning, POTENTIAL_OVERTEMPERATURE), (temp_voltage <= p.overtemperature_fatal, OVERTEMPERATURE)]:
+        np.bitwise_or(flags, bit, out=flags, where=condition)
+    return flags
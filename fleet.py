@@ -0,0 +1,286 @@
+import numpy as np
+from bms import STATES, STATE_CODES, TRIGGERS, TRANSITION_TABLE, PHASE_PERIOD, PHASE_SOC_STEP
+from faults import evaluate_faults_batch, WARNING_MASK, FATAL_MASK
+from profiles import LI4P25RT, ProfileArrays
+from temperature import DEFAULT_SENSOR
+from soc import coulomb_count, ocv_to_soc, soc_to_ocv, OCV_MIN, OCV_MAX
+
+# Struct-of-arrays version of BMS: every field of N BMS instances is held in one NumPy array
+# and the state of each instance is an integer code (index into STATES)
+
+DEEP_SLEEP = STATE_CODES['deep_sleep']
+RUN_TESTS = STATE_CODES['run_tests']
+IDLE = STATE_CODES['idle']
+NORMAL_OPERATION = STATE_CODES['normal_operation']
+FAULT_OPERATING = STATE_CODES['fault_operating']
+SLEEP = STATE_CODES['sleep']
+DISCHARGE_TO_STORAGE = STATE_CODES['discharge_to_storage']
+CHARGING = STATE_CODES['charging']
+
+# For every trigger, a column of TRANSITION_TABLE mapping each source state code to its dest state code
+# States the trigger is not valid from map to themselves, so firing it there does nothing
+_table = np.array(TRANSITION_TABLE, dtype=np.int8)
+_table = np.where(_table < 0, np.arange(len(STATES), dtype=np.int8)[:, None], _table)
+TRIGGER_TABLES = {trigger: _table[:, code].copy() for code, trigger in enumerate(TRIGGERS)}
+
+
+def seeded_random_state(seed):
+    # NumPy generator that yields the same numbers as random.seed(seed) followed by random.random()
+    # (both seed MT19937 with init_by_array over the 32 bit words of the seed)
+    seed = abs(seed)
+    key = []
+    while True:
+        key.append(seed & 0xffffffff)
+        seed >>= 32
+        if seed == 0:
+            break
+    return np.random.RandomState(key)
+
+
+# Per instance arrays of a fleet: (name, dtype, initial value), same initial values as BMS
+ARRAY_FIELDS = [
+    # Measurements
+    ('voltage', np.float64, 0.0),
+    ('current', np.float64, 0.0),
+    ('soc', np.float64, 100.0),
+    ('ocv', np.float64, 3.8),
+    ('temp_voltage', np.float64, 1.86), # 25 C
+    # Inputs/booleans
+    ('pedal_press', np.bool_, False),
+    ('charger_plugged_in', np.bool_, False),
+    ('diagnostics_pass', np.bool_, True),
+    ('button_press', np.bool_, False),
+    # State code of every instance, all start in deep sleep
+    ('state', np.int8, DEEP_SLEEP),
+    # State code of every instance at the last step() (-1: not stepped yet), like BMS.step_code
+    ('step_code', np.int8, -1),
+    # Seconds since the last step of the charging/discharge_to_storage phase of every instance
+    ('phase_time', np.float64, 0.0),
+]
+
+
+def initialize_arrays(arrays):
+    # Set every array of a fleet (name -> array) to its initial value
+    for name, dtype, initial in ARRAY_FIELDS:
+        arrays[name][:] = initial
+
+
+class BMSFleet():
+    def __init__(self, n, seed=None, profiles=None, profile_index=None, arrays=None, noise=None):
+        # arrays can map every name in ARRAY_FIELDS to an existing array of n elements (e.g. in shared memory)
+        # which the fleet then works on in place, otherwise new initialized arrays are allocated
+        self.n = n
+
+        # Cell limits, one shared CellProfile (Li4P25RT by default) or a mixed fleet
+        # where cell i uses profiles[profile_index[i]]
+        if profiles is None:
+            self.profile = LI4P25RT
+        elif profile_index is None:
+            self.profile = profiles[0]
+        else:
+            self.profile = ProfileArrays(profiles, profile_index)
+
+        if arrays is None:
+            arrays = {name: np.empty(n, dtype=dtype) for name, dtype, initial in ARRAY_FIELDS}
+            initialize_arrays(arrays)
+        for name, dtype, initial in ARRAY_FIELDS:
+            setattr(self, name, arrays[name])
+
+        # Length of one tick in seconds, used for coulomb counting
+        self.sample_period = 0.1
+
+        # False when voltage, current and temp_voltage are set from real readings (e.g. a replayed trace)
+        # instead of simulate_battery, like BMS.simulated
+        self.simulated = True
+        # Cell model of n cells (e.g. cellmodel.TheveninModel(n)) used by simulate_battery, the random walk if None
+        self.cell_model = None
+        # FaultFilter of n instances (debounce.FaultFilter(n)) applied to the fault evaluations, the raw checks if None
+        self.fault_filter = None
+        # ChargeController of n instances (charging.ChargeController(n)) running CC/CV charging, fixed steps if None
+        self.charge_controller = None
+
+        # With a NoiseStream, the fleet draws exactly what N BMS sharing that stream would draw stepped in index order
+        # Otherwise with a seed, what they would draw from the global random module after random.seed(seed)
+        self.noise = noise
+        self.rng = seeded_random_state(seed) if seed is not None else np.random.RandomState()
+
+    def states(self):
+        # State names of every instance (like BMS.state)
+        return np.array(STATES)[self.state]
+
+    def temperature(self, sensor=DEFAULT_SENSOR):
+        # Temperature in C of every instance (like BMS.temperature)
+        return sensor.to_celsius_array(self.temp_voltage)
+
+    def fire(self, trigger, mask=None):
+        # Apply a trigger to every instance in mask (all instances if None)
+        # Instances whose state has no transition for the trigger are left as they are
+        table = TRIGGER_TABLES[trigger]
+        if mask is None:
+            self.state[:] = table[self.state]
+        else:
+            self.state[mask] = table[self.state[mask]]
+
+    def step(self):
+        # One control period for every instance, each one runs the work of the state it is in at the start of the tick
+        # (the body of the matching BMS.enter_* handler, or one pass of its loop for the looping states)
+        # Masks are taken before any handler runs, since the handlers change self.state
+        # The work of begin_* only runs for the instances that entered their state since the last step (entered)
+        # The phases (charging, discharge_to_storage) take a step every PHASE_PERIOD (the charge controller's period)
+        # like BMS stepped by the runtime, not every tick
+        masks = [self.state == code for code in range(len(STATES))]
+        entered = self.state != self.step_code
+        self.step_code[:] = self.state
+        self.step_deep_sleep(masks[DEEP_SLEEP], masks[DEEP_SLEEP] & entered)
+        self.step_run_tests(masks[RUN_TESTS])
+        self.step_idle(masks[IDLE])
+        self.step_operating(masks[NORMAL_OPERATION], masks[FAULT_OPERATING])
+        self.step_sleep(masks[SLEEP], masks[SLEEP] & entered)
+        self.step_discharge_to_storage(self.phase_due(masks[DISCHARGE_TO_STORAGE], entered, PHASE_PERIOD))
+        period = self.charge_controller.period if self.charge_controller is not None else PHASE_PERIOD
+        self.step_charging(self.phase_due(masks[CHARGING], entered, period))
+
+    def phase_due(self, mask, entered, period):
+        # Instances in mask whose phase takes a step this tick: on entering it, then every period seconds
+        # (at most one step per tick, a sample_period longer than period slows the phase down)
+        self.phase_time[mask] += self.sample_period
+        due = mask & (entered | (self.phase_time >= period - 1e-9))
+        self.phase_time[due] = 0
+        return due
+
+    def step_deep_sleep(self, mask, entered):
+        # Power switch off
+        if self.fault_filter is not None:
+            self.fault_filter.reset(entered)
+        self.voltage[mask] = 0
+        self.current[mask] = 0
+        self.pedal_press[mask] = False
+        self.button_press[mask] = False
+
+    def step_run_tests(self, mask):
+        self.voltage[mask] = 3.6 # set to typical values
+        self.current[mask] = 0
+        self.temp_voltage[mask] = 1.86
+        passed = mask & ~self.fault_check(self.evaluate_faults(mask)) & self.diagnostics_pass
+        self.fire('tests_passed', passed)
+        self.fire('tests_failed', mask & ~passed)
+
+    def step_idle(self, mask):
+        self.fire('pedal_pressed', mask & self.pedal_press)
+        self.fire('button_pressed', mask & self.button_press)
+
+    def step_operating(self, normal, fault):
+        # Normal operation and one pass of the fault operating loop share a single battery simulation
+        # so random numbers are drawn in instance order, as they are for a list of BMS objects
+        active = normal | fault
+        proportion = np.where(fault, 0.75, 1.0)
+        self.simulate_battery(proportion, active)
+        self.simulate_soc(active)
+
+        flags = self.evaluate_faults(active)
+        faults = self.fault_check(flags)
+
+        # Normal operation
+        self.fire('fault_detected', normal & faults)
+        self.fire('soc_below_4_percent', normal & ~faults & (self.soc <= 4))
+        self.fire('button_pressed', normal & self.button_press)
+
+        # Fault operating
+        self.fire('no_faults', fault & ~faults)
+        self.fire('fatal_fault_detected', fault & self.fatal_fault_check(flags))
+        self.fire('button_pressed', fault & self.button_press)
+
+    def step_sleep(self, mask, entered):
+        # begin_sleep for the instances that entered sleep, then the inputs of all of them
+        self.current[entered] = 0
+        self.button_press[entered] = False
+        self.pedal_press[entered] = False
+        self.simulate_ocv(entered)
+        self.check_sleep_inputs(mask)
+
+    def check_sleep_inputs(self, mask):
+        # Batched BMS.check_sleep_inputs: at most one transition per instance, the button first
+        button = mask & self.button_press
+        self.fire('button_pressed', button)
+        self.fire('charger_in', mask & ~button & self.charger_plugged_in)
+
+    def step_discharge_to_storage(self, mask):
+        # One 0.5% step of the discharge loop
+        discharging = mask & (self.soc > 50)
+        self.soc[discharging] -= PHASE_SOC_STEP
+        if self.simulated:
+            self.voltage[mask] = soc_to_ocv(self.soc[mask]) # no load, the voltage follows the OCV curve
+        self.fire('soc_50', mask & (self.soc <= 50))
+
+    def step_charging(self, mask):
+        # One 0.5% step of the charging loop, or one CC/CV tick of the charge controller
+        if self.charge_controller is not None:
+            self.charge_controller.step_fleet(self, mask)
+            return
+        charging = mask & (self.soc < 100)
+        self.soc[charging] += PHASE_SOC_STEP
+        if self.simulated:
+            self.voltage[mask] = soc_to_ocv(np.minimum(self.soc[mask], 100)) # the voltage follows the OCV curve
+        full = mask & (self.soc >= 100)
+        self.soc[full] = 100
+        self.charger_plugged_in[full] = False # Stimulate unplugging
+        self.fire('fully_charged', full)
+
+    def evaluate_faults(self, mask=None):
+        # Fault bitmask of every instance (see faults.py)
+        # With a fault_filter, the bitmask after hysteresis and debouncing, one filter sample for the instances in mask
+        flags = evaluate_faults_batch(self.voltage, self.current, self.temp_voltage, self.profile)
+        if self.fault_filter is not None:
+            flags = self.fault_filter.filter_fleet(self, flags, mask)
+        return flags
+
+    def fault_check(self, flags=None):
+        # Batched BMS.fault_check, true where there is a fault
+        if flags is None:
+            flags = self.evaluate_faults()
+        return (flags & WARNING_MASK) != 0
+
+    def fatal_fault_check(self, flags=None):
+        # Batched BMS.fatal_fault_check, true where there is a fatal fault
+        if flags is None:
+            flags = self.evaluate_faults()
+        return (flags & FATAL_MASK) != 0
+
+    def simulate_soc(self, mask):
+        # Coulomb counting over one sample period (batched BMS.simulate_soc)
+        capacity = self.profile.capacity
+        if np.ndim(capacity):
+            capacity = capacity[mask]
+        self.soc[mask] = coulomb_count(self.soc[mask], self.current[mask], self.sample_period, capacity)
+
+    def simulate_ocv(self, mask):
+        # OCV measurement and SOC correction for resting instances with a valid voltage (batched BMS.simulate_ocv)
+        valid = mask & (self.voltage >= OCV_MIN) & (self.voltage <= OCV_MAX)
+        self.ocv[valid] = self.voltage[valid]
+        self.soc[valid] = ocv_to_soc(self.ocv[valid])
+
+    def simulate_battery(self, proportion, mask):
+        # Batched BMS.simulate_battery for the instances in mask, proportion is a scalar or one value per instance
+        # Each instance uses three uniform numbers (current, voltage, temperature) like random.uniform(a, b) = a + (b - a) * random()
+        if not self.simulated:
+            return # readings come from real sensors
+        if self.cell_model is not None:
+            self.cell_model.step_fleet(self, proportion, mask)
+            return
+        idx = np.flatnonzero(mask)
+        u = self.noise.rows(len(idx)) if self.noise is not None else self.rng.random_sample((len(idx), 3))
+        pedal = self.pedal_press[idx]
+        proportion = np.broadcast_to(proportion, mask.shape)[idx]
+
+        current = np.where(pedal, 0.5 + 4.5 * u[:, 0], 0.5 + 1.5 * u[:, 0])
+        voltage = 0.01 + (0.05 - 0.01) * u[:, 1]
+        temp = 0.01 + (0.02 - 0.01) * u[:, 2]
+
+        # Limited by proportion when the pedal is pressed, decreasing otherwise
+        self.current[idx] += np.where(pedal, current * proportion, -current)
+        self.voltage[idx] += np.where(pedal, voltage * proportion, -voltage)
+        self.temp_voltage[idx] += np.where(pedal, -(temp * proportion), temp)
+
+        np.maximum(self.current, 0, out=self.current)
+        np.maximum(self.voltage, 0, out=self.voltage)
+        np.maximum(self.temp_voltage, 0, out=self.temp_voltage)
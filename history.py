@@ -0,0 +1,107 @@
+from array import array
+import numpy as np
+from bms import STATES, TRIGGERS, TRANSITIONS, STATE_CODES, TRIGGER_CODES
+
+# Transition history of a BMS: the last size transitions in a ring buffer, the time spent in every state
+# and a counter per transition, all kept in preallocated arrays so recording a transition is O(1) and allocates nothing
+# A BMS only records while it has a history attached (bms.history is None by default, which costs one check per transition)
+
+# Index of every (source state, trigger) pair in TRANSITIONS, for the per transition counters
+TRANSITION_INDEX = {(STATE_CODES[source], TRIGGER_CODES[trigger]): index
+                    for index, (trigger, source, dest) in enumerate(TRANSITIONS)}
+_counter_index = array('b', [-1]) * (len(STATES) * len(TRIGGERS))
+for (source, trigger), index in TRANSITION_INDEX.items():
+    _counter_index[source * len(TRIGGERS) + trigger] = index
+
+HISTORY_DTYPE = np.dtype([
+    ('timestamp', np.float64),
+    ('source', np.int8),
+    ('dest', np.int8),
+    ('trigger', np.int8),
+])
+
+
+class TransitionHistory():
+    # start: time at which the BMS was in state (code), the residency of that state counts from there
+    def __init__(self, size=1024, start=0.0, state=0):
+        self.size = size
+        self.timestamps = array('d', [0.0]) * size
+        self.sources = array('b', [0]) * size
+        self.dests = array('b', [0]) * size
+        self.triggers = array('b', [0]) * size
+        self.count = 0 # transitions recorded since the start, the buffer keeps the last size
+
+        self.residency_times = array('d', [0.0]) * len(STATES)
+        self.counters = array('Q', [0]) * len(TRANSITIONS)
+        self.state = state
+        self.entered = start
+
+    def record(self, timestamp, source, dest, trigger):
+        i = self.count % self.size
+        self.timestamps[i] = timestamp
+        self.sources[i] = source
+        self.dests[i] = dest
+        self.triggers[i] = trigger
+        self.count += 1
+
+        self.residency_times[source] += timestamp - self.entered
+        self.entered = timestamp
+        self.state = dest
+        self.counters[_counter_index[source * len(TRIGGERS) + trigger]] += 1
+
+    def records(self):
+        # The transitions kept in the ring buffer, oldest first
+        kept = min(self.count, self.size)
+        records = np.empty(kept, dtype=HISTORY_DTYPE)
+        first = self.count - kept
+        order = np.arange(first, self.count) % self.size
+        records['timestamp'] = np.frombuffer(self.timestamps, dtype=np.float64)[order]
+        records['source'] = np.frombuffer(self.sources, dtype=np.int8)[order]
+        records['dest'] = np.frombuffer(self.dests, dtype=np.int8)[order]
+        records['trigger'] = np.frombuffer(self.triggers, dtype=np.int8)[order]
+        return records
+
+    def residency(self, now):
+        # Seconds spent in each state up to now (including the time in the current state)
+        times = {name: self.residency_times[code] for code, name in enumerate(STATES)}
+        times[STATES[self.state]] += now - self.entered
+        return times
+
+    def transition_counts(self):
+        # Number of times each transition fired, keyed by (trigger, source, dest)
+        return {transition: self.counters[index] for index, transition in enumerate(TRANSITIONS)}
+
+    def prometheus(self, now, labels=None):
+        # Prometheus text exposition of the residency times, transition counters and the current state
+        # labels (e.g. {'bms': '7'}) are added to every sample
+        extra = ''.join(f',{name}="{value}"' for name, value in (labels or {}).items())
+        lines = [
+            "# HELP bms_state_residency_seconds Time spent in each state.",
+            "# TYPE bms_state_residency_seconds counter",
+        ]
+        for name, seconds in self.residency(now).items():
+            lines.append(f'bms_state_residency_seconds{{state="{name}"{extra}}} {seconds}')
+        lines += [
+            "# HELP bms_transitions_total Transitions taken.",
+            "# TYPE bms_transitions_total counter",
+        ]
+        for (trigger, source, dest), count in self.transition_counts().items():
+            lines.append(f'bms_transitions_total{{trigger="{trigger}",source="{source}",dest="{dest}"{extra}}} {count}')
+        lines += [
+            "# HELP bms_state Current state (1 for the state the BMS is in).",
+            "# TYPE bms_state gauge",
+        ]
+        for code, name in enumerate(STATES):
+            lines.append(f'bms_state{{state="{name}"{extra}}} {int(code == self.state)}')
+        return '\n'.join(lines) + '\n'
+
+
+def attach_history(bms, size=1024):
+    # Start recording the transitions of bms, returns its TransitionHistory
+    bms.history = TransitionHistory(size, bms.clock.time(), bms.state_code)
+    return bms.history
+
+
+def detach_history(bms):
+    # Stop recording, the BMS is back to no instrumentation at all
+    bms.history = None
@@ -0,0 +1,46 @@
+import numpy as np
+
+# Dense lookup tables for precomputed curves (temperature sensor, OCV-SOC)
+
+
+def extrapolate(points, low, high):
+    # Piecewise linear curve through points, extended linearly from the end segments to cover [low, high]
+    (x0, y0), (x1, y1) = points[0], points[1]
+    (xa, ya), (xb, yb) = points[-2], points[-1]
+    start = (low, y0 + (low - x0) * (y1 - y0) / (x1 - x0))
+    end = (high, yb + (high - xb) * (yb - ya) / (xb - xa))
+    return [start] + list(points) + [end]
+
+
+class LookupTable():
+    # Values of a piecewise linear function sampled every step from start, interpolated on lookup
+    def __init__(self, points, start, stop, step):
+        points = extrapolate(sorted(points), start, stop)
+        self.start = start
+        self.step = step
+        self.inv_step = 1 / step
+        self.array = np.interp(np.arange(start, stop + step / 2, step), [x for x, y in points], [y for x, y in points])
+        self.values = self.array.tolist() # plain floats for scalar lookups
+        self.last = len(self.values) - 1
+
+    def lookup(self, x):
+        i = (x - self.start) * self.inv_step
+        if i <= 0:
+            return self.values[0]
+        if i >= self.last:
+            return self.values[self.last]
+        j = int(i)
+        low = self.values[j]
+        return low + (self.values[j + 1] - low) * (i - j)
+
+    def lookup_array(self, x):
+        i = np.clip((np.asarray(x, dtype=float) - self.start) * self.inv_step, 0, self.last)
+        j = np.minimum(i.astype(np.intp), self.last - 1)
+        low = self.array[j]
+        return low + (self.array[j + 1] - low) * (i - j)
+
+    def __call__(self, x):
+        # lookup for a single value, lookup_array for arrays
+        if isinstance(x, np.ndarray):
+            return self.lookup_array(x)
+        return self.lookup(x)
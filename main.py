@@ -1,16 +1,50 @@
+import sys
 from bms import BMS
-from tests import run_test1, run_test2, run_test3, run_test4, run_test5
-import time
+from tests import run_test1, run_test2, run_test3, run_test4, run_test5, run_test6, run_test7, run_test8, run_test9, run_test10, run_test11, run_test12, run_test13, run_test14, run_test15, run_test16, run_test17, run_test18, run_test19, run_test20, run_test21, run_test22, run_test23, run_test24, run_test25, run_test26, run_test27, run_test28, run_test29
+from clock import VirtualClock
+import tests
 
 def main():
-    run_test1()
-    run_test2()
-    run_test3()
-    run_test4()
-    run_test5()
+    # Pass --virtual to run every scenario on simulated time (no real waiting)
+    clock = VirtualClock() if '--virtual' in sys.argv else None
 
+    run_test1(clock)
+    run_test2(clock)
+    run_test3(clock)
+    run_test4(clock)
+    run_test5(clock)
+    run_test6(clock)
+    run_test7(clock)
+    run_test8(clock)
+    run_test9(clock)
+    run_test10(clock)
+    run_test11(clock)
+    run_test12(clock)
+    run_test13(clock)
+    run_test14(clock)
+    run_test15(clock)
+    run_test16(clock)
+    run_test17(clock)
+    run_test18(clock)
+    run_test19(clock)
+    run_test20(clock)
+    run_test21(clock)
+    run_test22(clock)
+    run_test23(clock)
+    run_test24(clock)
+    run_test25(clock)
+    run_test26(clock)
+    run_test27(clock)
+    run_test28(clock)
+    run_test29(clock)
+
+    if tests.failures:
+        print(f"{len(tests.failures)} check(s) failed:")
+        for message in tests.failures:
+            print(f"  {message}")
+        return 1
     print("All tests passed!")
-    return 
+    return 0
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,51 @@
+import numpy as np
+
+# Seeded noise for simulate_battery: uniform numbers in [0, 1) drawn block rows at a time from a NumPy Generator
+# and handed out three per simulated reading (current, voltage, temperature)
+# A stream only depends on its seed, so a run can be replayed exactly by giving the same seed again
+# One stream can be owned by a BMS, shared by a group of BMS stepped in order, or used by a BMSFleet;
+# a fleet using NoiseStream(seed) draws the same numbers as a list of BMS sharing NoiseStream(seed)
+
+NOISE_COLUMNS = 3
+
+
+class NoiseStream():
+    # seed: an int or a sequence of ints (e.g. [run_seed, shard]), a random seed is picked if None
+    # and kept in self.seed so the run can be replayed
+    def __init__(self, seed=None, block=64):
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        self.seed = seed
+        self.block = block
+        self.generator = np.random.Generator(np.random.PCG64(seed))
+        self.buffer = np.empty((0, NOISE_COLUMNS))
+        self.position = 0
+
+    def refill(self, rows):
+        # New block with at least rows rows, keeping the rows not used yet
+        count = max(self.block, rows)
+        fresh = self.generator.random((count, NOISE_COLUMNS))
+        rest = self.buffer[self.position:]
+        self.buffer = np.concatenate((rest, fresh)) if len(rest) else fresh
+        self.position = 0
+
+    def row(self):
+        # Three numbers as Python floats, for one BMS
+        if self.position == len(self.buffer):
+            self.refill(1)
+        row = self.buffer[self.position].tolist()
+        self.position += 1
+        return row
+
+    def rows(self, count):
+        # (count, 3) array, for count instances of a fleet in index order
+        if self.position + count > len(self.buffer):
+            self.refill(count)
+        rows = self.buffer[self.position:self.position + count]
+        self.position += count
+        return rows
+
+    def spawn(self, count):
+        # count independent streams, stream i is seeded with [seed..., i] so it can be replayed on its own
+        seed = list(self.seed) if isinstance(self.seed, (list, tuple)) else [self.seed]
+        return [NoiseStream(seed + [i], self.block) for i in range(count)]
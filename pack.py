@@ -0,0 +1,261 @@
+import numpy as np
+from bms import BMS, MachineError, PHASE_SOC_STEP, unsupported_property
+import events
+from events import DEBUG
+from fleet import BMSFleet
+from soc import coulomb_count, soc_to_ocv, OCV_MIN, OCV_MAX
+
+# Pack of n cell groups in series (each one like the 1s4p group of a BMS) run by one state machine
+# The cells are the arrays of a BMSFleet (readings, SOC, simulation), the pack is a BMS whose readings are
+# reductions over the cells and whose fault checks are the per cell fault checks of every cell combined:
+# the pack is in fault as soon as one cell is, and a fatal fault of any cell shuts the pack down
+#
+# Pack readings: voltage = sum of the cell voltages, current = mean cell current, temp_voltage = hottest cell,
+# soc = weakest cell (what can still be drawn), min/max/mean of each are kept by a Reduction per array
+
+# Passive balancing in sleep and charging: cells more than BALANCE_THRESHOLD % SOC above the weakest one are bled
+# through their balancing resistor at BLEED_CURRENT until they are within half of it
+# (the cells being bled are selected again on entering sleep or charging, and once they are all balanced)
+#
+# A fault_filter of a pack is a FaultFilter(n) of its n cells (debouncing every cell); a pack charges in fixed
+# steps, simulates its cells with the random walk and estimates their SOC by coulomb counting, so setting a
+# charge_controller, cell_model or soc_filter raises AttributeError
+BALANCE_THRESHOLD = 1.0
+BLEED_CURRENT = 0.2 # A
+BALANCE_STATES = ('sleep', 'charging')
+
+# Above this share of changed cells an update rebuilds the whole reduction instead
+REBUILD_SHARE = 0.125
+
+# Cell arrays with a Reduction
+READINGS = ('voltage', 'current', 'temp_voltage', 'soc')
+
+
+class Reduction():
+    # Min, max and sum of an array kept up to date as it changes, one segment tree for the minimum and one for the
+    # maximum (node i covers its children 2i and 2i+1, the values are the leaves from self.size on)
+    # update(idx) after changing values[idx] costs O(len(idx) log n), refresh() after changing most of them O(n)
+    def __init__(self, values):
+        self.values = values
+        self.n = len(values)
+        self.size = 2
+        while self.size < self.n:
+            self.size *= 2
+        self.low = np.full(2 * self.size, np.inf)
+        self.high = np.full(2 * self.size, -np.inf)
+        self.refresh()
+
+    def refresh(self):
+        size = self.size
+        self.low[size:size + self.n] = self.values
+        self.high[size:size + self.n] = self.values
+        while size > 1:
+            half = size // 2
+            np.minimum(self.low[size:2 * size:2], self.low[size + 1:2 * size:2], out=self.low[half:size])
+            np.maximum(self.high[size:2 * size:2], self.high[size + 1:2 * size:2], out=self.high[half:size])
+            size = half
+        self.total = float(self.values.sum())
+
+    def update(self, idx):
+        idx = np.unique(idx) # a cell listed twice changes the total once
+        if len(idx) > self.n * REBUILD_SHARE:
+            self.refresh()
+            return
+        if len(idx) == 0:
+            return
+        leaves = idx + self.size
+        new = self.values[idx]
+        self.total += float((new - self.low[leaves]).sum())
+        self.low[leaves] = new
+        self.high[leaves] = new
+        nodes = np.unique(leaves // 2)
+        while True:
+            self.low[nodes] = np.minimum(self.low[2 * nodes], self.low[2 * nodes + 1])
+            self.high[nodes] = np.maximum(self.high[2 * nodes], self.high[2 * nodes + 1])
+            if nodes[0] == 1:
+                break
+            nodes = np.unique(nodes // 2)
+
+    @property
+    def min(self):
+        return self.low[1]
+
+    @property
+    def max(self):
+        return self.high[1]
+
+    @property
+    def mean(self):
+        return self.total / self.n
+
+    def argmin(self):
+        # Index of a smallest value, following the minimum down the tree
+        node = 1
+        while node < self.size:
+            node = 2 * node if self.low[2 * node] == self.low[node] else 2 * node + 1
+        return node - self.size
+
+    def argmax(self):
+        node = 1
+        while node < self.size:
+            node = 2 * node if self.high[2 * node] == self.high[node] else 2 * node + 1
+        return node - self.size
+
+
+class Pack(BMS):
+    __slots__ = ('cells', 'every', 'reductions', 'cell_flags', 'bleeding')
+
+    def __init__(self, n, clock=None, events=None, profile=None, seed=None, noise=None, soc=None):
+        super().__init__(clock, events, profile)
+        self.cells = BMSFleet(n, seed=seed, profiles=[self.profile], noise=noise)
+        self.cells.sample_period = self.sample_period
+        if soc is not None:
+            self.cells.soc[:] = soc
+        self.every = np.ones(n, dtype=bool)
+        self.reductions = {name: Reduction(getattr(self.cells, name)) for name in READINGS}
+        self.cell_flags = np.zeros(n, dtype=np.uint16) # fault bits of every cell at the last evaluation
+        self.bleeding = None # cells being balanced (None: to be selected)
+        self.aggregate()
+
+    # Plug-ins of a single cell BMS the pack has no per cell version of: always None, setting one raises
+    charge_controller = unsupported_property('charge_controller', "charge controller")
+    cell_model = unsupported_property('cell_model', "cell model")
+    soc_filter = unsupported_property('soc_filter', "SOC filter")
+
+    def cells_changed(self, idx=None, names=READINGS):
+        # Update the reductions of the arrays in names after the cells in idx (all of them if None) changed,
+        # then the pack readings
+        for name in names:
+            if idx is None:
+                self.reductions[name].refresh()
+            else:
+                self.reductions[name].update(idx)
+        self.aggregate()
+
+    def aggregate(self):
+        reductions = self.reductions
+        self.voltage = reductions['voltage'].total
+        self.current = reductions['current'].mean
+        self.temp_voltage = reductions['temp_voltage'].min # hottest cell
+        self.soc = reductions['soc'].min # weakest cell
+
+    def weakest_cell(self):
+        return self.reductions['soc'].argmin()
+
+    def hottest_cell(self):
+        return self.reductions['temp_voltage'].argmin()
+
+    def faulty_cells(self, mask):
+        # Cells with any of the fault bits in mask at the last evaluation (e.g. faults.WARNING_MASK)
+        return np.flatnonzero(self.cell_flags & mask)
+
+    def evaluate_faults(self):
+        # Per cell limits, the pack flags are every bit tripped by at least one cell
+        # With a fault_filter, every cell is debounced on its own before they are combined
+        cells = self.cells
+        if self.fault_filter is not cells.fault_filter:
+            if self.fault_filter is not None and self.fault_filter.n != cells.n:
+                raise ValueError(f"The fault_filter of a pack of {cells.n} cells must be a FaultFilter({cells.n})")
+            cells.fault_filter = self.fault_filter
+        self.cell_flags = cells.evaluate_faults()
+        self.fault_flags = int(np.bitwise_or.reduce(self.cell_flags))
+        return self.fault_flags
+
+    def simulate_battery(self, proportion):
+        if not self.simulated:
+            return # cell readings come from real sensors
+        self.cells.sample_period = self.sample_period
+        self.cells.simulate_battery(proportion, self.every)
+        self.cells_changed(None, ('voltage', 'current', 'temp_voltage'))
+
+    def simulate_soc(self):
+        # Only the cells drawing a current change
+        self.cells.simulate_soc(self.every)
+        self.cells_changed(np.flatnonzero(self.cells.current), ('soc',))
+
+    def simulate_ocv(self):
+        # Only the cells with a valid OCV get a new SOC
+        cells = self.cells
+        cells.simulate_ocv(self.every)
+        self.cells_changed(np.flatnonzero((cells.voltage >= OCV_MIN) & (cells.voltage <= OCV_MAX)), ('soc',))
+
+    def set_cells(self, idx, **readings):
+        # Set readings (voltage=..., soc=... etc.) of the cells in idx, e.g. from cell sensors
+        idx = np.atleast_1d(idx)
+        for name, values in readings.items():
+            getattr(self.cells, name)[idx] = values
+        self.cells_changed(idx)
+
+    def step(self):
+        super().step()
+        if self.state in BALANCE_STATES:
+            self.balance()
+
+    def balance(self):
+        # One sample period of passive balancing, only the cells being bled change
+        soc = self.cells.soc
+        low = self.reductions['soc'].min
+        if self.bleeding is None:
+            if self.reductions['soc'].max - low <= BALANCE_THRESHOLD:
+                return
+            self.bleeding = np.flatnonzero(soc > low + BALANCE_THRESHOLD / 2)
+        if len(self.bleeding) == 0:
+            return
+        capacity = self.cells.profile.capacity
+        if np.ndim(capacity):
+            capacity = capacity[self.bleeding]
+        soc[self.bleeding] = coulomb_count(soc[self.bleeding], BLEED_CURRENT, self.sample_period, capacity)
+        self.cells_changed(self.bleeding, ('soc',))
+        self.bleeding = self.bleeding[soc[self.bleeding] > low + BALANCE_THRESHOLD / 2]
+        if len(self.bleeding) == 0:
+            self.bleeding = None # balanced, look again once the cells drift apart
+
+    def begin_run_tests(self):
+        cells = self.cells
+        cells.voltage[:] = 3.6 # set to typical values
+        cells.current[:] = 0
+        cells.temp_voltage[:] = 1.86
+        self.cells_changed()
+        super().begin_run_tests()
+        self.aggregate() # pack readings of the cells instead of the single cell typical values
+
+    def begin_sleep(self):
+        self.cells.current[:] = 0
+        self.cells_changed(None, ('current',))
+        self.bleeding = None
+        super().begin_sleep()
+
+    def begin_charging(self):
+        self.bleeding = None
+        super().begin_charging()
+
+    def step_discharge_to_storage(self):
+        # Every cell above 50% steps down, the pack is stored once all of them are at 50% or below
+        soc = self.cells.soc
+        discharging = np.flatnonzero(soc > 50)
+        soc[discharging] -= PHASE_SOC_STEP
+        if self.simulated:
+            self.cells.voltage[:] = soc_to_ocv(soc)
+            self.cells_changed(None, ('voltage',))
+        self.cells_changed(discharging, ('soc',))
+        self.events.emit(DEBUG, events.SOC_STEP, self)
+        if self.reductions['soc'].max <= 50:
+            self.soc_50()
+
+    def step_charging(self):
+        # Every cell below 100% steps up, charging stops as soon as one cell is full (balancing evens out the rest)
+        soc = self.cells.soc
+        charging = np.flatnonzero(soc < 100)
+        soc[charging] = np.minimum(soc[charging] + PHASE_SOC_STEP, 100)
+        if self.simulated:
+            self.cells.voltage[:] = soc_to_ocv(soc)
+            self.cells_changed(None, ('voltage',))
+        self.cells_changed(charging, ('soc',))
+        self.events.emit(DEBUG, events.SOC_STEP, self)
+        if self.reductions['soc'].max >= 100:
+            self.charger_plugged_in = False # Stimulate unplugging
+            self.fully_charged()
+
+    def fast_forward(self, resolution=None):
+        # The cells of a pack end their phases at different steps, so a pack is stepped through them
+        raise MachineError("A Pack can't fast-forward, step it through charging/discharge_to_storage")
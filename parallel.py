@@ -0,0 +1,174 @@
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+from fleet import ARRAY_FIELDS, BMSFleet, TRIGGER_TABLES, initialize_arrays
+from noise import NoiseStream
+
+# Multiprocess pack simulator: the cells of a pack are split into shards, each shard is a BMSFleet
+# working in place on its slice of arrays in shared memory, and the shards are spread over worker processes
+# Every tick all processes meet at a barrier, so nothing is pickled or copied between ticks
+#
+# Each shard draws its random numbers from its own NoiseStream, so a pack gives the same results
+# for any number of workers (including workers=0, where the shards are stepped in this process)
+
+# Per shard results written by the workers after every tick, reduced over the shards by the pack
+SHARD_FIELDS = [
+    ('min_voltage', np.float64),
+    ('max_voltage', np.float64),
+    ('hottest', np.int64), # cell with the lowest temp_voltage
+    ('hottest_temp_voltage', np.float64),
+    ('fatal', np.bool_),
+]
+
+
+def layout(fields, n):
+    # Byte offsets of one array of n elements per field, each aligned to 8 bytes
+    offsets = {}
+    size = 0
+    for name, dtype in fields:
+        offsets[name] = size
+        size += -(-n * np.dtype(dtype).itemsize // 8) * 8
+    return offsets, max(size, 8)
+
+
+def map_arrays(buffer, fields, n):
+    offsets, size = layout(fields, n)
+    return {name: np.ndarray(n, dtype=dtype, buffer=buffer, offset=offsets[name]) for name, dtype in fields}
+
+
+def cell_fields():
+    return [(name, dtype) for name, dtype, initial in ARRAY_FIELDS]
+
+
+class Shards():
+    # The shards stepped by one process, as fleets over the shared arrays
+    def __init__(self, cells, partials, bounds, shards, seed, sample_period):
+        self.partials = partials
+        self.shards = []
+        for shard in shards:
+            start, stop = bounds[shard], bounds[shard + 1]
+            # The noise of a shard only depends on [seed, shard], not on how the shards are spread over workers
+            fleet = BMSFleet(stop - start, noise=NoiseStream([seed, shard], block=stop - start),
+                             arrays={name: array[start:stop] for name, array in cells.items()})
+            fleet.sample_period = sample_period
+            self.shards.append((shard, start, fleet))
+
+    def step(self):
+        partials = self.partials
+        for shard, start, fleet in self.shards:
+            fleet.step()
+            if fleet.n == 0:
+                continue
+            hottest = int(np.argmin(fleet.temp_voltage))
+            partials['min_voltage'][shard] = fleet.voltage.min()
+            partials['max_voltage'][shard] = fleet.voltage.max()
+            partials['hottest'][shard] = start + hottest
+            partials['hottest_temp_voltage'][shard] = fleet.temp_voltage[hottest]
+            partials['fatal'][shard] = fleet.fatal_fault_check().any()
+
+
+def worker(name, n, shard_count, bounds, shards, seed, sample_period, barrier, stop):
+    memory = shared_memory.SharedMemory(name=name)
+    cells, partials = map_memory(memory.buf, n, shard_count)
+    work = Shards(cells, partials, bounds, shards, seed, sample_period)
+    while True:
+        barrier.wait() # start of a tick
+        if stop.value:
+            break
+        work.step()
+        barrier.wait() # end of the tick
+    # The arrays have to go before the memory can be closed
+    del cells, partials, work
+    memory.close()
+
+
+def map_memory(buffer, n, shard_count):
+    # Cell arrays followed by the per shard results
+    cell_offsets, cell_size = layout(cell_fields(), n)
+    cells = map_arrays(buffer, cell_fields(), n)
+    partials = map_arrays(buffer[cell_size:], SHARD_FIELDS, shard_count)
+    return cells, partials
+
+
+class ParallelPack():
+    # n cells split into shards (default: 64 or fewer) stepped by workers processes (default: one per core)
+    # Inputs can be changed between ticks through the cell arrays (e.g. pack.cells['pedal_press'][:] = True)
+    def __init__(self, n, seed=0, shards=None, workers=None, sample_period=0.1):
+        self.n = n
+        shard_count = min(shards if shards is not None else 64, max(n, 1)) # no empty shards
+        self.shard_count = shard_count
+        bounds = np.linspace(0, n, shard_count + 1).astype(int).tolist()
+        worker_count = workers if workers is not None else multiprocessing.cpu_count()
+        worker_count = min(worker_count, shard_count)
+
+        cell_offsets, cell_size = layout(cell_fields(), n)
+        shard_offsets, shard_size = layout(SHARD_FIELDS, shard_count)
+        self.memory = shared_memory.SharedMemory(create=True, size=cell_size + shard_size)
+        self.cells, self.partials = map_memory(self.memory.buf, n, shard_count)
+        initialize_arrays(self.cells)
+
+        self.processes = []
+        self.local = None
+        if worker_count == 0:
+            self.local = Shards(self.cells, self.partials, bounds, range(shard_count), seed, sample_period)
+            return
+        self.barrier = multiprocessing.Barrier(worker_count + 1)
+        self.stop = multiprocessing.Value('b', False)
+        for shards in np.array_split(np.arange(shard_count), worker_count):
+            process = multiprocessing.Process(target=worker, daemon=True,
+                args=(self.memory.name, n, shard_count, bounds, shards.tolist(), seed, sample_period, self.barrier, self.stop))
+            process.start()
+            self.processes.append(process)
+
+    def fire(self, trigger, mask=None):
+        # Same as BMSFleet.fire, on every cell of the pack (only between ticks)
+        table = TRIGGER_TABLES[trigger]
+        state = self.cells['state']
+        if mask is None:
+            state[:] = table[state]
+        else:
+            state[mask] = table[state[mask]]
+
+    def step(self):
+        # One tick of every cell, returns the pack results of the tick
+        if self.local is not None:
+            self.local.step()
+        else:
+            self.barrier.wait() # workers start the tick
+            self.barrier.wait() # workers are done
+        return self.results()
+
+    def run(self, ticks):
+        for _ in range(ticks):
+            results = self.step()
+        return results
+
+    def results(self):
+        # Pack results reduced from the per shard results (no cell data is copied)
+        partials = self.partials
+        shard = int(np.argmin(partials['hottest_temp_voltage']))
+        return {
+            'min_voltage': float(partials['min_voltage'].min()),
+            'max_voltage': float(partials['max_voltage'].max()),
+            'hottest': int(partials['hottest'][shard]),
+            'hottest_temp_voltage': float(partials['hottest_temp_voltage'][shard]),
+            'fatal': bool(partials['fatal'].any()),
+        }
+
+    def close(self):
+        if self.processes:
+            self.stop.value = True
+            self.barrier.wait()
+            for process in self.processes:
+                process.join()
+            self.processes = []
+        self.local = None
+        del self.cells, self.partials
+        self.memory.close()
+        self.memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,150 @@
+import json
+import os
+import numpy as np
+from temperature import DEFAULT_SENSOR
+
+# Cell profiles: the warning/fatal limits of a cell chemistry, used by the fault checks instead of literals
+# Profiles are immutable and interned, so every BMS using the same limits shares one object
+
+# Limits the fault checks compare against (temperature limits are temperature sensor voltages,
+# a higher temp_voltage means a colder cell)
+LIMIT_FIELDS = (
+    'undervoltage_warning', 'overvoltage_warning', 'overcurrent_warning',
+    'undertemperature_warning', 'overtemperature_warning',
+    'undervoltage_fatal', 'overvoltage_fatal', 'overcurrent_fatal',
+    'undertemperature_fatal', 'overtemperature_fatal',
+)
+
+# Limits on the temperature sensor voltage
+TEMPERATURE_FIELDS = ('undertemperature_warning', 'overtemperature_warning', 'undertemperature_fatal', 'overtemperature_fatal')
+
+# (min, max) temperature windows in C
+WINDOW_FIELDS = ('charge_temperature', 'discharge_temperature')
+
+# Limits of each channel from its lowest to its highest reading: fatal limits lie beyond their warning limits
+# and the under-limits below the over-limits (a higher temp_voltage is a colder cell)
+LIMIT_ORDER = (
+    ('undervoltage_fatal', 'undervoltage_warning', 'overvoltage_warning', 'overvoltage_fatal'),
+    ('overcurrent_warning', 'overcurrent_fatal'),
+    ('overtemperature_fatal', 'overtemperature_warning', 'undertemperature_warning', 'undertemperature_fatal'),
+)
+
+# Cell parameters: capacity in Ah and internal resistance in ohm
+CELL_FIELDS = ('capacity', 'internal_resistance')
+
+FIELDS = ('name',) + LIMIT_FIELDS + WINDOW_FIELDS + CELL_FIELDS
+
+
+class CellProfile():
+    __slots__ = FIELDS
+
+    def __init__(self, name, undervoltage_warning, overvoltage_warning, overcurrent_warning,
+                 undertemperature_warning, overtemperature_warning,
+                 undervoltage_fatal, overvoltage_fatal, overcurrent_fatal,
+                 undertemperature_fatal, overtemperature_fatal,
+                 charge_temperature, discharge_temperature, capacity=10.2, internal_resistance=0.0054):
+        values = locals()
+        for field in LIMIT_FIELDS + CELL_FIELDS:
+            object.__setattr__(self, field, float(values[field]))
+        for field in WINDOW_FIELDS:
+            low, high = values[field]
+            object.__setattr__(self, field, (float(low), float(high)))
+        object.__setattr__(self, 'name', name)
+        self.check()
+
+    def check(self):
+        # ValueError if the limits are out of order (see LIMIT_ORDER), fatal and warning limits may coincide
+        # but the under-limits must lie strictly below the over-limits
+        for fields in LIMIT_ORDER:
+            for low, high in zip(fields, fields[1:]):
+                strict = 'warning' in low and 'warning' in high
+                a, b = getattr(self, low), getattr(self, high)
+                if a > b or (strict and a == b):
+                    raise ValueError(f"Profile {self.name!r}: {low} ({a}) must be {'below' if strict else 'at most'} {high} ({b})")
+        for field in WINDOW_FIELDS:
+            low, high = getattr(self, field)
+            if low > high:
+                raise ValueError(f"Profile {self.name!r}: {field} {(low, high)} is not a (min, max) window")
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CellProfile is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("CellProfile is immutable")
+
+    def key(self):
+        return tuple(getattr(self, field) for field in FIELDS)
+
+    def __eq__(self, other):
+        return isinstance(other, CellProfile) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def temperature_limits(self, sensor=DEFAULT_SENSOR):
+        # The temperature limits in C
+        return {field: sensor.to_celsius(getattr(self, field)) for field in TEMPERATURE_FIELDS}
+
+    def __repr__(self):
+        return f"CellProfile({self.name!r})"
+
+
+# Interned profiles by value, and by file path for profiles loaded from a file
+PROFILES = {}
+LOADED_FILES = {}
+
+def intern_profile(profile):
+    # Returns the shared profile equal to profile (registering it if it is the first one)
+    return PROFILES.setdefault(profile, profile)
+
+
+def celsius_profile(sensor=DEFAULT_SENSOR, **fields):
+    # Interned profile from fields whose temperature limits are given in C instead of sensor voltages
+    for field in TEMPERATURE_FIELDS:
+        fields[field] = sensor.to_voltage(fields[field])
+    return intern_profile(CellProfile(**fields))
+
+
+def load_profile(path):
+    # Load a profile from a JSON or TOML file with one key per field, each file is only read once
+    # With temperature_unit = "C" in the file the temperature limits are read in C
+    path = os.path.abspath(path)
+    if path in LOADED_FILES:
+        return LOADED_FILES[path]
+    if path.endswith('.toml'):
+        import tomllib
+        with open(path, 'rb') as file:
+            data = tomllib.load(file)
+    else:
+        with open(path) as file:
+            data = json.load(file)
+    if data.pop('temperature_unit', 'V') == 'C':
+        profile = celsius_profile(**data)
+    else:
+        profile = intern_profile(CellProfile(**data))
+    LOADED_FILES[path] = profile
+    return profile
+
+
+# Li4P25RT (1s4p) accumulator, see the datasheet values at the top of bms.py
+# 10.2 Ah typical capacity at 10 A, 5.4 mOhm typical internal impedance
+# Warning: 2.7 V < voltage < 4.0 V, i < 110 A, -15 < temp < 55 corresponds to 2.32 V > temp_voltage > 1.55 V
+# Fatal: 2.5 V < voltage < 4.2 V, i < 120 A, -20 < temp < 60 so 2.35 V > temp_voltage > 1.51 V
+LI4P25RT = intern_profile(CellProfile(
+    name='Li4P25RT',
+    undervoltage_warning=2.7, overvoltage_warning=4.0, overcurrent_warning=110,
+    undertemperature_warning=2.32, overtemperature_warning=1.55,
+    undervoltage_fatal=2.5, overvoltage_fatal=4.2, overcurrent_fatal=120,
+    undertemperature_fatal=2.35, overtemperature_fatal=1.51,
+    charge_temperature=(0, 45), discharge_temperature=(-20, 60),
+    capacity=10.2, internal_resistance=0.0054,
+))
+
+
+class ProfileArrays():
+    # The limits of a mixed fleet, one value per cell for every field in LIMIT_FIELDS and CELL_FIELDS
+    # Used in place of a CellProfile by the batched fault checks
+    def __init__(self, profiles, index):
+        index = np.asarray(index)
+        for field in LIMIT_FIELDS + CELL_FIELDS:
+            setattr(self, field, np.array([getattr(profile, field) for profile in profiles])[index])
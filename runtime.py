@@ -0,0 +1,145 @@
+import asyncio
+from collections import namedtuple
+from bms import MachineError, PHASE_PERIOD, TRIGGER_CODES
+from clock import LoopClock
+
+# Asyncio runtime for BMS: consumes a stream of sensor samples and input events and runs the work
+# of each state as a scheduled tick, so no handler ever blocks and many BMS can share one event loop
+
+# Stream items
+# Sample: new sensor readings (voltage V, current A, temp_voltage V)
+# Input: a change of one of the inputs pedal_press, button_press, charger_plugged_in, diagnostics_pass,
+#        or a trigger such as button_pressed_5_sec (value is ignored), any other name raises ValueError
+Sample = namedtuple('Sample', ['voltage', 'current', 'temp_voltage'])
+Input = namedtuple('Input', ['name', 'value'])
+
+INPUT_FLAGS = ('pedal_press', 'button_press', 'charger_plugged_in', 'diagnostics_pass')
+
+# Seconds between ticks in each state (None: only woken up by inputs)
+PERIODS = {
+    'deep_sleep': None,
+    'run_tests': 0,
+    'idle': None,
+    'normal_operation': 0.1,
+    'fault_operating': 0.1,
+    'sleep': None, # OCV measurements are scheduled with backoff
+    'discharge_to_storage': PHASE_PERIOD,
+    'charging': PHASE_PERIOD,
+}
+
+# OCV measurements in sleep start 0.5 s after entering and the time doubles after each one
+OCV_FIRST_INTERVAL = 0.5
+OCV_MAX_INTERVAL = 3600
+
+
+class Backoff():
+    # Intervals between the OCV measurements in sleep, shared by BMSRuntime and the OCV schedulers:
+    # first_interval after entering sleep (or a wake up), doubling after every measurement up to max_interval
+    def __init__(self, first_interval=OCV_FIRST_INTERVAL, max_interval=OCV_MAX_INTERVAL):
+        self.first_interval = first_interval
+        self.max_interval = max_interval
+
+    def next(self, interval):
+        # Interval after a measurement taken interval after the previous one
+        return min(interval * 2, self.max_interval)
+
+
+class BMSRuntime():
+    def __init__(self, bms, periods=None, ocv_first_interval=OCV_FIRST_INTERVAL, ocv_max_interval=OCV_MAX_INTERVAL):
+        self.bms = bms
+        self.periods = dict(PERIODS)
+        if periods is not None:
+            self.periods.update(periods)
+        self.backoff = Backoff(ocv_first_interval, ocv_max_interval)
+        self.ocv_interval = ocv_first_interval
+        self.next_ocv = 0
+        self.last_state = None
+        self.wake = None
+
+    async def run(self, stream):
+        # Run until the stream ends, the clock and simulated of the BMS are restored afterwards
+        loop = asyncio.get_running_loop()
+        saved = self.bms.clock, self.bms.simulated
+        self.bms.clock = LoopClock(loop)
+        self.wake = asyncio.Event()
+        ticker = asyncio.create_task(self.tick_loop())
+        try:
+            async for item in stream:
+                self.handle(item)
+                await asyncio.sleep(0) # let the tick run if the item woke it up
+        finally:
+            ticker.cancel()
+            try:
+                await ticker
+            except asyncio.CancelledError:
+                pass
+            self.bms.clock, self.bms.simulated = saved
+
+    def handle(self, item):
+        bms = self.bms
+        if isinstance(item, Sample):
+            bms.simulated = False
+            bms.voltage, bms.current, bms.temp_voltage = item
+            return
+        if item.name in INPUT_FLAGS:
+            setattr(bms, item.name, item.value)
+        elif item.name not in TRIGGER_CODES:
+            raise ValueError(f"Unknown input {item.name!r}, expected one of {INPUT_FLAGS} or a trigger")
+        else:
+            try:
+                bms.fire(item.name)
+            except MachineError:
+                return # the trigger does nothing in this state
+        # States without periodic work react to inputs right away, the others at their next tick
+        if self.periods[bms.state] is None or bms.state != self.last_state:
+            self.wake.set()
+
+    async def tick_loop(self):
+        while True:
+            timeout = self.tick()
+            self.wake.clear()
+            if timeout == 0:
+                await asyncio.sleep(0)
+            elif timeout is None:
+                await self.wake.wait()
+            else:
+                try:
+                    await asyncio.wait_for(self.wake.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+    def tick(self):
+        # Work for the current state, returns the seconds until the next tick (None: wait for an input, 0: right away)
+        bms = self.bms
+        state = bms.state
+        entered = state != self.last_state
+        self.last_state = state
+
+        if state == 'sleep':
+            return self.tick_sleep(entered)
+        bms.step()
+
+        if bms.state != state:
+            return 0
+        return self.periods[state]
+
+    def tick_sleep(self, entered):
+        bms = self.bms
+        now = bms.clock.time()
+        if entered:
+            self.ocv_interval = self.backoff.first_interval
+            self.next_ocv = now + self.ocv_interval
+        elif now >= self.next_ocv:
+            bms.simulate_ocv()
+            self.ocv_interval = self.backoff.next(self.ocv_interval)
+            self.next_ocv = now + self.ocv_interval
+        bms.step() # begin_sleep (OCV measurement) on entering, then the inputs
+
+        if bms.state != 'sleep':
+            return 0
+        return max(self.next_ocv - now, 0)
+
+
+async def run_all(runtimes, streams):
+    # Run many BMS runtimes concurrently on one event loop, one stream each
+    await asyncio.gather(*(runtime.run(stream) for runtime, stream in zip(runtimes, streams)))
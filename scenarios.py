@@ -0,0 +1,183 @@
+import argparse
+import json
+import multiprocessing
+import sys
+import time
+import numpy as np
+from bms import STATES, STATE_CODES, TRIGGER_CODES
+from fleet import BMSFleet, NORMAL_OPERATION, FAULT_OPERATING, DEEP_SLEEP
+from noise import NoiseStream
+from runtime import Input
+
+# Scenario runner: declarative scenarios (a schedule of inputs and triggers, the expected sequence of states
+# and invariants) run on virtual time as Monte-Carlo batches, every run of a batch being one instance of a BMSFleet
+# python scenarios.py [--runs 10000] [--workers 4] [--seed 0] [names...]
+# Prints pass/fail statistics of every scenario as JSON
+#
+# Run i of a scenario is instance i % batch of batch i // batch, whose noise is NoiseStream([seed, batch index]),
+# so the statistics don't depend on the number of workers and any run can be replayed with run_batch
+
+# Scenario
+# schedule: list of (time in s, Input(name, value)), name being a trigger (value is ignored), an input or a reading
+# expected: states the runs have to go through in order (each change of state is checked against it)
+# invariants: functions of a fleet returning true for every instance where the invariant holds, checked every tick
+# (module level functions, so the scenario can be sent to worker processes)
+class Scenario():
+    def __init__(self, name, schedule, duration, expected, invariants=(), sample_period=0.1):
+        self.name = name
+        self.schedule = sorted(schedule, key=lambda entry: entry[0])
+        self.duration = duration
+        self.expected = expected
+        self.invariants = list(invariants)
+        self.sample_period = sample_period
+
+
+def soc_in_range(fleet):
+    return (fleet.soc >= 0) & (fleet.soc <= 100)
+
+
+def no_fatal_in_normal_operation(fleet):
+    # A fatal fault always takes the BMS out of normal operation
+    return ~((fleet.state == NORMAL_OPERATION) & fleet.fatal_fault_check())
+
+
+INVARIANTS = [soc_in_range, no_fatal_in_normal_operation]
+
+START = [(0.0, Input('button_pressed_5_sec', None))]
+DRIVE = START + [(0.5, Input('pedal_press', True)), (1.5, Input('pedal_press', False)), (2.5, Input('button_press', True))]
+DRIVE_STATES = ['deep_sleep', 'run_tests', 'idle', 'normal_operation', 'sleep']
+
+# Scenarios of run_test1..run_test5
+# Phases step 0.5% every PHASE_PERIOD (0.2 s): storage from full takes 20 s, a full charge from empty 40 s
+SCENARIOS = [
+    Scenario('diagnostics_fail', [(0.0, Input('diagnostics_pass', False))] + START, 1.0,
+             ['deep_sleep', 'run_tests', 'deep_sleep'], INVARIANTS),
+    Scenario('drive', DRIVE, 4.0, DRIVE_STATES, INVARIANTS),
+    Scenario('drive_to_fatal', START + [(0.5, Input('pedal_press', True))], 10.0,
+             ['deep_sleep', 'run_tests', 'idle', 'normal_operation', 'fault_operating', 'deep_sleep'], INVARIANTS),
+    Scenario('discharge_to_storage', DRIVE + [(3.5, Input('button_pressed_5_sec', None))], 25.0,
+             DRIVE_STATES + ['discharge_to_storage', 'deep_sleep'], INVARIANTS),
+    Scenario('charging', DRIVE + [(3.5, Input('charger_plugged_in', True))], 45.0,
+             DRIVE_STATES + ['charging', 'sleep'], INVARIANTS),
+]
+
+
+def run_batch(scenario, seed, batch, size):
+    # Run size instances of the scenario (batch number batch), returns one array per result, one value per run
+    fleet = BMSFleet(size, noise=NoiseStream([seed, batch], block=size))
+    fleet.sample_period = scenario.sample_period
+    expected = np.array([STATE_CODES[name] for name in scenario.expected], dtype=np.int8)
+
+    position = np.zeros(size, dtype=np.int64) # index in expected of the current state
+    in_sequence = fleet.state == expected[0]
+    reached = np.zeros((size, len(STATES)), dtype=bool)
+    reached[np.arange(size), fleet.state] = True
+    fault_time = np.full(size, np.nan)
+    fatal_time = np.full(size, np.nan)
+    invariant_ok = np.ones((len(scenario.invariants), size), dtype=bool)
+
+    def observe(previous, now):
+        changed = fleet.state != previous
+        if not changed.any():
+            return
+        following = np.minimum(position + 1, len(expected) - 1)
+        matches = (position + 1 < len(expected)) & (expected[following] == fleet.state)
+        position[changed & matches] += 1
+        in_sequence[changed & ~matches] = False
+        reached[np.flatnonzero(changed), fleet.state[changed]] = True
+        fault_time[changed & (fleet.state == FAULT_OPERATING) & np.isnan(fault_time)] = now
+        fatal = changed & (previous == FAULT_OPERATING) & (fleet.state == DEEP_SLEEP)
+        fatal_time[fatal & np.isnan(fatal_time)] = now
+
+    schedule = scenario.schedule
+    next_entry = 0
+    ticks = int(round(scenario.duration / scenario.sample_period))
+    for tick in range(ticks):
+        now = tick * scenario.sample_period
+        previous = fleet.state.copy()
+        while next_entry < len(schedule) and schedule[next_entry][0] <= now + 1e-9:
+            name, value = schedule[next_entry][1]
+            if name in TRIGGER_CODES:
+                fleet.fire(name)
+            else:
+                getattr(fleet, name)[:] = value
+            next_entry += 1
+        observe(previous, now)
+
+        previous = fleet.state.copy()
+        fleet.step()
+        now += scenario.sample_period
+        observe(previous, now)
+        for i, invariant in enumerate(scenario.invariants):
+            invariant_ok[i] &= invariant(fleet)
+
+    complete = position == len(expected) - 1
+    return {
+        'passed': in_sequence & complete & invariant_ok.all(axis=0),
+        'in_sequence': in_sequence & complete,
+        'reached': reached,
+        'fault_time': fault_time,
+        'fatal_time': fatal_time,
+        'invariant_ok': invariant_ok,
+        'final_state': fleet.state.copy(),
+    }
+
+
+def distribution(times):
+    # Summary of the times of the runs that have one (nan for the others)
+    times = times[~np.isnan(times)]
+    if len(times) == 0:
+        return {'count': 0}
+    p50, p90, p99 = np.percentile(times, [50, 90, 99])
+    return {'count': len(times), 'mean': float(times.mean()), 'min': float(times.min()),
+            'p50': float(p50), 'p90': float(p90), 'p99': float(p99), 'max': float(times.max())}
+
+
+def run_scenario(scenario, runs=1000, seed=0, batch=1024, workers=0):
+    # Monte-Carlo statistics of runs runs of the scenario, batches are spread over workers processes (0: this process)
+    start = time.perf_counter()
+    tasks = [(scenario, seed, index, min(batch, runs - first)) for index, first in enumerate(range(0, runs, batch))]
+    if workers:
+        with multiprocessing.Pool(workers) as pool:
+            batches = pool.starmap(run_batch, tasks)
+    else:
+        batches = [run_batch(*task) for task in tasks]
+    results = {name: np.concatenate([result[name] for result in batches], axis=-1 if name == 'invariant_ok' else 0)
+               for name in batches[0]}
+
+    passed = results['passed']
+    return {
+        'scenario': scenario.name,
+        'runs': runs,
+        'seed': seed,
+        'passed': int(passed.sum()),
+        'pass_rate': float(passed.mean()),
+        'sequence_mismatches': int((~results['in_sequence']).sum()),
+        'invariant_failures': {invariant.__name__: int((~ok).sum())
+                               for invariant, ok in zip(scenario.invariants, results['invariant_ok'])},
+        'reached': {name: float(results['reached'][:, code].mean()) for code, name in enumerate(STATES)},
+        'final_state': {name: float((results['final_state'] == code).mean()) for code, name in enumerate(STATES)},
+        'time_to_fault_s': distribution(results['fault_time']),
+        'time_to_fatal_s': distribution(results['fatal_time']),
+        'failed_runs': np.flatnonzero(~passed)[:10].tolist(), # first few, to replay with run_batch
+        'elapsed_s': time.perf_counter() - start,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Monte-Carlo BMS scenarios")
+    parser.add_argument('names', nargs='*', help="scenarios to run (all by default)")
+    parser.add_argument('--runs', type=int, default=10000, help="runs of each scenario")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--batch', type=int, default=1024, help="runs per batch (one fleet)")
+    parser.add_argument('--workers', type=int, default=0, help="worker processes (0: run in this process)")
+    args = parser.parse_args(argv)
+
+    scenarios = [scenario for scenario in SCENARIOS if not args.names or scenario.name in args.names]
+    report = [run_scenario(scenario, args.runs, args.seed, args.batch, args.workers) for scenario in scenarios]
+    print(json.dumps(report, indent=2))
+    return 0 if all(result['passed'] == result['runs'] for result in report) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,179 @@
+import heapq
+import itertools
+import numpy as np
+from fleet import SLEEP
+from runtime import OCV_FIRST_INTERVAL, OCV_MAX_INTERVAL, Backoff
+
+# OCV measurements of sleeping BMS with exponential backoff (runtime.Backoff, as BMSRuntime: first one interval after
+# parking, the interval doubling after every measurement up to max_interval), for many BMS or fleet instances at once:
+# the due times are kept on a heap, run_due only touches the BMS whose measurement is due and a parked BMS
+# costs nothing in between, next_due tells the caller how long it can wait
+# A wake event (wake(), after button_press/charger_plugged_in changed) checks the inputs of the BMS right away,
+# a BMS that left sleep is dropped from the heap, one still sleeping starts its backoff again
+# Heap entries are never searched for: dropping or rescheduling a BMS bumps its generation, entries of an older
+# generation are skipped when they come up
+# A parked BMS may still be stepped by other code: one that left sleep that way is dropped when its entry comes up
+# (or on wake), without a measurement
+
+class OCVScheduler():
+    # Scheduler for BMS objects sharing clock
+    def __init__(self, clock, first_interval=OCV_FIRST_INTERVAL, max_interval=OCV_MAX_INTERVAL):
+        self.clock = clock
+        self.backoff = Backoff(first_interval, max_interval)
+        self.heap = [] # (due time, sequence, generation, interval, bms)
+        self.generations = {} # generation of every parked BMS
+        self.sequence = itertools.count()
+        self.measurements = 0
+
+    def __len__(self):
+        return len(self.generations)
+
+    def park(self, bms):
+        # Take over a BMS in sleep (running begin_sleep if it was not stepped in sleep yet)
+        if bms.state != 'sleep':
+            raise ValueError(f"Only a sleeping BMS can be parked, not one in {bms.state}")
+        if bms.step_code != bms.state_code:
+            bms.step()
+            if bms.state != 'sleep': # inputs already set
+                return
+        self.schedule(bms, self.backoff.first_interval, self.clock.time())
+
+    def schedule(self, bms, interval, now):
+        generation = self.generations.get(bms, -1) + 1
+        self.generations[bms] = generation
+        heapq.heappush(self.heap, (now + interval, next(self.sequence), generation, interval, bms))
+
+    def unpark(self, bms):
+        self.generations.pop(bms, None)
+
+    def wake(self, bms):
+        # The inputs of a parked BMS changed: leaves sleep (and the scheduler) or starts its backoff again
+        if bms.state == 'sleep':
+            bms.step()
+        if bms.state != 'sleep':
+            self.unpark(bms)
+        else:
+            self.schedule(bms, self.backoff.first_interval, self.clock.time())
+
+    def next_due(self):
+        # Time of the next measurement, None if no BMS is parked
+        heap = self.heap
+        while heap and self.generations.get(heap[0][4]) != heap[0][2]:
+            heapq.heappop(heap) # dropped or rescheduled since
+        return heap[0][0] if heap else None
+
+    def run_due(self, now=None):
+        # Measure the OCV of every BMS due by now (clock time by default), returns the number of measurements
+        if now is None:
+            now = self.clock.time()
+        heap = self.heap
+        count = 0
+        while heap and heap[0][0] <= now:
+            due, sequence, generation, interval, bms = heapq.heappop(heap)
+            if self.generations.get(bms) != generation:
+                continue
+            if bms.state != 'sleep': # stepped out of sleep elsewhere
+                self.unpark(bms)
+                continue
+            bms.simulate_ocv()
+            bms.step() # inputs changed without wake()
+            count += 1
+            if bms.state != 'sleep':
+                self.unpark(bms)
+            else:
+                self.schedule(bms, self.backoff.next(interval), now)
+        self.measurements += count
+        return count
+
+
+class FleetOCVScheduler():
+    # Scheduler for the instances of a BMSFleet: instances parked together share one heap entry (an index array),
+    # so a batch of them is measured with a few array operations
+    # A fleet whose instances are all parked can be left unstepped; if fleet.step() still runs, it checks the inputs
+    # of the parked instances as well (at most one transition each, as wake does) and the instances it takes out of
+    # sleep are dropped when their entry comes up
+    def __init__(self, fleet, clock, first_interval=OCV_FIRST_INTERVAL, max_interval=OCV_MAX_INTERVAL):
+        self.fleet = fleet
+        self.clock = clock
+        self.backoff = Backoff(first_interval, max_interval)
+        self.heap = [] # (due time, sequence, interval, instances, their generations)
+        self.parked = np.zeros(fleet.n, dtype=bool)
+        self.generation = np.zeros(fleet.n, dtype=np.int64)
+        self.sequence = itertools.count()
+        self.measurements = 0
+
+    def __len__(self):
+        return int(self.parked.sum())
+
+    def park(self, mask=None):
+        # Take over the sleeping instances in mask (all sleeping instances if None) that are not parked yet, running
+        # the begin_sleep work of those not stepped in sleep yet (as fleet.step() would)
+        fleet = self.fleet
+        sleeping = (fleet.state == SLEEP) & ~self.parked
+        if mask is not None:
+            sleeping &= mask
+        entered = sleeping & (fleet.step_code != SLEEP)
+        fleet.step_code[entered] = SLEEP
+        fleet.step_sleep(entered, entered)
+        idx = np.flatnonzero(sleeping & (fleet.state == SLEEP))
+        self.schedule(idx, self.backoff.first_interval, self.clock.time())
+
+    def schedule(self, idx, interval, now):
+        if len(idx) == 0:
+            return
+        self.generation[idx] += 1
+        self.parked[idx] = True
+        heapq.heappush(self.heap, (now + interval, next(self.sequence), interval, idx, self.generation[idx]))
+
+    def unpark(self, mask):
+        self.parked[mask] = False
+        self.generation[mask] += 1
+
+    def check_inputs(self, idx):
+        # Sleep inputs of the instances in idx, returns those still sleeping (the others are unparked)
+        fleet = self.fleet
+        mask = np.zeros(fleet.n, dtype=bool)
+        mask[idx] = True
+        fleet.check_sleep_inputs(mask & (fleet.state == SLEEP))
+        left = idx[fleet.state[idx] != SLEEP]
+        self.unpark(left)
+        return idx[fleet.state[idx] == SLEEP]
+
+    def wake(self, mask):
+        # The inputs of the parked instances in mask changed: they leave sleep or start their backoff again
+        idx = np.flatnonzero(mask & self.parked)
+        staying = self.check_inputs(idx)
+        self.schedule(staying, self.backoff.first_interval, self.clock.time())
+
+    def next_due(self):
+        heap = self.heap
+        while heap and not (self.parked[heap[0][3]] & (self.generation[heap[0][3]] == heap[0][4])).any():
+            heapq.heappop(heap)
+        return heap[0][0] if heap else None
+
+    def run_due(self, now=None):
+        # Measure the OCV of every instance due by now, returns the number of measurements
+        if now is None:
+            now = self.clock.time()
+        heap = self.heap
+        fleet = self.fleet
+        count = 0
+        while heap and heap[0][0] <= now:
+            due, sequence, interval, idx, generations = heapq.heappop(heap)
+            idx = idx[self.parked[idx] & (self.generation[idx] == generations)]
+            left = idx[fleet.state[idx] != SLEEP] # stepped out of sleep by fleet.step()
+            self.unpark(left)
+            idx = idx[fleet.state[idx] == SLEEP]
+            if len(idx) == 0:
+                continue
+            mask = np.zeros(fleet.n, dtype=bool)
+            mask[idx] = True
+            fleet.simulate_ocv(mask)
+            count += len(idx)
+            staying = self.check_inputs(idx)
+            if len(staying):
+                # same generation, the entry just moves on
+                interval = self.backoff.next(interval)
+                heapq.heappush(heap, (now + interval, next(self.sequence), interval, staying, self.generation[staying]))
+        self.measurements += count
+        return count
@@ -0,0 +1,60 @@
+from lookup import LookupTable
+
+# SOC estimation: coulomb counting over each sample period, corrected from the OCV while the pack rests
+# Every function works on single values and on NumPy arrays (one value per cell) and is O(1) per sample
+
+# Open circuit voltage (V) at each SOC (%) of a 2.5 V - 4.2 V cell
+OCV_CURVE = [(0, 2.5), (2, 3.0), (5, 3.3), (10, 3.45), (20, 3.55), (30, 3.62), (40, 3.67), (50, 3.72),
+             (60, 3.8), (70, 3.88), (80, 3.96), (90, 4.06), (100, 4.2)]
+
+# Rest voltages outside of this range are not valid OCV readings
+OCV_MIN = 2.5
+OCV_MAX = 4.2
+
+SOC_TO_OCV = LookupTable(OCV_CURVE, 0.0, 100.0, 0.01)
+OCV_TO_SOC = LookupTable([(v, s) for s, v in OCV_CURVE], OCV_MIN, OCV_MAX, 0.0001)
+
+
+def coulomb_count(soc, current, dt, capacity):
+    # SOC after drawing current (A) for dt seconds from a capacity (Ah) cell (3600 s/h / 100 % = 36)
+    return soc - current * dt / (capacity * 36)
+
+
+def ocv_to_soc(ocv):
+    return OCV_TO_SOC(ocv)
+
+
+def soc_to_ocv(soc):
+    return SOC_TO_OCV(soc)
+
+
+class SOCKalmanFilter():
+    # Extended Kalman filter on SOC: coulomb counting as the process model and the terminal voltage
+    # OCV(SOC) - current * resistance as the measurement
+    # soc/variance can be arrays to run one filter per cell (used directly: only BMS has a soc_filter slot, BMSFleet
+    # estimates by coulomb counting)
+    def __init__(self, soc, capacity, resistance, variance=25.0, process_noise=0.01, measurement_noise=0.0004):
+        self.soc = soc
+        self.variance = variance
+        self.capacity = capacity
+        self.resistance = resistance
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+
+    def reset(self, soc, variance=1.0):
+        # Restart from a known SOC (e.g. after an OCV correction)
+        self.soc = soc
+        self.variance = variance
+
+    def step(self, current, voltage, dt):
+        # Predict
+        soc = coulomb_count(self.soc, current, dt, self.capacity)
+        variance = self.variance + self.process_noise
+
+        # Correct with the measured voltage, slope of the OCV curve in V per % around soc
+        slope = SOC_TO_OCV(soc + 0.5) - SOC_TO_OCV(soc - 0.5)
+        error = voltage - (SOC_TO_OCV(soc) - current * self.resistance)
+        gain = variance * slope / (slope * slope * variance + self.measurement_noise)
+        self.soc = soc + gain * error
+        self.variance = (1 - gain * slope) * variance
+        return self.soc
@@ -0,0 +1,297 @@
+import json
+import os
+import queue
+import threading
+import numpy as np
+from bms import STATES
+import events
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Columnar telemetry: the readings of BMS and fleet runs and their state transitions, written as two tables
+# (samples and transitions) in a directory, query ready for pandas/duckdb:
+#   duckdb.sql("select state, avg(voltage) from 'run/samples.parquet' group by state")
+#   pandas.read_parquet('run/samples.parquet')
+#
+# Rows are appended to preallocated column chunks, a full chunk is handed to a writer thread and the recording
+# continues in a free one; a table has a fixed number of chunks, so memory is bounded (recording waits for
+# the writer thread if it falls that far behind)
+#
+# Formats: 'parquet' (one row group per chunk) and 'arrow' (Arrow IPC file, one record batch per chunk) need pyarrow,
+# 'npz' (one file per chunk, <table>-<part>.npz) only needs numpy; the default is parquet if pyarrow is installed
+# State codes index STATES (also kept in the schema metadata of parquet/arrow files)
+
+SAMPLE_DTYPE = np.dtype([
+    ('timestamp', '<f8'),
+    ('instance', '<u4'),
+    ('state', 'i1'),
+    ('voltage', '<f4'),
+    ('current', '<f4'),
+    ('temp_voltage', '<f4'),
+    ('soc', '<f4'),
+])
+
+TRANSITION_DTYPE = np.dtype([
+    ('timestamp', '<f8'),
+    ('instance', '<u4'),
+    ('source', 'i1'),
+    ('dest', 'i1'),
+])
+
+TABLES = {'samples': SAMPLE_DTYPE, 'transitions': TRANSITION_DTYPE}
+EXTENSIONS = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+# Events that carry a reading, recorded as a sample by TelemetrySink
+SAMPLE_EVENTS = (events.MEASUREMENT, events.SOC_STEP, events.SOC_FAST_FORWARD)
+
+
+class TelemetryError(Exception):
+    pass
+
+
+def default_format():
+    return 'parquet' if pyarrow is not None else 'npz'
+
+
+class ArrowOutput():
+    # Parquet or Arrow IPC file of one table, written one chunk at a time
+    def __init__(self, path, dtype, format):
+        fields = [pyarrow.field(name, pyarrow.from_numpy_dtype(dtype[name])) for name in dtype.names]
+        self.schema = pyarrow.schema(fields, metadata={'states': json.dumps(STATES)})
+        if format == 'parquet':
+            self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        else:
+            self.writer = pyarrow.ipc.new_file(path, self.schema)
+
+    def write(self, columns, count):
+        batch = pyarrow.RecordBatch.from_arrays([pyarrow.array(column[:count]) for column in columns.values()],
+                                                schema=self.schema)
+        self.writer.write_batch(batch)
+
+    def close(self):
+        self.writer.close()
+
+
+class NpzOutput():
+    # One .npz file per chunk, path-00000.npz, path-00001.npz...
+    def __init__(self, path, dtype, format):
+        self.path = path
+        self.part = 0
+
+    def write(self, columns, count):
+        np.savez(f'{self.path}-{self.part:05d}.npz', **{name: column[:count] for name, column in columns.items()})
+        self.part += 1
+
+    def close(self):
+        pass
+
+
+class ColumnChunks():
+    # Rows of one table being recorded: the current chunk (one array per column) and the free ones
+    def __init__(self, output, dtype, rows, chunks, pending):
+        self.output = output
+        self.rows = rows
+        self.pending = pending # queue of the writer thread
+        self.free = queue.Queue()
+        for _ in range(chunks):
+            self.free.put({name: np.zeros(rows, dtype=dtype[name]) for name in dtype.names})
+        self.columns = self.free.get()
+        self.count = 0
+
+    def submit(self):
+        # Hand the current chunk to the writer thread and continue in a free one
+        if self.count == 0:
+            return
+        self.pending.put((self, self.columns, self.count))
+        self.columns = self.free.get()
+        self.count = 0
+
+    def append(self, count, values):
+        # count rows, values maps each column to a scalar or to count values
+        done = 0
+        while done < count:
+            take = min(count - done, self.rows - self.count)
+            for name, value in values.items():
+                self.columns[name][self.count:self.count + take] = value if np.ndim(value) == 0 else value[done:done + take]
+            self.count += take
+            done += take
+            if self.count == self.rows:
+                self.submit()
+
+
+class TelemetryWriter():
+    # Telemetry of a run written to directory, chunk rows per chunk and at most chunks chunks per table in memory
+    def __init__(self, directory, format=None, chunk=65536, chunks=4):
+        format = format or default_format()
+        if format not in ('parquet', 'arrow', 'npz'):
+            raise TelemetryError(f"Unknown telemetry format {format}")
+        if format != 'npz' and pyarrow is None:
+            raise TelemetryError(f"The {format} format needs pyarrow, use format='npz'")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.format = format
+        self.pending = queue.Queue()
+        self.error = None
+        self.fleet_state = None # state of every fleet instance at the last record_fleet
+
+        output = NpzOutput if format == 'npz' else ArrowOutput
+        self.tables = {}
+        for name, dtype in TABLES.items():
+            path = os.path.join(directory, name + EXTENSIONS.get(format, ''))
+            self.tables[name] = ColumnChunks(output(path, dtype, format), dtype, chunk, chunks, self.pending)
+        self.samples = self.tables['samples']
+        self.transitions = self.tables['transitions']
+
+        self.thread = threading.Thread(target=self.write_chunks, daemon=True)
+        self.thread.start()
+
+    def write_chunks(self):
+        # Writer thread: writes the chunks handed over until close() sends None
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            table, columns, count = item
+            if self.error is None:
+                try:
+                    table.output.write(columns, count)
+                except Exception as error:
+                    self.error = error # raised in the recording thread at close()
+            table.free.put(columns)
+
+    def record(self, bms, instance=0):
+        # One sample of a BMS at bms.clock.time()
+        table = self.samples
+        i = table.count
+        columns = table.columns
+        columns['timestamp'][i] = bms.clock.time()
+        columns['instance'][i] = instance
+        columns['state'][i] = bms.state_code
+        columns['voltage'][i] = bms.voltage
+        columns['current'][i] = bms.current
+        columns['temp_voltage'][i] = bms.temp_voltage
+        columns['soc'][i] = bms.soc
+        table.count = i + 1
+        if table.count == table.rows:
+            table.submit()
+
+    def transition(self, timestamp, instance, source, dest):
+        table = self.transitions
+        i = table.count
+        columns = table.columns
+        columns['timestamp'][i] = timestamp
+        columns['instance'][i] = instance
+        columns['source'][i] = source
+        columns['dest'][i] = dest
+        table.count = i + 1
+        if table.count == table.rows:
+            table.submit()
+
+    def record_fleet(self, fleet, timestamp, mask=None):
+        # One sample of every instance of a fleet (those in mask if given), and the state changes since the last call
+        if self.fleet_state is not None:
+            changed = np.flatnonzero(fleet.state != self.fleet_state)
+            if len(changed):
+                self.transitions.append(len(changed), {'timestamp': timestamp, 'instance': changed,
+                                                       'source': self.fleet_state[changed],
+                                                       'dest': fleet.state[changed]})
+        self.fleet_state = fleet.state.copy()
+
+        idx = np.arange(fleet.n) if mask is None else np.flatnonzero(mask)
+        values = {'timestamp': timestamp, 'instance': idx, 'state': fleet.state}
+        for name in ('voltage', 'current', 'temp_voltage', 'soc'):
+            values[name] = getattr(fleet, name)
+        if mask is not None:
+            for name in ('state', 'voltage', 'current', 'temp_voltage', 'soc'):
+                values[name] = values[name][idx]
+        self.samples.append(len(idx), values)
+
+    def close(self):
+        # Write the last chunks and close the files
+        if self.thread.is_alive():
+            for table in self.tables.values():
+                table.submit()
+            self.pending.put(None)
+            self.thread.join()
+            for table in self.tables.values():
+                table.output.close()
+        if self.error is not None:
+            raise TelemetryError(f"Writing telemetry to {self.directory} failed") from self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TelemetrySink():
+    # Event sink recording the readings of a BMS (measurements and SOC steps) into a writer, every event is passed
+    # on to forward if given (e.g. a PrintSink at INFO to keep the messages)
+    # Also takes the place of the TransitionHistory of the BMS, to record each transition when fire() takes it, every
+    # transition is passed on to history if given (the TransitionHistory it took the place of)
+    def __init__(self, writer, instance=0, forward=None, history=None):
+        self.writer = writer
+        self.instance = instance
+        self.forward = forward
+        self.history = history
+
+    def emit(self, level, code, bms):
+        if code in SAMPLE_EVENTS:
+            self.writer.record(bms, self.instance)
+        if self.forward is not None:
+            self.forward.emit(level, code, bms)
+
+    def record(self, timestamp, source, dest, trigger):
+        self.writer.transition(timestamp, self.instance, source, dest)
+        if self.history is not None:
+            self.history.record(timestamp, source, dest, trigger)
+
+
+def attach_telemetry(bms, writer, instance=0, forward=None):
+    # Start recording the samples and transitions of bms into writer as instance, returns its TelemetrySink
+    # (replaces the event sink of bms, and its transition history which keeps recording behind the sink)
+    # Raises TelemetryError for a BMS without a history slot (a CompactBMS row), whose transitions can't be recorded
+    sink = TelemetrySink(writer, instance, forward, bms.history)
+    try:
+        bms.history = sink
+    except AttributeError as error:
+        raise TelemetryError(f"Telemetry can't be attached to a {type(bms).__name__}: {error}") from None
+    bms.events = sink
+    return sink
+
+
+def read_telemetry(directory, table='samples'):
+    # A table of a telemetry directory as a structured array (in memory), whatever its format
+    dtype = TABLES[table]
+    parts = sorted(name for name in os.listdir(directory) if name.startswith(table + '-') and name.endswith('.npz'))
+    if parts:
+        chunks = []
+        for name in parts:
+            with np.load(os.path.join(directory, name)) as data:
+                chunk = np.empty(len(data['timestamp']), dtype=dtype)
+                for column in dtype.names:
+                    chunk[column] = data[column]
+                chunks.append(chunk)
+        return np.concatenate(chunks)
+
+    for format, extension in EXTENSIONS.items():
+        path = os.path.join(directory, table + extension)
+        if os.path.exists(path):
+            if pyarrow is None:
+                raise TelemetryError(f"Reading {path} needs pyarrow")
+            if format == 'parquet':
+                data = pyarrow.parquet.read_table(path)
+            else:
+                with pyarrow.ipc.open_file(path) as reader:
+                    data = reader.read_all()
+            records = np.empty(data.num_rows, dtype=dtype)
+            for column in dtype.names:
+                records[column] = data.column(column).to_numpy()
+            return records
+    return np.empty(0, dtype=dtype)
@@ -0,0 +1,35 @@
+from lookup import LookupTable
+
+# Conversion between the temperature sensor voltage (temp_voltage) and the cell temperature in C
+# The calibration points are interpolated once into dense lookup tables, after that a conversion
+# is an index computation and one linear interpolation between neighbouring table entries
+
+# Sensor calibration (temperature C, sensor voltage V), the voltage drops as the cell gets hotter
+# Points from the Li4P25RT limits: -20 C = 2.35 V, -15 C = 2.32 V, 25 C = 1.86 V, 55 C = 1.55 V, 60 C = 1.51 V
+CALIBRATION = [(-20, 2.35), (-15, 2.32), (25, 1.86), (55, 1.55), (60, 1.51)]
+
+
+class TemperatureSensor():
+    # Converts both ways, for single values (to_celsius/to_voltage) and arrays (to_celsius_array/to_voltage_array)
+    # Inputs outside the table ranges are clamped to the end of the table
+    def __init__(self, calibration=CALIBRATION, voltage_range=(0.0, 3.3), voltage_step=0.001,
+                 temperature_range=(-40.0, 125.0), temperature_step=0.01):
+        self.calibration = tuple(calibration)
+        self.celsius = LookupTable([(v, t) for t, v in calibration], voltage_range[0], voltage_range[1], voltage_step)
+        self.voltage = LookupTable(calibration, temperature_range[0], temperature_range[1], temperature_step)
+
+    def to_celsius(self, temp_voltage):
+        return self.celsius.lookup(temp_voltage)
+
+    def to_celsius_array(self, temp_voltage):
+        return self.celsius.lookup_array(temp_voltage)
+
+    def to_voltage(self, celsius):
+        return self.voltage.lookup(celsius)
+
+    def to_voltage_array(self, celsius):
+        return self.voltage.lookup_array(celsius)
+
+
+# Sensor used by BMS unless another one is set
+DEFAULT_SENSOR = TemperatureSensor()
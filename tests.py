@@ -1,27 +1,68 @@
-import time
-from bms import BMS
+import asyncio
+import itertools
+import json
+import numpy as np
+import os
+import random
+import tempfile
+import types
+from analysis import KNOWN_GAPS, analyze, graph_hash, problems
+from bms import BMS, MachineError, STATES, STATE_CODES, TRANSITION_TABLE, TRANSITIONS, TRIGGERS, TRIGGER_CODES
+from cellmodel import TheveninModel
+from charging import CHARGE_FATAL_FAULT, CHARGE_OVERCURRENT, CHARGE_OVERTEMPERATURE, CHARGE_OVERVOLTAGE, FAST_CHARGE_CURRENT, TERMINATION_CURRENT, ChargeController
+import events
+import faults
+from events import RingBufferSink, NullSink
+import profiles
+from profiles import CellProfile, LI4P25RT, intern_profile, load_profile
+from clock import RealClock, VirtualClock
+from compact import BMSStore
+from debounce import FaultFilter
+from fleet import BMSFleet
+from history import attach_history, detach_history
+from noise import NoiseStream
+from pack import Pack
+from parallel import ParallelPack
+from runtime import OCV_MAX_INTERVAL, BMSRuntime, Input, Sample, run_all
+from scenarios import SCENARIOS, run_scenario
+from soc import SOCKalmanFilter, coulomb_count, soc_to_ocv
+from scheduler import FleetOCVScheduler, OCVScheduler
+import telemetry
+from telemetry import TelemetryError, TelemetryWriter, attach_telemetry, read_telemetry
+from temperature import CALIBRATION, DEFAULT_SENSOR, TemperatureSensor
+from traces import TraceRecorder, TransitionLog, open_trace, open_transition_log, replay, replay_fleet
 
-def run_test1():
+# Messages of the failed checks of every run_testN so far, main.py exits with status 1 if there is any
+failures = []
+
+
+def report_failure(message):
+    print(f"{message}: Test failed")
+    failures.append(message)
+
+
+def run_test1(clock=None):
     # Test 1: deep_sleep => run_tests => deep_sleep
+    clock = clock if clock is not None else RealClock()
     print("Test 1 \n")
-    time.sleep(0.5)
-    bms1 = BMS()
+    clock.sleep(0.5)
+    bms1 = BMS(clock)
 
     print("\nThis will test deep_sleep => run_tests => deep_sleep\n")
-    time.sleep(2)
+    clock.sleep(2)
 
     print("Starting BMS Simulation...\n")
 
     # Check that we are in deep sleep state
     if (bms1.state != 'deep_sleep'):
-        print("Incorrect state: Test failed")
+        report_failure("Incorrect state")
         return
 
     bms1.button_pressed_5_sec() # Simulate start up, transition to run_tests
 
     # Check that we are in the run_tests state
     if (bms1.state != 'run_tests'):
-        print("Incorrect state: Test failed")
+        report_failure("Incorrect state")
         return
 
     bms1.diagnostics_pass = False 
@@ -30,7 +71,7 @@ def run_test1():
 
     #Check we go back to the deep sleep state
     if (bms1.state != 'deep_sleep'):
-        print("Incorrect state: Test failed")
+        report_failure("Incorrect state")
         return
     
     bms1.enter_deep_sleep()
@@ -39,17 +80,18 @@ def run_test1():
     #Tests passed, so print test is passed, wait 5 seconds and go onto the next tests
     print("\nTest 1 passed \n")
 
-    time.sleep(2)
+    clock.sleep(2)
 
-def run_test2():
+def run_test2(clock=None):
     # Test 2 : deep_sleep => run_tests => idle => normal operation => sleep
     # From normal operation, randomization of parameters
+    clock = clock if clock is not None else RealClock()
     print("Test 2 \n")
-    time.sleep(0.5)
-    bms2 = BMS()
+    clock.sleep(0.5)
+    bms2 = BMS(clock)
 
     print("\nThis will test transitioning to the normal operation mode and monitoring when the pedal is pressed and not pressed. It will then go to the sleep state\n")
-    time.sleep(2)
+    clock.sleep(2)
 
     print("Starting BMS Simulation...\n")
 
@@ -60,41 +102,41 @@ def run_test2():
 
     # Check that we are in the idle state
     if (bms2.state != 'idle'):
-        print("Incorrect state: Test failed")
+        report_failure("Incorrect state")
         return
     
     bms2.enter_idle()
     # wait to simulate time pedal is not pressed
-    time.sleep(0.5) # simulate while loop
+    clock.sleep(0.5) # simulate while loop
 
     bms2.pedal_press = True # Simulate pedal pressed
     print("\nPedal pressed down\n")
-    time.sleep(1)
+    clock.sleep(1)
     bms2.enter_idle()
 
     # Check that we are in normal operation
     if (bms2.state != 'normal_operation'):
-        print("Incorrect state: Test failed")
+        report_failure("Incorrect state")
         return
     
     # when the pedal is being pressed in normal operating state
     cycles = 10 # Monitor for 10 cycles before letting go of the pedal
     while bms2.state == 'normal_operation' and cycles != 0:
         bms2.enter_normal_operation()
-        time.sleep(0.1)
+        clock.sleep(0.1)
         # if there is no fault detected, assert that state is still normal operation
         if bms2.fault_check():
             if (bms2.state != 'fault_detected'):
-                print("Incorrect state: Test failed")
+                report_failure("Incorrect state")
                 return
         # if there is a fault detected, assert that state is now fault operating
         else:
             if (bms2.state != 'normal_operation'):
-                print("Incorrect state: Test failed")
+                report_failure("Incorrect state")
                 return
         cycles -= 1
     
-    time.sleep(1)
+    clock.sleep(1)
     bms2.pedal_press = False
     print("\nTake foot off the pedal\n")
 
@@ -102,16 +144,16 @@ def run_test2():
     cycles = 10
     while bms2.state == 'normal_operation' and cycles != 0:
         bms2.enter_normal_operation()
-        time.sleep(0.1)
+        clock.sleep(0.1)
         # if there is no fault detected, assert that state is still normal operation
         if bms2.fault_check():
             if (bms2.state != 'fault_detected'):
-                print("Incorrect state: Test failed")
+                report_failure("Incorrect state")
                 return
         # if there is a fault detected, assert that state is now fault operating
         else:
             if (bms2.state != 'normal_operation'):
-                print("Incorrect state: Test failed")
+                report_failure("Incorrect state")
                 return
         cycles -= 1
 
@@ -119,21 +161,22 @@ def run_test2():
     bms2.enter_normal_operation() # Simulate button press (go to sleep)
 
     if (bms2.state != 'sleep'):
-        print("Incorrect state: Test failed")
+        report_failure("Incorrect state")
         return
     
     # Test passed
     print("\nTest 2 passed \n")
-    time.sleep(2)
+    clock.sleep(2)
 
-def run_test3():
+def run_test3(clock=None):
     # Test 3 : deep_sleep => run_tests => idle => normal operation => fault operating => fatal_fault
+    clock = clock if clock is not None else RealClock()
     print("Test 3 \n")
-    time.sleep(0.5)
-    bms3 = BMS()
+    clock.sleep(0.5)
+    bms3 = BMS(clock)
 
     print("\nThis will test transitioning to fault operating and fatal fault states when the pedal is pressed indefinitely, causing a fault.\n")
-    time.sleep(2)
+    clock.sleep(2)
 
     print("Starting BMS Simulation...\n")
 
@@ -143,46 +186,46 @@ def run_test3():
 
     # Check that we are in the idle state
     if (bms3.state != 'idle'):
-        print("Incorrect state: Test failed")
+        report_failure("Incorrect state")
         return
     
     bms3.enter_idle()
-    time.sleep(0.5) # simulate some time in idle
+    clock.sleep(0.5) # simulate some time in idle
 
     # Simulate the pedal being pressed down indefinitely
     bms3.pedal_press = True
     print("\nPedal pressed down indefinitely\n")
-    time.sleep(1)
+    clock.sleep(1)
     bms3.enter_idle()
 
     # Check that we are in normal operation
     if (bms3.state != 'normal_operation'):
-        print("Incorrect state: Test failed")
+        report_failure("Incorrect state")
         return
     
     # Simulate continuous normal operation with the pedal pressed
     while bms3.state == 'normal_operation':
         bms3.enter_normal_operation()
-        time.sleep(0.1)
+        clock.sleep(0.1)
         
         # Eventually, a fault should occur
         if bms3.fault_check():
             
             # Ensure transition to fault operating state
             if (bms3.state != 'fault_operating'):
-                print("Incorrect state: Test failed")
+                report_failure("Incorrect state")
                 return
             
             # Simulate fault getting worse over time until fatal fault
-            time.sleep(1)
+            clock.sleep(1)
             bms3.enter_fault_operating()
             
             if bms3.fatal_fault_check():
                 if (bms3.state != 'deep_sleep'):
-                    print("Incorrect state: Test failed")
+                    report_failure("Incorrect state")
                     return
             elif (bms3.state != 'fatal_fault'):
-                print("Incorrect state: Test failed")
+                report_failure("Incorrect state")
                 return
             
             print("\nSystem enncountered fatal fault.\n")
@@ -191,17 +234,18 @@ def run_test3():
 
     # Test passed
     print("\nTest 3 passed \n")
-    time.sleep(2)
+    clock.sleep(2)
 
-def run_test4():
+def run_test4(clock=None):
     # Test 4 : deep_sleep => tests => idle => sleep => discharge to storage => deep_sleep
     # Checking discharge to storage by checking soc attribute
+    clock = clock if clock is not None else RealClock()
     print("Test 4 \n")
-    time.sleep(0.5)
-    bms4 = BMS()
+    clock.sleep(0.5)
+    bms4 = BMS(clock)
 
     print("\nThis test checks that if the button is pressed for 5 seconds, the battery is discharged to 50% SOC before being sent to deep sleep\n")
-    time.sleep(2)
+    clock.sleep(2)
 
     print("Starting BMS Simulation...\n")
 
@@ -212,37 +256,37 @@ def run_test4():
 
     # Check that we are in the idle state
     if (bms4.state != 'idle'):
-        print("Incorrect state: Test failed")
+        report_failure("Incorrect state")
         return
     
     bms4.enter_idle()
     # wait to simulate time pedal is not pressed
-    time.sleep(0.5) # simulate while loop
+    clock.sleep(0.5) # simulate while loop
 
     bms4.pedal_press = True # Simulate pedal pressed
     print("\nPedal pressed down\n")
-    time.sleep(1)
+    clock.sleep(1)
     bms4.enter_idle()
 
     # Check that we are in normal operation
     if (bms4.state != 'normal_operation'):
-        print("Incorrect state: Test failed")
+        report_failure("Incorrect state")
         return
     
     # when the pedal is being pressed in normal operating state
     cycles = 10 # Monitor for 10 cycles before letting go of the pedal
     while bms4.state == 'normal_operation' and cycles != 0:
         bms4.enter_normal_operation()
-        time.sleep(0.1)
+        clock.sleep(0.1)
         # if there is no fault detected, assert that state is still normal operation
         if bms4.fault_check():
             if (bms4.state != 'fault_detected'):
-                print("Incorrect state: Test failed")
+                report_failure("Incorrect state")
                 return
         # if there is a fault detected, assert that state is now fault operating
         else:
             if (bms4.state != 'normal_operation'):
-                print("Incorrect state: Test failed")
+                report_failure("Incorrect state")
                 return
         cycles -= 1
     
@@ -250,29 +294,29 @@ def run_test4():
     bms4.enter_normal_operation() # Simulate button press (go to sleep)
 
     if (bms4.state != 'sleep'):
-        print("Incorrect state: Test failed")
+        report_failure("Incorrect state")
         return
     
     print("\nWe are currently in the sleep state\n")
-    time.sleep(1)
+    clock.sleep(1)
 
     bms4.button_pressed_5_sec() # Simulate 5 second button press
 
     if (bms4.state != 'discharge_to_storage'): # Check that we are in the discharge to storage state
-        print("Incorrect state: Test failed")
+        report_failure("Incorrect state")
         return
     
     bms4.enter_discharge_to_storage() # start draining the battery to 50% SOC
 
-    time.sleep(0.5)
+    clock.sleep(0.5)
 
     if (bms4.state != 'deep_sleep'): # Check that we are in the deep sleep after discharging to 50% SOC
-        print("Incorrect state: Test failed")
+        report_failure("Incorrect state")
         return
     
-    time.sleep(0.2)
+    clock.sleep(0.2)
     print("\nWe are at 50% SOC and in the deep sleep state for long term storage")
-    time.sleep(0.5)
+    clock.sleep(0.5)
     print("\nTest 4 Passed\n")
 
 
@@ -281,15 +325,16 @@ def run_test4():
 
 
 
-def run_test5():
+def run_test5(clock=None):
     # Test 5 : deep_sleep => tests => idle => normal => sleep (with depleted SOC) => charging => sleep
     # Checking for charging after use
+    clock = clock if clock is not None else RealClock()
     print("Test 5 \n")
-    time.sleep(0.5)
-    bms5 = BMS()
+    clock.sleep(0.5)
+    bms5 = BMS(clock)
 
     print("\nThis test checks the charging state and makes sure it refills soc to 100%\n")
-    time.sleep(2)
+    clock.sleep(2)
 
     print("Starting BMS Simulation...\n")
 
@@ -300,37 +345,37 @@ def run_test5():
 
     # Check that we are in the idle state
     if (bms5.state != 'idle'):
-        print("Incorrect state: Test failed")
+        report_failure("Incorrect state")
         return
     
     bms5.enter_idle()
     # wait to simulate time pedal is not pressed
-    time.sleep(0.5) # simulate while loop
+    clock.sleep(0.5) # simulate while loop
 
     bms5.pedal_press = True # Simulate pedal pressed
     print("\nPedal pressed down\n")
-    time.sleep(1)
+    clock.sleep(1)
     bms5.enter_idle()
 
     # Check that we are in normal operation
     if (bms5.state != 'normal_operation'):
-        print("Incorrect state: Test failed")
+        report_failure("Incorrect state")
         return
     
     # when the pedal is being pressed in normal operating state
     cycles = 10 # Monitor for 10 cycles before letting go of the pedal
     while bms5.state == 'normal_operation' and cycles != 0:
         bms5.enter_normal_operation()
-        time.sleep(0.1)
+        clock.sleep(0.1)
         # if there is no fault detected, assert that state is still normal operation
         if bms5.fault_check():
             if (bms5.state != 'fault_detected'):
-                print("Incorrect state: Test failed")
+                report_failure("Incorrect state")
                 return
         # if there is a fault detected, assert that state is now fault operating
         else:
             if (bms5.state != 'normal_operation'):
-                print("Incorrect state: Test failed")
+                report_failure("Incorrect state")
                 return
         cycles -= 1
     
@@ -338,7 +383,7 @@ def run_test5():
     bms5.enter_normal_operation() # Simulate button press (go to sleep)
 
     if (bms5.state != 'sleep'):
-        print("Incorrect state: Test failed")
+        report_failure("Incorrect state")
         return
     
     print("\nWe are currently in the sleep state\n")
@@ -347,20 +392,1485 @@ def run_test5():
     bms5.enter_sleep()
 
     if (bms5.state != 'charging'): # Check that we are in the charging state
-        print("Incorrect state: Test failed")
+        report_failure("Incorrect state")
         return
     
     while (bms5.state == 'charging'):
         bms5.enter_charging()
-        time.sleep(1)
+        clock.sleep(1)
     
     if (bms5.state != 'sleep'): # Check that we are in the sleep state after soc is 100
-        print("Incorrect state: Test failed")
+        report_failure("Incorrect state")
         return
     
-    time.sleep(0.2)
+    clock.sleep(0.2)
     print("\nWe are fully charged and back in the sleep state")
-    time.sleep(0.5)
+    clock.sleep(0.5)
     print("\nTest 5 Passed\n")
     
 
+
+
+def run_test6(clock=None):
+    # Test 6 : BMSFleet gives the same results as a list of BMS objects for the same seed
+    # deep_sleep => run_tests => idle => normal operation (pedal pressed, then released) => sleep
+    clock = clock if clock is not None else RealClock()
+    print("Test 6 \n")
+    clock.sleep(0.5)
+
+    n = 10
+    seed = 6
+    random.seed(seed)
+    cells = [BMS(clock) for _ in range(n)]
+    fleet = BMSFleet(n, seed=seed)
+
+    print("\nThis test steps a fleet and a list of BMS objects through the same inputs and checks that they match\n")
+    clock.sleep(2)
+
+    print("Starting BMS Simulation...\n")
+
+    def tick():
+        # One control period for every BMS, each one runs the handler of its current state
+        for cell in cells:
+            getattr(cell, 'enter_' + cell.state)()
+        fleet.step()
+
+    for cell in cells:
+        cell.button_pressed_5_sec() # Simulate start up, transition to run_tests
+    fleet.fire('button_pressed_5_sec')
+
+    tick() # run_tests => idle
+    tick() # stay idle
+
+    for cell in cells:
+        cell.pedal_press = True
+    fleet.pedal_press[:] = True
+    for _ in range(6): # idle => normal operation, then monitor while the pedal is pressed
+        tick()
+
+    for cell in cells:
+        cell.pedal_press = False
+    fleet.pedal_press[:] = False
+    for _ in range(10): # monitor with the pedal released
+        tick()
+
+    for cell in cells:
+        cell.button_press = True
+    fleet.button_press[:] = True
+    tick() # go to sleep
+
+    # Check that every field matches exactly
+    for name in ['voltage', 'current', 'temp_voltage', 'soc']:
+        if list(getattr(fleet, name)) != [getattr(cell, name) for cell in cells]:
+            report_failure(f"Fleet {name} does not match")
+            return
+    if list(fleet.states()) != [cell.state for cell in cells]:
+        report_failure("Incorrect state")
+        return
+    if any(cell.state != 'sleep' for cell in cells):
+        report_failure("Incorrect state")
+        return
+
+    print("\nTest 6 Passed\n")
+
+
+def run_test7(clock=None):
+    # Test 7 : events go to a RingBufferSink as codes instead of being printed
+    # deep_sleep => run_tests => idle => normal operation with an overvoltage reading
+    clock = clock if clock is not None else RealClock()
+    print("Test 7 \n")
+    clock.sleep(0.5)
+    sink = RingBufferSink(size=4)
+    bms7 = BMS(clock, events=sink)
+
+    print("\nThis test checks that a quiet BMS records its events (and the readings at the time) in a ring buffer\n")
+    clock.sleep(2)
+
+    print("Starting BMS Simulation...\n")
+
+    bms7.button_pressed_5_sec()  # Simulate start-up, transition to run_tests
+    bms7.enter_run_tests()  # Transition to idle
+    bms7.pedal_press = True
+    bms7.enter_idle() # Transition to normal operation
+
+    if (bms7.state != 'normal_operation'):
+        report_failure("Incorrect state")
+        return
+
+    bms7.voltage = 4.1 # Simulate overvoltage reading
+    bms7.fault_check()
+
+    # Run tests, tests passed, idle, pedal pressed, potential overvoltage: the oldest event has been overwritten
+    records = sink.records()
+    if sink.count != 5 or len(records) != 4:
+        report_failure("Incorrect number of events")
+        return
+    if list(records['code']) != [events.TESTS_PASSED, events.ENTER_IDLE, events.PEDAL_PRESSED, events.POTENTIAL_OVERVOLTAGE]:
+        report_failure("Incorrect events")
+        return
+    if records['voltage'][-1] != 4.1 or records['state'][-1] != STATE_CODES['normal_operation']:
+        report_failure("Incorrect event readings")
+        return
+
+    print("\nTest 7 Passed\n")
+
+
+def run_test8(clock=None):
+    # Test 8 : cell profiles loaded from a file are shared and used by the fault checks of BMS and BMSFleet
+    clock = clock if clock is not None else RealClock()
+    print("Test 8 \n")
+    clock.sleep(0.5)
+
+    print("\nThis test loads a cell profile with a lower overvoltage limit and checks a mixed fleet against it\n")
+    clock.sleep(2)
+
+    # Same limits as Li4P25RT except for a 3.9 V overvoltage warning
+    fields = {field: getattr(LI4P25RT, field) for field in profiles.FIELDS}
+    fields['name'] = 'low_voltage_cell'
+    fields['overvoltage_warning'] = 3.9
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'low_voltage_cell.json')
+        with open(path, 'w') as file:
+            json.dump(fields, file)
+        profile = load_profile(path)
+        if load_profile(path) is not profile or intern_profile(CellProfile(**fields)) is not profile:
+            report_failure("Profile is not shared")
+            return
+
+        # Limits out of order are rejected: a fatal limit inside its warning limit, crossed under/over limits
+        for field, value in (('overcurrent_fatal', 105), ('undervoltage_warning', 4.1), ('undertemperature_fatal', 2.0)):
+            path = os.path.join(directory, f'bad_{field}.json')
+            with open(path, 'w') as file:
+                json.dump(dict(fields, name='bad_cell', **{field: value}), file)
+            try:
+                load_profile(path)
+            except ValueError:
+                continue
+            report_failure("Profile out of order accepted")
+            return
+
+    bms8 = BMS(clock, events=NullSink(), profile=profile)
+    bms8_default = BMS(clock, events=NullSink())
+    bms8.voltage = bms8_default.voltage = 3.95
+    if not bms8.fault_check() or bms8_default.fault_check():
+        report_failure("Incorrect fault check")
+        return
+
+    # Cells 0 and 2 are Li4P25RT, cells 1 and 3 use the loaded profile
+    fleet = BMSFleet(4, profiles=[LI4P25RT, profile], profile_index=[0, 1, 0, 1])
+    fleet.voltage[:] = 3.95
+    fleet.temp_voltage[:] = 1.86
+    if list(fleet.fault_check()) != [False, True, False, True]:
+        report_failure("Incorrect fleet fault check")
+        return
+
+    print("\nTest 8 Passed\n")
+
+
+def run_test9(clock=None):
+    # Test 9 : SOC follows the current drawn (coulomb counting) and is corrected from the OCV in sleep
+    clock = clock if clock is not None else RealClock()
+    print("Test 9 \n")
+    clock.sleep(0.5)
+    bms9 = BMS(clock, events=NullSink())
+
+    print("\nThis test draws 1C for 6 minutes, then checks the SOC correction from a 3.72 V rest voltage\n")
+    clock.sleep(2)
+
+    # 10.2 A from a 10.2 Ah cell for 360 one second samples uses 10% SOC
+    bms9.sample_period = 1.0
+    bms9.current = LI4P25RT.capacity
+    for _ in range(360):
+        bms9.simulate_soc()
+    if abs(bms9.soc - 90) > 1e-9:
+        report_failure("Incorrect SOC after discharge")
+        return
+
+    # 3.72 V at rest is 50% on the OCV curve
+    bms9.state = 'sleep'
+    bms9.voltage = 3.72
+    bms9.enter_sleep()
+    if abs(bms9.soc - 50) > 1e-6 or bms9.ocv != 3.72:
+        report_failure("Incorrect SOC after OCV correction")
+        return
+
+    print("\nTest 9 Passed\n")
+
+
+def run_test10(clock=None):
+    # Test 10 : async runtime driven by a stream of sensor samples and inputs, many BMS on one event loop
+    # deep_sleep => run_tests => idle => normal operation => fault operating => normal operation => sleep => charging => sleep
+    # (the runtime waits on the event loop, so this test takes about a second whatever the clock)
+    clock = clock if clock is not None else RealClock()
+    print("Test 10 \n")
+    clock.sleep(0.5)
+
+    print("\nThis test replays the same sensor stream into 100 BMS running concurrently on one event loop\n")
+    clock.sleep(2)
+
+    print("Starting BMS Simulation...\n")
+
+    periods = {'normal_operation': 0.005, 'fault_operating': 0.005, 'charging': 0.001}
+
+    async def stream(runtime):
+        yield Input('button_pressed_5_sec', True) # start up, tests pass
+        yield Sample(3.7, 0, 1.86)
+        yield Input('pedal_press', True)
+        for _ in range(5):
+            yield Sample(3.7, 20, 1.86)
+            await asyncio.sleep(0.01)
+        yield Sample(4.1, 20, 1.86) # overvoltage
+        await asyncio.sleep(0.02)
+        yield Sample(3.7, 20, 1.86) # fault clears
+        await asyncio.sleep(0.02)
+        yield Input('button_press', True) # go to sleep
+        yield Sample(3.72, 0, 1.86) # resting voltage, 50% SOC
+        await asyncio.sleep(0.05) # wait for an OCV measurement
+        yield Input('charger_plugged_in', True)
+        yield Sample(4.2, 0, 1.86)
+        # charge to 100% (about 0.2 s, more on a loaded machine)
+        deadline = asyncio.get_running_loop().time() + 10
+        while runtime.bms.soc != 100 and asyncio.get_running_loop().time() < deadline:
+            await asyncio.sleep(0.01)
+
+    sinks = [RingBufferSink(size=512) for _ in range(100)]
+    clocks = [VirtualClock() for _ in sinks]
+    runtimes = [BMSRuntime(BMS(clock, events=sink), periods=periods, ocv_first_interval=0.01) for clock, sink in zip(clocks, sinks)]
+    asyncio.run(run_all(runtimes, [stream(runtime) for runtime in runtimes]))
+
+    expected = [events.ENTER_FAULT_OPERATING, events.NO_MORE_FAULTS, events.BUTTON_TO_SLEEP, events.CHARGER_IN]
+    for runtime, sink in zip(runtimes, sinks):
+        codes = [code for code in sink.records()['code'] if code in expected]
+        if codes != expected:
+            report_failure("Incorrect events")
+            return
+        if runtime.bms.state != 'sleep' or runtime.bms.soc != 100:
+            report_failure("Incorrect state")
+            return
+    # The runtime leaves the BMS with its own clock and simulated readings
+    if any(runtime.bms.clock is not clock or not runtime.bms.simulated for runtime, clock in zip(runtimes, clocks)):
+        report_failure("Clock not restored")
+        return
+
+    # A misspelt input name is reported as such
+    async def misspelt():
+        yield Input('charger_plugged', True)
+    try:
+        asyncio.run(BMSRuntime(BMS(VirtualClock(), events=NullSink())).run(misspelt()))
+    except ValueError as error:
+        if 'charger_plugged' not in str(error):
+            report_failure("Unclear input error")
+            return
+    else:
+        report_failure("Unknown input accepted")
+        return
+
+    # Button and charger together in sleep: one transition per step, the button first
+    bms = BMS(VirtualClock(), events=NullSink())
+    bms.state = 'sleep'
+    bms.step()
+    bms.button_press = bms.charger_plugged_in = True
+    bms.step()
+    if bms.state != 'idle':
+        report_failure("Incorrect sleep inputs")
+        return
+
+    print("\nTest 10 Passed\n")
+
+
+def run_test11(clock=None):
+    # Test 11 : a pack stepped by worker processes over shared memory gives the same results as in one process
+    # deep_sleep => run_tests => idle => normal operation (pedal pressed) => fault operating / fatal
+    clock = clock if clock is not None else RealClock()
+    print("Test 11 \n")
+    clock.sleep(0.5)
+
+    print("\nThis test steps the same pack with 2 worker processes and in this process and checks that they match\n")
+
+    def simulate(workers):
+        with ParallelPack(1000, seed=11, shards=8, workers=workers) as pack:
+            pack.fire('button_pressed_5_sec')
+            pack.run(2) # run_tests => idle
+            pack.cells['pedal_press'][:] = True
+            results = [pack.step() for _ in range(20)]
+            return results, {name: array.copy() for name, array in pack.cells.items()}
+
+    results, cells = simulate(2)
+    local_results, local_cells = simulate(0)
+
+    if results != local_results:
+        report_failure("Pack results differ")
+        return
+    for name, array in cells.items():
+        if not np.array_equal(array, local_cells[name]):
+            report_failure(f"Cell {name} differs")
+            return
+    last = results[-1]
+    if not last['min_voltage'] <= last['max_voltage'] or last['hottest_temp_voltage'] != cells['temp_voltage'].min():
+        report_failure("Incorrect pack results")
+        return
+
+    print("\nTest 11 Passed\n")
+
+
+def run_test12(clock=None):
+    # Test 12 : seeded noise streams, a run replays exactly from its seed and a fleet matches BMS sharing a stream
+    # deep_sleep => run_tests => idle => normal operation (pedal pressed, then released)
+    clock = clock if clock is not None else RealClock()
+    print("Test 12 \n")
+    clock.sleep(0.5)
+
+    print("\nThis test runs BMS with a seeded NoiseStream twice and against a fleet with the same stream\n")
+
+    def simulate(seed, n=10):
+        random.seed() # the global random module must not matter
+        noise = NoiseStream(seed, block=7)
+        cells = [BMS(clock, events=NullSink(), noise=noise) for _ in range(n)]
+        for cell in cells:
+            cell.button_pressed_5_sec()
+        for tick in range(20):
+            for cell in cells:
+                cell.pedal_press = tick < 10
+                getattr(cell, 'enter_' + cell.state)()
+        return cells
+
+    cells = simulate(12)
+    replay = simulate(12)
+    fields = ['voltage', 'current', 'temp_voltage', 'soc', 'state']
+    if [[getattr(cell, name) for name in fields] for cell in cells] != [[getattr(cell, name) for name in fields] for cell in replay]:
+        report_failure("Replay from the seed does not match")
+        return
+
+    fleet = BMSFleet(len(cells), noise=NoiseStream(12, block=1000))
+    fleet.fire('button_pressed_5_sec')
+    for tick in range(20):
+        fleet.pedal_press[:] = tick < 10
+        fleet.step()
+    for name in ['voltage', 'current', 'temp_voltage', 'soc']:
+        if list(getattr(fleet, name)) != [getattr(cell, name) for cell in cells]:
+            report_failure(f"Fleet {name} does not match")
+            return
+    if list(fleet.states()) != [cell.state for cell in cells]:
+        report_failure("Incorrect state")
+        return
+
+    print("\nTest 12 Passed\n")
+
+
+def run_test13(clock=None):
+    # Test 13 : record a sensor trace of 3 packs and replay it through BMS objects and a fleet
+    # deep_sleep => run_tests => idle => normal operation, then per pack:
+    # 0: stays in normal operation, 1: fault operating => deep sleep (fatal overvoltage), 2: sleep => charging
+    clock = clock if clock is not None else RealClock()
+    print("Test 13 \n")
+    clock.sleep(0.5)
+
+    print("\nThis test writes a trace file, replays it from a memory map and checks the transition logs\n")
+
+    with tempfile.TemporaryDirectory() as directory:
+        trace_path = os.path.join(directory, 'packs.trace')
+        samples = BMSFleet(3) # only used to hold the readings and inputs of each sample
+        with TraceRecorder(trace_path, packs=3) as recorder:
+            for tick in range(30):
+                samples.voltage[:] = 3.6
+                samples.current[:] = 1.0
+                samples.temp_voltage[:] = 1.86
+                samples.pedal_press[:] = tick > 0
+                if tick >= 10:
+                    samples.voltage[1] = 4.1 # overvoltage warning
+                if tick >= 20:
+                    samples.voltage[1] = 4.3 # fatal overvoltage
+                samples.button_press[2] = tick == 15
+                samples.charger_plugged_in[2] = tick >= 25
+                trigger = np.full(3, TRIGGER_CODES['button_pressed_5_sec'] if tick == 0 else -1)
+                recorder.record_fleet(samples, tick * 0.1, trigger)
+
+        trace = open_trace(trace_path)
+        if trace.shape != (30, 3):
+            report_failure("Incorrect trace shape")
+            return
+
+        expected = ['normal_operation', 'deep_sleep', 'charging']
+        with TransitionLog(os.path.join(directory, 'fleet.log')) as log:
+            fleet = replay_fleet(trace, log=log)
+        if list(fleet.states()) != expected:
+            report_failure("Incorrect fleet state")
+            return
+
+        for pack, state in enumerate(expected):
+            bms = BMS(clock, events=NullSink())
+            with TransitionLog(os.path.join(directory, f'pack{pack}.log')) as log:
+                replay(trace, bms, log=log, pack=pack)
+            if bms.clock is not clock or not bms.simulated:
+                report_failure("Clock or simulated not restored")
+                return
+            if bms.state != state:
+                report_failure("Incorrect state")
+                return
+
+        fatal = (STATE_CODES['fault_operating'], STATE_CODES['deep_sleep'])
+        for name in ['fleet.log', 'pack1.log']:
+            transitions = open_transition_log(os.path.join(directory, name))
+            if fatal not in zip(transitions['source'].tolist(), transitions['dest'].tolist()):
+                report_failure("Missing transition in the log")
+                return
+
+    print("\nTest 13 Passed\n")
+
+
+def run_test14(clock=None):
+    # Test 14 : transition history, state residency and transition counters
+    # deep_sleep => run_tests => idle => normal operation => sleep => idle => normal operation => sleep
+    clock = clock if clock is not None else RealClock()
+    print("Test 14 \n")
+    clock.sleep(0.5)
+    # Exact residencies: the BMS runs on its own virtual clock whatever clock the tests use
+    virtual = VirtualClock()
+    bms14 = BMS(virtual, events=NullSink(), noise=NoiseStream(14))
+    history = attach_history(bms14, size=4)
+
+    print("\nThis test checks the recorded transitions instead of polling the state\n")
+
+    start = virtual.time()
+    bms14.button_pressed_5_sec()
+    bms14.enter_run_tests()
+    for _ in range(2): # drive twice, sleeping in between
+        bms14.pedal_press = True
+        bms14.enter_idle()
+        for _ in range(5):
+            virtual.sleep(0.1)
+            bms14.enter_normal_operation()
+        bms14.pedal_press = False
+        bms14.button_press = True
+        bms14.enter_normal_operation()
+        bms14.button_press = False
+        virtual.sleep(1)
+        bms14.button_pressed() # back to idle
+    bms14.button_press = True
+    bms14.enter_idle()
+    now = virtual.time()
+
+    # Only the last 4 of the 9 transitions are kept
+    records = history.records()
+    names = [(STATES[source], STATES[dest]) for source, dest in zip(records['source'].tolist(), records['dest'].tolist())]
+    if history.count != 9 or names != [('idle', 'normal_operation'), ('normal_operation', 'sleep'), ('sleep', 'idle'), ('idle', 'sleep')]:
+        report_failure("Incorrect history")
+        return
+    counts = history.transition_counts()
+    if counts[('pedal_pressed', 'idle', 'normal_operation')] != 2 or counts[('button_pressed', 'sleep', 'idle')] != 2:
+        report_failure("Incorrect transition counts")
+        return
+    residency = history.residency(now)
+    if abs(sum(residency.values()) - (now - start)) > 1e-9 or abs(residency['normal_operation'] - 1.0) > 1e-9:
+        report_failure("Incorrect residency")
+        return
+    text = history.prometheus(now, {'bms': '14'})
+    if 'bms_state{state="sleep",bms="14"} 1' not in text.splitlines():
+        report_failure("Incorrect Prometheus text")
+        return
+
+    detach_history(bms14)
+    bms14.button_pressed()
+    if history.count != 9:
+        report_failure("History recorded while detached")
+        return
+
+    print("\nTest 14 Passed\n")
+
+
+def run_test15(clock=None):
+    # Test 15 : Monte-Carlo batches of the declarative scenarios of tests 1 to 5 on virtual time
+    clock = clock if clock is not None else RealClock()
+    print("Test 15 \n")
+    clock.sleep(0.5)
+
+    print("\nThis test runs 1000 seeded runs of every scenario and checks the statistics\n")
+
+    for scenario in SCENARIOS:
+        result = run_scenario(scenario, runs=1000, seed=15, batch=256)
+        print(f"{scenario.name}: {result['pass_rate']:.1%} passed in {result['elapsed_s']:.2f} s")
+        if result['pass_rate'] != 1.0:
+            report_failure("Scenario failed")
+            return
+
+    fatal = [scenario for scenario in SCENARIOS if scenario.name == 'drive_to_fatal'][0]
+    result = run_scenario(fatal, runs=1000, seed=15, batch=256)
+    if result['reached']['fault_operating'] != 1.0 or result['time_to_fatal_s']['count'] != 1000:
+        report_failure("Incorrect fault statistics")
+        return
+
+    # The same runs spread over worker processes
+    parallel = run_scenario(fatal, runs=1000, seed=15, batch=256, workers=2)
+    del result['elapsed_s'], parallel['elapsed_s']
+    if parallel != result:
+        report_failure("Results depend on the workers")
+        return
+
+    print("\nTest 15 Passed\n")
+
+
+def run_test16(clock=None):
+    # Test 16 : tick driven step() of every state, 300 BMS interleaved one control period at a time
+    # deep_sleep => run_tests => idle => normal operation => fault operating => deep sleep (fatal), or
+    # => sleep => charging => sleep for the BMS whose button is pressed
+    clock = clock if clock is not None else RealClock()
+    print("Test 16 \n")
+    clock.sleep(0.5)
+
+    print("\nThis test steps BMS objects round robin and checks them against a fleet with the same noise\n")
+
+    n = 300
+    noise = NoiseStream(16)
+    cells = [BMS(clock, events=NullSink(), noise=noise) for _ in range(n)]
+    fleet = BMSFleet(n, noise=NoiseStream(16))
+    button = np.arange(n) % 2 == 0 # half of them go to sleep before the fatal fault
+
+    for cell in cells:
+        cell.button_pressed_5_sec()
+    fleet.fire('button_pressed_5_sec')
+    for tick in range(200):
+        if tick == 2:
+            for cell in cells:
+                cell.pedal_press = True
+            fleet.pedal_press[:] = True
+        if tick == 10:
+            for cell, pressed in zip(cells, button):
+                cell.button_press = bool(pressed)
+            fleet.button_press[:] = button
+        if tick == 12:
+            for cell, plugged in zip(cells, button):
+                cell.charger_plugged_in = bool(plugged)
+            fleet.charger_plugged_in[:] = button
+        for cell in cells:
+            cell.step() # returns after one control period whatever the state
+        fleet.step()
+        clock.sleep(0.1)
+
+    for name in ['voltage', 'current', 'temp_voltage', 'soc']:
+        if list(getattr(fleet, name)) != [getattr(cell, name) for cell in cells]:
+            report_failure(f"Fleet {name} does not match")
+            return
+    states = [cell.state for cell in cells]
+    if states != list(fleet.states()) or set(states) != {'sleep', 'deep_sleep'}:
+        report_failure("Incorrect state")
+        return
+
+    # Inputs set after entering sleep: nothing, button (=> idle), charger (=> charging), both (button first)
+    inputs = [(False, False), (True, False), (False, True), (True, True)]
+    cells = [BMS(clock, events=NullSink()) for _ in inputs]
+    fleet = BMSFleet(len(cells))
+    fleet.state[:] = STATE_CODES['sleep']
+    fleet.voltage[:] = 3.7
+    for cell in cells:
+        cell.state = 'sleep'
+        cell.voltage = 3.7
+    for tick in range(2):
+        if tick == 1:
+            for i, (button, charger) in enumerate(inputs):
+                cells[i].button_press = fleet.button_press[i] = button
+                cells[i].charger_plugged_in = fleet.charger_plugged_in[i] = charger
+        for cell in cells:
+            cell.step()
+        fleet.step()
+        if list(fleet.states()) != [cell.state for cell in cells] \
+                or list(fleet.soc) != [cell.soc for cell in cells]:
+            report_failure("Incorrect sleep inputs")
+            return
+    if [cell.state for cell in cells] != ['sleep', 'idle', 'charging', 'idle']:
+        report_failure("Incorrect sleep inputs")
+        return
+
+    print("\nTest 16 Passed\n")
+
+
+def run_test17(clock=None):
+    # Test 17 : fast-forward of charging and discharge to storage gives the same end as stepping through them
+    # sleep => charging => sleep, sleep => discharge to storage => deep sleep
+    clock = clock if clock is not None else RealClock()
+    print("Test 17 \n")
+    clock.sleep(0.5)
+
+    print("\nThis test compares fast_forward with enter_charging/enter_discharge_to_storage on virtual clocks\n")
+
+    for state in ['charging', 'discharge_to_storage']:
+        for soc in [12.25, 49.9, 50, 73.123456, 100]:
+            stepped = BMS(VirtualClock(), events=NullSink())
+            skipped = BMS(VirtualClock(), events=NullSink())
+            levels = []
+            for bms in (stepped, skipped):
+                bms.soc = soc
+                bms.state = state
+                bms.charger_plugged_in = state == 'charging'
+            while stepped.state == state:
+                getattr(stepped, 'step_' + state)()
+                levels.append(stepped.soc)
+                stepped.clock.sleep(0.2)
+
+            seconds, (times, samples) = skipped.fast_forward(resolution=0.2)
+            if (skipped.state, skipped.soc, skipped.voltage, skipped.charger_plugged_in) != \
+               (stepped.state, stepped.soc, stepped.voltage, stepped.charger_plugged_in):
+                report_failure("Incorrect end of phase")
+                return
+            if abs(skipped.clock.time() - stepped.clock.time()) > 1e-6 or abs(seconds - 0.2 * len(levels)) > 1e-9:
+                report_failure("Incorrect phase duration")
+                return
+            if len(samples) != len(levels) or np.abs(samples - levels).max() > 1e-9:
+                report_failure("Incorrect samples")
+                return
+
+    # A fleet ticking every 0.1 s steps its phases every 0.2 s, taking as long as fast_forward
+    for state in ['charging', 'discharge_to_storage']:
+        bms = BMS(VirtualClock(), events=NullSink())
+        bms.soc = 60
+        bms.state = state
+        seconds, samples = bms.fast_forward()
+        fleet = BMSFleet(1)
+        fleet.soc[:] = 60
+        fleet.state[:] = STATE_CODES[state]
+        ticks = 0
+        while fleet.state[0] == STATE_CODES[state] and ticks < 1000:
+            fleet.step()
+            ticks += 1
+        if fleet.soc[0] != bms.soc or abs(ticks * fleet.sample_period - seconds) > 0.2 + 1e-9:
+            report_failure("Fleet phase duration differs")
+            return
+
+    # A phase entered through step() is not entered again by fast_forward
+    for state, code in [('charging', events.ENTER_CHARGING), ('discharge_to_storage', events.ENTER_DISCHARGE_TO_STORAGE)]:
+        sink = RingBufferSink()
+        bms = BMS(VirtualClock(), events=sink)
+        bms.soc = 70
+        bms.state = state
+        bms.step()
+        bms.fast_forward()
+        if list(sink.records()['code']).count(code) != 1:
+            report_failure("Phase entered twice")
+            return
+
+    print("\nTest 17 Passed\n")
+
+
+def run_test18(clock=None):
+    # Test 18 : equivalent circuit cell model in place of the random walk, BMS and fleet
+    # deep_sleep => run_tests => idle => normal operation (driving at 40 A) => sleep (SOC below 4%), one BMS stays idle
+    clock = clock if clock is not None else RealClock()
+    print("Test 18 \n")
+    clock.sleep(0.5)
+
+    print("\nThis test drives cells with a Thevenin model until they are empty and checks the readings\n")
+
+    n = 4
+    cells = [BMS(VirtualClock(), events=NullSink()) for _ in range(n)]
+    fleet = BMSFleet(n)
+    fleet.cell_model = TheveninModel(n)
+    for cell in cells:
+        cell.cell_model = TheveninModel()
+        cell.button_pressed_5_sec()
+    fleet.fire('button_pressed_5_sec')
+    pedal = np.array([True, True, False, True])
+
+    voltages = []
+    for tick in range(12000):
+        if tick == 2:
+            for cell, pressed in zip(cells, pedal):
+                cell.pedal_press = bool(pressed)
+            fleet.pedal_press[:] = pedal
+        for cell in cells:
+            cell.step()
+        fleet.step()
+        voltages.append(cells[0].voltage)
+        if tick == 1000 and not (cells[0].current == 40 and cells[0].temperature > 25):
+            report_failure("Incorrect readings")
+            return
+
+    for name in ['voltage', 'current', 'temp_voltage', 'soc']:
+        if np.abs(getattr(fleet, name) - [getattr(cell, name) for cell in cells]).max() > 1e-9:
+            report_failure(f"Fleet {name} does not match")
+            return
+    # The driven cells sagged under load as they emptied and went to sleep below 4% SOC
+    driven = voltages[10:9000]
+    if max(np.diff(driven)) > 1e-3 or not driven[0] > driven[-1] + 0.3:
+        report_failure("Voltage does not follow the SOC")
+        return
+    if [cell.state for cell in cells] != ['sleep', 'sleep', 'idle', 'sleep']:
+        report_failure("Incorrect state")
+        return
+
+    print("\nTest 18 Passed\n")
+
+
+def run_test19(clock=None):
+    # Test 19 : pack of 96 cells, faults of single cells drive the pack, passive balancing in sleep
+    # deep_sleep => run_tests => idle => normal operation => fault operating => deep sleep (one cell fatal)
+    # sleep with unbalanced cells => balanced
+    clock = clock if clock is not None else RealClock()
+    print("Test 19 \n")
+    clock.sleep(0.5)
+
+    print("\nThis test checks pack readings and faults made from the cells, and balancing\n")
+
+    def reductions_match(pack):
+        for name, reduction in pack.reductions.items():
+            values = getattr(pack.cells, name)
+            if reduction.min != values.min() or reduction.max != values.max() or abs(reduction.mean - values.mean()) > 1e-9:
+                return False
+        return True
+
+    pack = Pack(96, clock, events=NullSink(), noise=NoiseStream(19))
+    pack.button_pressed_5_sec()
+    pack.step() # run_tests => idle
+    pack.pedal_press = True
+    for _ in range(3):
+        pack.step()
+    if pack.state != 'normal_operation' or not reductions_match(pack) or abs(pack.voltage - pack.cells.voltage.sum()) > 1e-9:
+        report_failure("Incorrect pack readings")
+        return
+
+    pack.set_cells(40, voltage=4.1) # one cell close to overvoltage
+    pack.step()
+    if pack.state != 'fault_operating' or list(pack.faulty_cells(faults.WARNING_MASK)) != [40]:
+        report_failure("Pack not in fault for one cell")
+        return
+    pack.set_cells(40, voltage=4.3, temp_voltage=1.4)
+    pack.step()
+    if pack.state != 'deep_sleep' or pack.hottest_cell() != 40:
+        report_failure("Pack not shut down by one cell")
+        return
+
+    # Balancing: 3 cells 4% above the others, bled while the pack sleeps
+    soc = np.full(96, 60.0)
+    soc[[3, 50, 90]] = 64.0
+    pack = Pack(96, clock, events=NullSink(), soc=soc)
+    pack.sample_period = 60 # long sleep ticks
+    pack.state = 'sleep'
+    for _ in range(200):
+        pack.step()
+    spread = pack.reductions['soc'].max - pack.reductions['soc'].min
+    changed = np.flatnonzero(pack.cells.soc != 60.0)
+    if not spread <= 0.5 or list(changed) != [3, 50, 90] or not reductions_match(pack) or pack.soc != 60.0:
+        report_failure("Cells not balanced")
+        return
+
+    # Balancing while charging goes on to half the threshold as well, the reductions following the cells
+    pack = Pack(96, clock, events=NullSink(), soc=soc)
+    pack.sample_period = 600
+    pack.state = 'charging'
+    for _ in range(30):
+        pack.step()
+    spread = pack.reductions['soc'].max - pack.reductions['soc'].min
+    if pack.state != 'charging' or not spread <= 0.5 or not reductions_match(pack):
+        report_failure("Cells not balanced while charging")
+        return
+
+    # Per cell debouncing: one overvoltage sample of a cell does not put the pack in fault
+    pack = Pack(96, clock, events=NullSink(), noise=NoiseStream(19))
+    pack.fault_filter = FaultFilter(96)
+    pack.button_pressed_5_sec()
+    pack.step()
+    pack.pedal_press = True
+    pack.step()
+    pack.set_cells(40, voltage=4.1)
+    pack.step()
+    if pack.state != 'normal_operation':
+        report_failure("Pack fault not debounced")
+        return
+    pack.fault_filter = FaultFilter()
+    try:
+        pack.step()
+    except ValueError:
+        pass
+    else:
+        report_failure("Fault filter of the wrong size accepted")
+        return
+    pack = Pack(4, clock, events=NullSink())
+    for name, plugin in (('charge_controller', ChargeController(4)), ('cell_model', TheveninModel(4)),
+                         ('soc_filter', SOCKalmanFilter(np.full(4, 50.0), 10.2, 0.0054))):
+        try:
+            setattr(pack, name, plugin)
+        except AttributeError:
+            continue
+        report_failure(f"{name} accepted by a pack")
+        return
+
+    # A cell listed twice is counted once
+    pack = Pack(96, clock, events=NullSink())
+    pack.set_cells([1, 1, 2], voltage=3.9)
+    if not reductions_match(pack) or abs(pack.voltage - (2 * 3.9 + 94 * float(pack.cells.voltage[0]))) > 1e-6:
+        report_failure("Duplicate cells counted twice")
+        return
+
+    print("\nTest 19 Passed\n")
+
+
+def run_test20(clock=None):
+    # Test 20 : columnar telemetry of a BMS (through its event sink) and of a fleet, written by a background thread
+    # deep_sleep => run_tests => idle => normal operation => fault operating => deep sleep (fatal)
+    clock = clock if clock is not None else RealClock()
+    print("Test 20 \n")
+    clock.sleep(0.5)
+
+    print("\nThis test records drive cycles as telemetry chunks and reads them back\n")
+
+    with tempfile.TemporaryDirectory() as directory:
+        # Every format that can be written here, the pyarrow ones are skipped without pyarrow
+        formats = ['npz', 'parquet', 'arrow'] if telemetry.pyarrow is not None else ['npz']
+        if telemetry.pyarrow is None:
+            print("pyarrow not installed, parquet and arrow round-trips skipped")
+        for format in formats:
+            ring = RingBufferSink(size=65536)
+            with TelemetryWriter(os.path.join(directory, format), format=format, chunk=4, chunks=2) as writer:
+                bms = BMS(VirtualClock())
+                history = attach_history(bms)
+                attach_telemetry(bms, writer, instance=7, forward=ring)
+                bms.button_pressed_5_sec()
+                bms.pedal_press = True
+                bms.step()
+                while bms.state != 'deep_sleep':
+                    bms.step()
+                    bms.clock.sleep(bms.sample_period)
+            samples = read_telemetry(os.path.join(directory, format))
+            transitions = read_telemetry(os.path.join(directory, format), 'transitions')
+            events_recorded = ring.records()
+            measured = events_recorded[events_recorded['code'] == events.MEASUREMENT]
+            if len(samples) != len(measured) or len(samples) <= 4 or set(samples['instance']) != {7}:
+                report_failure(f"Incorrect number of samples ({format})")
+                return
+            if np.abs(samples['voltage'] - measured['voltage']).max() > 1e-6 or \
+               list(samples['timestamp']) != list(measured['timestamp']):
+                report_failure(f"Incorrect samples ({format})")
+                return
+            expected = ['run_tests', 'idle', 'normal_operation', 'fault_operating', 'deep_sleep']
+            if [STATES[code] for code in transitions['dest']] != expected or set(transitions['instance']) != {7}:
+                report_failure(f"Incorrect transitions ({format})")
+                return
+            # The transition history attached before the telemetry keeps recording behind the sink
+            if history.count != len(expected) or bms.history.history is not history or \
+               [STATES[code] for code in history.dests[:history.count]] != expected:
+                report_failure("Transition history not kept")
+                return
+
+        # A CompactBMS row has no transition history to record from, and its store is left as it was
+        store = BMSStore(1, VirtualClock(), NullSink())
+        try:
+            with TelemetryWriter(os.path.join(directory, 'compact'), format='npz') as writer:
+                attach_telemetry(store.new(), writer)
+        except TelemetryError:
+            pass
+        else:
+            report_failure("Telemetry attached to a CompactBMS")
+            return
+        if not isinstance(store.events, NullSink):
+            report_failure("Store events replaced")
+            return
+
+        # Fleet: chunks smaller than one tick of the fleet
+        n = 100
+        fleet = BMSFleet(n, noise=NoiseStream(20))
+        fleet.fire('button_pressed_5_sec')
+        fleet.pedal_press[:] = True
+        changes = 0
+        with TelemetryWriter(os.path.join(directory, 'fleet'), chunk=64, chunks=2) as writer:
+            for tick in range(100):
+                previous = fleet.state.copy()
+                fleet.step()
+                if tick > 0:
+                    changes += int((fleet.state != previous).sum())
+                writer.record_fleet(fleet, tick * 0.1)
+        samples = read_telemetry(os.path.join(directory, 'fleet'))
+        transitions = read_telemetry(os.path.join(directory, 'fleet'), 'transitions')
+        last = samples[-n:]
+        if len(samples) != 100 * n or list(last['instance']) != list(range(n)) or \
+           not np.array_equal(last['soc'], fleet.soc.astype(np.float32)) or list(last['state']) != list(fleet.state):
+            report_failure("Incorrect fleet samples")
+            return
+        if len(transitions) != changes or changes == 0:
+            report_failure("Incorrect fleet transitions")
+            return
+
+    print("\nTest 20 Passed\n")
+
+
+def run_test21(clock=None):
+    # Test 21 : reachability and safety analysis of the state machine, cached by the hash of the graph
+    clock = clock if clock is not None else RealClock()
+    print("Test 21 \n")
+    clock.sleep(0.5)
+
+    print("\nThis test analyses the transition graph over the sensor regions and checks the known gaps\n")
+
+    with tempfile.TemporaryDirectory() as cache:
+        report = analyze(cache=cache)
+        if report['cached'] or report['reachable'] != STATES or report['traps'] or report['dead_ends']:
+            report_failure("Incorrect reachability")
+            return
+        if report['unreachable_transitions'] or report['invariants']['fatal_fault_can_reach_deep_sleep']:
+            report_failure("Incorrect transitions")
+            return
+        # Exactly the known gaps: a fatal fault while charging shuts the BMS down, idle/sleep never check for faults
+        if report['invariants']['fatal_fault_shuts_down'] != ['run_tests', 'idle', 'normal_operation', 'sleep'] or \
+           set(KNOWN_GAPS) != set(report['invariants']['fatal_fault_shuts_down']):
+            report_failure("Incorrect invariant violations")
+            return
+        # No step fires a trigger the state it got to has no transition for, so the analysis passes
+        if report['step_errors'] or problems(report):
+            report_failure("Analysis does not pass")
+            return
+        if problems(report, dict(KNOWN_GAPS, charging="")) != ["known gap of fatal_fault_shuts_down in charging not seen"]:
+            report_failure("Stale known gap not reported")
+            return
+
+        cached = analyze(cache=cache)
+        if not cached['cached'] or dict(cached, cached=False) != report:
+            report_failure("Report not cached")
+            return
+        changed = TRANSITIONS + [('fatal_fault_detected', 'sleep', 'deep_sleep')]
+        if graph_hash(transitions=changed) == report['hash']:
+            report_failure("Hash does not depend on the transitions")
+            return
+
+    print("\nTest 21 Passed\n")
+
+
+def run_test22(clock=None):
+    # Test 22 : hysteresis and debouncing of the fault checks, voltage sitting on the 4.0 V warning limit
+    # normal operation => fault operating => normal operation once (instead of every sample), BMS and fleet
+    clock = clock if clock is not None else RealClock()
+    print("Test 22 \n")
+    clock.sleep(0.5)
+
+    print("\nThis test holds the voltage around the overvoltage warning limit and counts the transitions\n")
+
+    def flaps(fault_filter):
+        bms = BMS(VirtualClock(), events=NullSink())
+        bms.simulated = False
+        bms.fault_filter = fault_filter
+        bms.state = 'normal_operation'
+        history = attach_history(bms)
+        for tick in range(120):
+            bms.voltage = 3.8 if tick >= 100 else (4.01 if tick % 2 else 3.99)
+            bms.current = 10
+            bms.step()
+            bms.clock.sleep(bms.sample_period)
+        return bms, history.count
+
+    bms, count = flaps(None)
+    if count < 50:
+        report_failure("Raw fault checks did not flap")
+        return
+    bms, count = flaps(FaultFilter())
+    if count != 2 or bms.state != 'normal_operation':
+        report_failure(f"Incorrect filtered transitions ({count})")
+        return
+    window = bms.fault_filter.windows['voltage']
+    if (window.min, window.max, abs(window.mean - 3.8) < 1e-12) != (3.8, 3.8, True):
+        report_failure("Incorrect rolling window")
+        return
+
+    # Fleet with one filter for all instances against BMS with one filter each, readings from 3.9 to 4.25 V
+    n = 50
+    rng = np.random.default_rng(22)
+    fleet = BMSFleet(n)
+    fleet.simulated = False
+    fleet.fault_filter = FaultFilter(n)
+    fleet.state[:] = STATE_CODES['normal_operation']
+    cells = []
+    for _ in range(n):
+        cell = BMS(VirtualClock(), events=NullSink())
+        cell.simulated = False
+        cell.fault_filter = FaultFilter()
+        cell.state = 'normal_operation'
+        cells.append(cell)
+    for tick in range(200):
+        voltage = rng.uniform(3.9, 4.25, n)
+        fleet.voltage[:] = voltage
+        fleet.current[:] = 10
+        for cell, value in zip(cells, voltage):
+            cell.voltage = float(value)
+            cell.current = 10
+            cell.step()
+        fleet.step()
+        if list(fleet.states()) != [cell.state for cell in cells]:
+            report_failure("Fleet does not match the BMS")
+            return
+    means = fleet.fault_filter.windows['voltage'].mean
+    if not np.allclose(means, [cell.fault_filter.windows['voltage'].mean for cell in cells]):
+        report_failure("Incorrect fleet windows")
+        return
+
+    print("\nTest 22 Passed\n")
+
+
+def run_test23(clock=None):
+    # Test 23 : OCV measurements of parked sleeping BMS with exponential backoff, woken by their inputs
+    # sleep => idle (button), sleep => charging (charger), the others stay parked
+    clock = clock if clock is not None else RealClock()
+    print("Test 23 \n")
+    clock.sleep(0.5)
+
+    print("\nThis test parks sleeping BMS and fleet instances for an hour and checks the measurements\n")
+
+    # Measurements at 0.5, 1.5, 3.5, 7.5... s after parking (the interval doubling from 0.5 s)
+    expected = 0
+    due = interval = 0.5
+    while due <= 3600:
+        expected += 1
+        interval *= 2
+        due += interval
+
+    virtual = VirtualClock()
+    cells = [BMS(virtual, events=NullSink()) for _ in range(200)]
+    scheduler = OCVScheduler(virtual)
+    for cell in cells:
+        cell.state = 'sleep'
+        cell.voltage = 3.7
+        scheduler.park(cell)
+    measurements = 0
+    while virtual.time() < 3600:
+        virtual.sleep(1)
+        measurements += scheduler.run_due()
+    if measurements != expected * len(cells) or scheduler.next_due() <= virtual.time():
+        report_failure("Incorrect number of measurements")
+        return
+
+    cells[0].button_press = True
+    cells[1].charger_plugged_in = True
+    for cell in cells[:3]:
+        scheduler.wake(cell)
+    if (cells[0].state, cells[1].state, cells[2].state, len(scheduler)) != ('idle', 'charging', 'sleep', 198):
+        report_failure("Incorrect wake up")
+        return
+    if scheduler.next_due() != virtual.time() + 0.5: # backoff of the BMS still sleeping starts again
+        report_failure("Backoff not reset")
+        return
+
+    # Button and charger at once: the button wins, one transition only; a BMS stepped out of sleep elsewhere is
+    # dropped without a measurement
+    cells[3].button_press = True
+    cells[3].charger_plugged_in = True
+    scheduler.wake(cells[3])
+    cells[4].charger_plugged_in = True
+    cells[4].step()
+    ocv = cells[4].ocv
+    cells[4].voltage = 3.9
+    virtual.sleep(OCV_MAX_INTERVAL)
+    scheduler.run_due()
+    if (cells[3].state, cells[4].state, cells[4].ocv, len(scheduler)) != ('idle', 'charging', ocv, 196):
+        report_failure("Incorrect inputs of parked BMS")
+        return
+
+    # Fleet of 100000 parked instances, only touched when a batch is due
+    n = 100000
+    fleet = BMSFleet(n)
+    fleet.state[:] = STATE_CODES['sleep']
+    fleet.voltage[:] = 3.7
+    virtual = VirtualClock()
+    scheduler = FleetOCVScheduler(fleet, virtual)
+    scheduler.park()
+    measurements = 0
+    while virtual.time() < 3600:
+        virtual.sleep(1)
+        measurements += scheduler.run_due()
+    if measurements != expected * n or np.abs(fleet.ocv - 3.7).max() > 0:
+        report_failure("Incorrect fleet measurements")
+        return
+    fleet.button_press[:100] = True
+    woken = np.zeros(n, dtype=bool)
+    woken[:200] = True
+    scheduler.wake(woken)
+    if len(scheduler) != n - 100 or list(np.flatnonzero(fleet.state != STATE_CODES['sleep'])) != list(range(100)):
+        report_failure("Incorrect fleet wake up")
+        return
+
+    # Same inputs through the scheduler and through fleet.step(), the parked instances it takes out of sleep are
+    # dropped when they come up
+    fleet.button_press[100:110] = True
+    fleet.charger_plugged_in[100:120] = True
+    woken[:] = False
+    woken[100:110] = True
+    scheduler.wake(woken)
+    fleet.button_press[:] = False # released, idle would go back to sleep
+    fleet.step()
+    virtual.sleep(OCV_MAX_INTERVAL)
+    scheduler.run_due()
+    if list(fleet.state[100:120]) != [STATE_CODES['idle']] * 10 + [STATE_CODES['charging']] * 10 or \
+       len(scheduler) != n - 120 or scheduler.parked[:120].any():
+        report_failure("Incorrect inputs of parked fleet instances")
+        return
+
+    print("\nTest 23 Passed\n")
+
+
+def run_test24(clock=None):
+    # Test 24 : CC/CV charging with temperature/SOC derating and charge limit checks, per BMS and over a fleet
+    # sleep => charging => sleep (fully charged), charging => sleep (charging fault)
+    clock = clock if clock is not None else RealClock()
+    print("Test 24 \n")
+    clock.sleep(0.5)
+
+    print("\nThis test charges BMS and fleet instances CC/CV at several temperatures\n")
+
+    # Warm cell charged from 20%: constant current at the limit, then constant voltage down to the termination current
+    virtual = VirtualClock()
+    cell = BMS(virtual, events=NullSink())
+    controller = ChargeController()
+    cell.charge_controller = controller
+    cell.temp_voltage = DEFAULT_SENSOR.to_voltage(25)
+    cell.soc = 20
+    cell.state = 'charging'
+    currents = []
+    voltages = []
+    while cell.state == 'charging' and len(currents) < 100000:
+        cell.step()
+        currents.append(-cell.current)
+        voltages.append(cell.voltage)
+    if (cell.state, cell.soc, cell.charger_plugged_in) != ('sleep', 100, False):
+        report_failure("Charging did not complete")
+        return
+    if currents[0] != FAST_CHARGE_CURRENT or max(currents) > FAST_CHARGE_CURRENT or max(voltages) > controller.cv_voltage + 1e-9:
+        report_failure("Charge current or voltage over the limit")
+        return
+    if currents[-1] >= TERMINATION_CURRENT and voltages[-1] < controller.cv_voltage - 1e-9:
+        report_failure("Charging ended outside the CV phase")
+        return
+
+    # Cold cell: derated current, hot cell: charging fault, the charger is disconnected
+    cell = BMS(virtual, events=NullSink())
+    cell.charge_controller = ChargeController()
+    cell.temp_voltage = DEFAULT_SENSOR.to_voltage(5)
+    cell.soc = 20
+    cell.state = 'charging'
+    cell.step()
+    if cell.state != 'charging' or not 0 < -cell.current < FAST_CHARGE_CURRENT:
+        report_failure("Cold charge current not derated")
+        return
+    cell.temp_voltage = DEFAULT_SENSOR.to_voltage(50)
+    cell.step()
+    if (cell.state, cell.charger_plugged_in) != ('sleep', False) or not cell.charge_controller.flags & CHARGE_OVERTEMPERATURE:
+        report_failure("No charging fault on a hot cell")
+        return
+    # Measured readings over the limit (charger misbehaving) also stop the charge
+    cell = BMS(virtual, events=NullSink())
+    cell.charge_controller = ChargeController()
+    cell.simulated = False
+    cell.temp_voltage = DEFAULT_SENSOR.to_voltage(25)
+    cell.voltage, cell.current, cell.soc = 3.8, -30.0, 50
+    cell.state = 'charging'
+    cell.step()
+    if cell.state != 'sleep' or cell.charge_controller.flags != CHARGE_OVERCURRENT:
+        report_failure("No charging fault on overcurrent")
+        return
+    # The profile's fatal limits hold while charging and shut the BMS down: 4.22 V is past the 4.2 V overvoltage
+    # fatal limit, 2.4 V below the undervoltage one
+    for voltage, expected in ((4.22, CHARGE_FATAL_FAULT | CHARGE_OVERVOLTAGE), (2.4, CHARGE_FATAL_FAULT)):
+        cell = BMS(virtual, events=NullSink())
+        cell.charge_controller = ChargeController()
+        cell.simulated = False
+        cell.voltage, cell.current, cell.soc = voltage, -1.0, 50
+        cell.state = 'charging'
+        cell.step()
+        if (cell.state, cell.charger_plugged_in) != ('deep_sleep', False) or cell.charge_controller.flags != expected \
+                or not cell.fault_flags & faults.FATAL_MASK:
+            report_failure("No shutdown on a fatal limit while charging")
+            return
+    fleet = BMSFleet(3)
+    fleet.charge_controller = ChargeController(3)
+    fleet.simulated = False
+    fleet.state[:] = STATE_CODES['charging']
+    fleet.charger_plugged_in[:] = True
+    fleet.voltage[:] = [3.8, 4.22, 3.8]
+    fleet.current[:] = [-1.0, -1.0, -30.0]
+    fleet.temp_voltage[:] = DEFAULT_SENSOR.to_voltage(25)
+    fleet.soc[:] = 50
+    fleet.step()
+    if list(fleet.states()) != ['charging', 'deep_sleep', 'sleep'] or list(fleet.charger_plugged_in) != [True, False, False]:
+        report_failure("Incorrect fleet charging faults")
+        return
+
+    # Fleet at mixed temperatures, tick by tick like the same BMS one by one
+    n = 1000
+    period = 5.0
+    temperatures = np.arange(n) % 65 - 9.5 # -9.5 to 54.5 C, away from the window limits
+    fleet = BMSFleet(n)
+    fleet.sample_period = period # one controller tick per fleet step, as every cell.step()
+    fleet.charge_controller = ChargeController(n, period=period)
+    fleet.state[:] = STATE_CODES['charging']
+    fleet.temp_voltage[:] = DEFAULT_SENSOR.to_voltage_array(temperatures)
+    fleet.soc[:] = np.linspace(5, 90, n) # an empty cell (2.5 V) is past the undervoltage fatal limit
+    cells = []
+    for i in range(0, n, 50):
+        cell = BMS(virtual, events=NullSink())
+        cell.charge_controller = ChargeController(period=period)
+        cell.state = 'charging'
+        cell.temp_voltage = float(fleet.temp_voltage[i])
+        cell.soc = float(fleet.soc[i])
+        cells.append(cell)
+    for _ in range(5000):
+        if not (fleet.state == STATE_CODES['charging']).any():
+            break
+        fleet.step()
+        for cell in cells:
+            cell.step()
+    if (fleet.state != STATE_CODES['sleep']).any() or fleet.charger_plugged_in.any():
+        report_failure("Fleet charging did not complete")
+        return
+    window = LI4P25RT.charge_temperature
+    outside = (temperatures < window[0]) | (temperatures > window[1])
+    # full cells rest at cv_voltage, just below OCV(100%), and sleep reads their SOC back from the OCV
+    if (fleet.soc[~outside] < 99).any() or (fleet.charge_controller.flags[~outside] != 0).any() \
+            or (fleet.charge_controller.flags[outside] == 0).any():
+        report_failure("Incorrect fleet charging")
+        return
+    for i, cell in zip(range(0, n, 50), cells):
+        if STATE_CODES[cell.state] != fleet.state[i] or abs(cell.soc - fleet.soc[i]) > 1e-6 \
+                or cell.charge_controller.flags != fleet.charge_controller.flags[i]:
+            report_failure("Fleet and BMS charging differ")
+            return
+
+    print("\nTest 24 Passed\n")
+
+
+def run_test25(clock=None):
+    # Test 25 : the fault bitmask of one reading is the same as the batched one, at and around every limit
+    clock = clock if clock is not None else RealClock()
+    print("Test 25 \n")
+    clock.sleep(0.5)
+
+    print("\nThis test evaluates the faults of readings on every limit one at a time and batched\n")
+
+    # Limits in any order: the fatal overcurrent limit below the warning one (any object with the limit
+    # fields can be evaluated against)
+    limits = types.SimpleNamespace(**{field: getattr(LI4P25RT, field) for field in profiles.LIMIT_FIELDS})
+    limits.overcurrent_fatal = 105
+    for profile in (LI4P25RT, limits):
+        channels = []
+        for limits, normal in (((profile.undervoltage_fatal, profile.undervoltage_warning,
+                                 profile.overvoltage_warning, profile.overvoltage_fatal), 3.6),
+                               ((profile.overcurrent_warning, profile.overcurrent_fatal), 0.0),
+                               ((profile.overtemperature_fatal, profile.overtemperature_warning,
+                                 profile.undertemperature_warning, profile.undertemperature_fatal), 1.86)):
+            channels.append([normal] + [limit + offset for limit in limits for offset in (-1e-3, 0.0, 1e-3)])
+        readings = np.array(list(itertools.product(*channels)))
+        batch = faults.evaluate_faults_batch(readings[:, 0], readings[:, 1], readings[:, 2], profile)
+        single = [faults.evaluate_faults(voltage, current, temp_voltage, profile)
+                  for voltage, current, temp_voltage in readings.tolist()]
+        if single != batch.tolist():
+            report_failure("Fault bitmasks differ")
+            return
+        if faults.evaluate_faults(3.6, profile.overcurrent_fatal, 1.86, profile) & faults.OVERCURRENT == 0:
+            report_failure("Fatal limit not checked")
+            return
+
+    print("\nTest 25 Passed\n")
+
+
+def run_test26(clock=None):
+    # Test 26 : a CompactBMS row runs like a BMS given the same inputs and noise
+    # deep_sleep => run_tests => idle => normal operation => sleep => charging => sleep
+    clock = clock if clock is not None else RealClock()
+    print("Test 26 \n")
+    clock.sleep(0.5)
+
+    print("\nThis test steps a BMSStore row and a BMS side by side and compares them every tick\n")
+
+    store = BMSStore(4, VirtualClock(), NullSink())
+    store.noise = NoiseStream(26)
+    store.new() # the compared cell is not the first row
+    compact = store.new()
+    cell = BMS(VirtualClock(), events=NullSink(), noise=NoiseStream(26))
+
+    fields = ['voltage', 'current', 'temp_voltage', 'ocv', 'soc']
+    for bms in (compact, cell):
+        bms.soc = 60
+        bms.button_pressed_5_sec()
+    for tick in range(300):
+        for bms in (compact, cell):
+            bms.pedal_press = 2 <= tick < 14
+            if tick == 30:
+                bms.button_press = True
+            if tick == 40:
+                bms.charger_plugged_in = True
+            bms.step()
+        if compact.state != cell.state or compact.fault_flags != cell.fault_flags \
+                or any(abs(getattr(compact, name) - getattr(cell, name)) > 1e-3 for name in fields):
+            report_failure(f"CompactBMS and BMS differ at tick {tick}")
+            return
+    if (cell.state, cell.soc, cell.charger_plugged_in) != ('sleep', 100, False) or store[0].state != 'deep_sleep':
+        report_failure("Incorrect state")
+        return
+
+    # Views of the same row are the same cell as far as dicts are concerned
+    other = store.new()
+    if store[1] != compact or hash(store[1]) != hash(compact) or store[0] == compact or \
+       {store[1]: 'a', other: 'b'}[store[1]] != 'a' or BMSStore(2, store.clock, NullSink()).new() == store[0]:
+        report_failure("Row views not equal")
+        return
+    other.state = 'sleep'
+    other.step()
+    scheduler = OCVScheduler(store.clock)
+    scheduler.park(store[2])
+    store[2].button_press = True
+    scheduler.wake(store[2])
+    if (other.state, len(scheduler)) != ('idle', 0):
+        report_failure("Row view not unparked")
+        return
+
+    for name in ('soc_filter', 'history', 'cell_model', 'fault_filter', 'charge_controller'):
+        setattr(compact, name, None)
+        try:
+            setattr(compact, name, object())
+        except AttributeError:
+            continue
+        report_failure(f"CompactBMS accepted a {name}")
+        return
+
+    print("\nTest 26 Passed\n")
+
+
+def run_test27(clock=None):
+    # Test 27 : every (state, trigger) pair of the transition table, through a BMS and a fleet
+    # a pair listed in TRANSITIONS goes to its dest, any other raises MachineError and leaves the state as it was
+    clock = clock if clock is not None else RealClock()
+    print("Test 27 \n")
+    clock.sleep(0.5)
+
+    print("\nThis test fires every trigger from every state and checks the table against TRANSITIONS\n")
+
+    expected = {}
+    for trigger, source, dest in TRANSITIONS:
+        if expected.setdefault((source, trigger), dest) != dest:
+            report_failure(f"Conflicting transitions for {trigger} from {source}")
+            return
+    if set(TRIGGERS) != {trigger for trigger, source, dest in TRANSITIONS}:
+        report_failure("Incorrect triggers")
+        return
+
+    for state, trigger in itertools.product(STATES, TRIGGERS):
+        dest = expected.get((state, trigger))
+        # by name, by code and through the trigger method
+        for fire in (lambda bms: bms.fire(trigger), lambda bms: bms.fire(TRIGGER_CODES[trigger]),
+                     lambda bms: getattr(bms, trigger)()):
+            bms = BMS(VirtualClock(), events=NullSink())
+            history = attach_history(bms)
+            bms.state = state
+            try:
+                fire(bms)
+            except MachineError:
+                if dest is not None or bms.state != state or history.count != 0:
+                    report_failure(f"{trigger} from {state} raised")
+                    return
+                continue
+            if dest is None or bms.state != dest or history.count != 1:
+                report_failure(f"{trigger} from {state} went to {bms.state}")
+                return
+        if TRANSITION_TABLE[STATE_CODES[state]][TRIGGER_CODES[trigger]] != (-1 if dest is None else STATE_CODES[dest]):
+            report_failure(f"Incorrect table entry for {trigger} from {state}")
+            return
+
+    # The fleet leaves the instances without a transition as they are
+    fleet = BMSFleet(len(STATES))
+    for trigger in TRIGGERS:
+        fleet.state[:] = np.arange(len(STATES))
+        fleet.fire(trigger)
+        dests = [expected.get((state, trigger), state) for state in STATES]
+        if list(fleet.states()) != dests:
+            report_failure(f"Incorrect fleet transitions for {trigger}")
+            return
+
+    print("\nTest 27 Passed\n")
+
+
+def run_test28(clock=None):
+    # Test 28 : temperature sensor conversions, both ways, for single values and arrays, and through BMS and fleet
+    clock = clock if clock is not None else RealClock()
+    print("Test 28 \n")
+    clock.sleep(0.5)
+
+    print("\nThis test converts temperatures to sensor voltages and back over the calibrated range\n")
+
+    temperatures, voltages = zip(*CALIBRATION)
+    celsius = np.arange(-20.0, 60.0 + 1e-9, 0.25)
+    expected = np.interp(celsius, temperatures, voltages)
+    voltage = DEFAULT_SENSOR.to_voltage_array(celsius)
+    if np.abs(voltage - expected).max() > 1e-9 or not (np.diff(voltage) < 0).all():
+        report_failure("Incorrect sensor voltages")
+        return
+    if np.abs(DEFAULT_SENSOR.to_celsius_array(voltage) - celsius).max() > 1e-6:
+        report_failure("Incorrect round-trip")
+        return
+    # The scalar conversions give the same values as the array ones
+    if voltage.tolist() != [DEFAULT_SENSOR.to_voltage(t) for t in celsius.tolist()] or \
+       DEFAULT_SENSOR.to_celsius_array(voltage).tolist() != [DEFAULT_SENSOR.to_celsius(v) for v in voltage.tolist()]:
+        report_failure("Scalar and array conversions differ")
+        return
+    # Inputs beyond the tables are clamped to their ends
+    if (DEFAULT_SENSOR.to_celsius(5.0), DEFAULT_SENSOR.to_voltage(-100)) != (DEFAULT_SENSOR.to_celsius(3.3), DEFAULT_SENSOR.to_voltage(-40)):
+        report_failure("Inputs not clamped")
+        return
+
+    # Through the temperature of a BMS, and a fleet read with another calibration
+    bms = BMS(VirtualClock(), events=NullSink())
+    bms.temperature = 25
+    if bms.temp_voltage != DEFAULT_SENSOR.to_voltage(25) or abs(bms.temperature - 25) > 1e-6:
+        report_failure("Incorrect BMS temperature")
+        return
+    sensor = TemperatureSensor([(0, 2.0), (100, 1.0)])
+    fleet = BMSFleet(3)
+    fleet.temp_voltage[:] = sensor.to_voltage_array(np.array([10.0, 50.0, 90.0]))
+    if np.abs(fleet.temp_voltage - [1.9, 1.5, 1.1]).max() > 1e-9 or np.abs(fleet.temperature(sensor) - [10, 50, 90]).max() > 1e-6:
+        report_failure("Incorrect calibrated sensor")
+        return
+
+    print("\nTest 28 Passed\n")
+
+
+def run_test29(clock=None):
+    # Test 29 : SOC Kalman filter, started from a wrong SOC, per cell and as one array filter, and through a BMS
+    # normal operation (filtered SOC) => sleep (OCV reset of the filter)
+    clock = clock if clock is not None else RealClock()
+    print("Test 29 \n")
+    clock.sleep(0.5)
+
+    print("\nThis test tracks the SOC of discharging cells from noisy terminal voltages\n")
+
+    capacity = LI4P25RT.capacity
+    resistance = LI4P25RT.internal_resistance
+    rng = np.random.default_rng(29)
+    truth = np.array([85.0, 70.0, 45.0, 25.0])
+    start = np.array([60.0, 90.0, 60.0, 40.0]) # off by 15-25 %
+    current = 10.0
+    cells = [SOCKalmanFilter(float(soc), capacity, resistance) for soc in start]
+    array = SOCKalmanFilter(start.copy(), capacity, resistance, variance=np.full(4, 25.0))
+    counted = start.copy()
+    for _ in range(600):
+        truth = coulomb_count(truth, current, 1.0, capacity)
+        counted = coulomb_count(counted, current, 1.0, capacity)
+        voltage = soc_to_ocv(truth) - current * resistance + rng.normal(0, 0.005, 4)
+        array.step(current, voltage, 1.0)
+        for cell, v in zip(cells, voltage.tolist()):
+            cell.step(current, v, 1.0)
+    estimates = np.array([cell.soc for cell in cells])
+    if np.abs(estimates - truth).max() > 2 or np.abs(counted - truth).min() < 10:
+        report_failure("SOC not tracked")
+        return
+    if np.abs(array.soc - estimates).max() > 1e-9 or not (array.variance < 1).all():
+        report_failure("Array filter differs from the cell filters")
+        return
+
+    # A BMS with a filter estimates its SOC through it, and the OCV measurement in sleep resets it
+    bms = BMS(VirtualClock(), events=NullSink(), noise=NoiseStream(29))
+    bms.soc_filter = SOCKalmanFilter(bms.soc, capacity, resistance)
+    bms.button_pressed_5_sec()
+    bms.pedal_press = True
+    for _ in range(8):
+        bms.step()
+    if bms.state != 'normal_operation' or bms.soc != bms.soc_filter.soc or bms.soc_filter.variance >= 25:
+        report_failure("SOC not filtered")
+        return
+    bms.state = 'sleep' # at rest at 3.8 V, 60 % by the OCV curve
+    bms.voltage = 3.8
+    bms.step()
+    if bms.state != 'sleep' or abs(bms.soc - 60) > 1e-6 or (bms.soc_filter.soc, bms.soc_filter.variance) != (bms.soc, 1.0):
+        report_failure("Filter not reset from the OCV")
+        return
+
+    print("\nTest 29 Passed\n")
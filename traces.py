@@ -0,0 +1,253 @@
+import struct
+import numpy as np
+from bms import TRIGGERS, TRIGGER_CODES, MachineError
+from clock import VirtualClock
+from compact import PEDAL_PRESS, CHARGER_PLUGGED_IN, DIAGNOSTICS_PASS, BUTTON_PRESS
+from fleet import BMSFleet
+from runtime import BMSRuntime
+
+# Sensor traces: fixed width binary records of pack telemetry, recorded from live/simulated runs
+# and replayed through the state machine, read with numpy.memmap so a trace never has to fit in memory
+#
+# Trace file: 16 byte header (magic, version, record size, packs) followed by the records of each tick,
+# one record per pack (a trace of n packs is a (ticks, n) array of records)
+# Record (24 bytes): timestamp (s), voltage (V), current (A), temp_voltage (V), input flag bits
+# (same bits as compact.py), trigger code fired at this sample (-1: none, e.g. button_pressed_5_sec)
+#
+# Transition log file: 16 byte header followed by one 16 byte record per state change
+# (timestamp, pack, source state code, dest state code)
+
+TRACE_MAGIC = b'BMSTRACE'
+LOG_MAGIC = b'BMSTLOG\0'
+VERSION = 1
+HEADER = struct.Struct('<8sHHI') # magic, version, record size, packs
+
+TRACE_DTYPE = np.dtype([
+    ('timestamp', '<f8'),
+    ('voltage', '<f4'),
+    ('current', '<f4'),
+    ('temp_voltage', '<f4'),
+    ('inputs', 'u1'),
+    ('trigger', 'i1'),
+    ('reserved', '<u2'),
+])
+
+LOG_DTYPE = np.dtype([
+    ('timestamp', '<f8'),
+    ('pack', '<u4'),
+    ('source', 'i1'),
+    ('dest', 'i1'),
+    ('reserved', '<u2'),
+])
+
+# Input attributes and their flag bits
+INPUT_BITS = [
+    ('pedal_press', PEDAL_PRESS),
+    ('charger_plugged_in', CHARGER_PLUGGED_IN),
+    ('diagnostics_pass', DIAGNOSTICS_PASS),
+    ('button_press', BUTTON_PRESS),
+]
+
+# Ticks a single sample may take, for states left right away (run_tests => idle => ...)
+MAX_TICKS_PER_SAMPLE = 8
+
+
+class TraceError(Exception):
+    pass
+
+
+def read_header(path, magic, dtype):
+    with open(path, 'rb') as file:
+        header = file.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise TraceError(f"{path} is too short to be a trace")
+    found, version, record_size, packs = HEADER.unpack(header)
+    if found != magic or version != VERSION or record_size != dtype.itemsize:
+        raise TraceError(f"{path} is not a version {VERSION} {magic.rstrip(bytes(1)).decode()} file")
+    return packs
+
+
+def open_trace(path):
+    # Memory mapped (ticks, packs) array of TRACE_DTYPE records, read only
+    packs = read_header(path, TRACE_MAGIC, TRACE_DTYPE)
+    records = np.memmap(path, dtype=TRACE_DTYPE, mode='r', offset=HEADER.size)
+    return records.reshape(-1, packs)
+
+
+def open_transition_log(path):
+    # Memory mapped array of LOG_DTYPE records, read only
+    read_header(path, LOG_MAGIC, LOG_DTYPE)
+    return np.memmap(path, dtype=LOG_DTYPE, mode='r', offset=HEADER.size)
+
+
+class RecordWriter():
+    # Appends records of dtype to a file, buffering up to buffer records in memory
+    def __init__(self, path, magic, dtype, packs=1, buffer=65536):
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(magic, VERSION, dtype.itemsize, packs))
+        self.records = np.zeros(buffer, dtype=dtype)
+        self.count = 0
+        self.written = 0
+
+    def reserve(self, count):
+        # Index of count free records in the buffer (flushing first if they don't fit)
+        if self.count + count > len(self.records):
+            self.flush()
+            if count > len(self.records):
+                self.records = np.zeros(count, dtype=self.records.dtype)
+        start = self.count
+        self.count += count
+        self.written += count
+        return slice(start, start + count)
+
+    def flush(self):
+        self.records[:self.count].tofile(self.file)
+        self.count = 0
+        self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TraceRecorder(RecordWriter):
+    # Records the readings and inputs of a BMS (packs=1) or of every instance of a BMSFleet (packs=fleet.n) each tick
+    def __init__(self, path, packs=1, buffer=65536):
+        super().__init__(path, TRACE_MAGIC, TRACE_DTYPE, packs, buffer)
+        self.packs = packs
+
+    def record(self, bms, trigger=None):
+        # One sample of a BMS at bms.clock.time(), trigger is the name of a trigger fired at this sample
+        record = self.records[self.reserve(1)][0:1]
+        inputs = 0
+        for name, bit in INPUT_BITS:
+            if getattr(bms, name):
+                inputs |= bit
+        record['timestamp'] = bms.clock.time()
+        record['voltage'] = bms.voltage
+        record['current'] = bms.current
+        record['temp_voltage'] = bms.temp_voltage
+        record['inputs'] = inputs
+        record['trigger'] = TRIGGER_CODES[trigger] if trigger is not None else -1
+
+    def record_fleet(self, fleet, timestamp, trigger=None):
+        # One sample of every instance of a fleet, trigger is None or a trigger code per instance (-1: none)
+        records = self.records[self.reserve(fleet.n)]
+        inputs = np.zeros(fleet.n, dtype=np.uint8)
+        for name, bit in INPUT_BITS:
+            inputs[getattr(fleet, name)] |= bit
+        records['timestamp'] = timestamp
+        records['voltage'] = fleet.voltage
+        records['current'] = fleet.current
+        records['temp_voltage'] = fleet.temp_voltage
+        records['inputs'] = inputs
+        records['trigger'] = trigger if trigger is not None else -1
+
+
+class TransitionLog(RecordWriter):
+    def __init__(self, path, buffer=65536):
+        super().__init__(path, LOG_MAGIC, LOG_DTYPE, 1, buffer)
+
+    def append(self, timestamp, pack, source, dest):
+        record = self.records[self.reserve(1)][0:1]
+        record['timestamp'] = timestamp
+        record['pack'] = pack
+        record['source'] = source
+        record['dest'] = dest
+
+    def extend(self, timestamp, packs, source, dest):
+        records = self.records[self.reserve(len(packs))]
+        records['timestamp'] = timestamp
+        records['pack'] = packs
+        records['source'] = source
+        records['dest'] = dest
+
+
+def replay(trace, bms, log=None, pack=0, chunk=65536):
+    # Feed the samples of one pack of a trace into a BMS, one tick of its current state per sample
+    # (the same work as the async runtime), on a VirtualClock set to the sample timestamps
+    # Every state change is appended to log (a TransitionLog) if given, returns the number of transitions
+    # The clock and simulated of bms are restored afterwards
+    # Plain Python per sample, about 0.4M samples/s here: replay_fleet of a single pack only reaches about 4k ticks/s
+    # (its fixed array work per tick), it pays off for many packs
+    saved = bms.clock, bms.simulated
+    bms.simulated = False
+    clock = bms.clock = VirtualClock()
+    try:
+        runtime = BMSRuntime(bms)
+        transitions = 0
+        for start in range(0, len(trace), chunk):
+            # Plain Python lists of each column are much faster to step through than the records
+            records = trace[start:start + chunk, pack]
+            columns = [records[name].tolist() for name in ('timestamp', 'voltage', 'current', 'temp_voltage', 'inputs', 'trigger')]
+            for timestamp, voltage, current, temp_voltage, inputs, trigger in zip(*columns):
+                clock.now = timestamp
+                bms.voltage = voltage
+                bms.current = current
+                bms.temp_voltage = temp_voltage
+                bms.pedal_press = (inputs & PEDAL_PRESS) != 0
+                bms.charger_plugged_in = (inputs & CHARGER_PLUGGED_IN) != 0
+                bms.diagnostics_pass = (inputs & DIAGNOSTICS_PASS) != 0
+                bms.button_press = (inputs & BUTTON_PRESS) != 0
+
+                source = bms.state_code
+                if trigger >= 0:
+                    try:
+                        bms.fire(trigger)
+                    except MachineError:
+                        pass # the trigger does nothing in this state
+                    if bms.state_code != source:
+                        transitions += 1
+                        if log is not None:
+                            log.append(timestamp, pack, source, bms.state_code)
+                        source = bms.state_code
+
+                for _ in range(MAX_TICKS_PER_SAMPLE):
+                    delay = runtime.tick()
+                    if bms.state_code != source:
+                        transitions += 1
+                        if log is not None:
+                            log.append(timestamp, pack, source, bms.state_code)
+                        source = bms.state_code
+                    if delay != 0:
+                        break
+        return transitions
+    finally:
+        bms.clock, bms.simulated = saved # the replay leaves bms as it was
+
+
+def replay_fleet(trace, fleet=None, log=None):
+    # Feed every pack of a trace into one instance of a BMSFleet each (one fleet step per tick)
+    # This is the fast path for many packs: the work per tick is a few array operations over all of them
+    # Every state change is appended to log if given, returns the fleet
+    ticks, packs = trace.shape
+    if fleet is None:
+        fleet = BMSFleet(packs)
+    fleet.simulated = False
+    for tick in range(ticks):
+        records = np.asarray(trace[tick])
+        fleet.voltage[:] = records['voltage']
+        fleet.current[:] = records['current']
+        fleet.temp_voltage[:] = records['temp_voltage']
+        inputs = records['inputs']
+        for name, bit in INPUT_BITS:
+            np.not_equal(inputs & bit, 0, out=getattr(fleet, name))
+
+        source = fleet.state.copy()
+        triggers = records['trigger']
+        for code in np.unique(triggers[triggers >= 0]):
+            fleet.fire(TRIGGERS[code], triggers == code)
+        fleet.step()
+
+        if log is not None:
+            changed = np.flatnonzero(fleet.state != source)
+            if len(changed):
+                log.extend(records['timestamp'][changed], changed, source[changed], fleet.state[changed])
+    return fleet